@@ -1,29 +1,42 @@
 # Copyright 2017 Canonical Ltd.
 # Licensed under the AGPLv3, see LICENCE file for details.
 
+# This module is loaded by every hook, including collect-metrics which runs
+# every five minutes. Standard library modules are imported here, while
+# expensive third party modules, like charms.reactive, pylxd and the
+# charmhelpers templating and unit data modules, are imported by the
+# functions using them.
 import base64
+from concurrent import futures
+import datetime
 import hashlib
+import ipaddress
+import json
 import os
 import pipes
+import socket
 import subprocess
+import time
+import uuid
 from urllib import parse
 
-from charmhelpers.core import (
-    hookenv,
-    templating,
-)
-from charms.reactive import (
-    set_flag,
-)
+from charmhelpers.core import hookenv
 import yaml
 
 
-# Define the LXD image name and profiles to use when launching instances.
+# Define the LXD image names and profiles to use when launching instances.
 IMAGE_NAME = 'termserver'
+IMAGE_NAME_LIMITED = 'termserver-limited'
 LXC = '/usr/bin/lxc'
 LXD = '/usr/bin/lxd'
+XDELTA3 = '/usr/bin/xdelta3'
 PROFILE_TERMSERVER = 'termserver'
 PROFILE_TERMSERVER_LIMITED = 'termserver-limited'
+PROFILE_LIMITED_TERMSERVER = 'limited-termserver'
+NETWORK_BRIDGE = 'jujushellbr0'
+STORAGE_POOL = 'jujushellstorage'
+CACHE_VOLUME = 'jujushell-cache'
+CACHE_PATH = '/var/cache/jujushell'
 
 
 def agent_path():
@@ -36,6 +49,11 @@ def config_path():
     return os.path.join(hookenv.charm_dir(), 'files', 'config.yaml')
 
 
+def allowed_users_path():
+    """Get the location for the allowed users resource file."""
+    return os.path.join(hookenv.charm_dir(), 'files', 'allowed-users')
+
+
 def jujushell_path():
     """Get the location for the jujushell binary."""
     return os.path.join(hookenv.charm_dir(), 'files', 'jujushell')
@@ -46,6 +64,29 @@ def termserver_path(limited=False):
     return '/var/tmp/termserver{}.tar.gz'.format('-limited' if limited else '')
 
 
+def image_name(limited=False):
+    """Get the LXD alias for the termserver image."""
+    return IMAGE_NAME_LIMITED if limited else IMAGE_NAME
+
+
+def termserver_profiles(limited=False):
+    """Get the LXD profiles applied to termserver containers.
+
+    Limited sessions use their own devices and quotas in place of the full
+    ones, so that limited quotas do not depend on full ones. The cloud-init
+    user data is provided to all sessions by the termserver-limited profile.
+    """
+    if limited:
+        return (PROFILE_LIMITED_TERMSERVER, PROFILE_TERMSERVER_LIMITED)
+    return (PROFILE_TERMSERVER, PROFILE_TERMSERVER_LIMITED)
+
+
+def set_flag(flag):
+    """Set the given reactive flag."""
+    from charms.reactive import set_flag
+    set_flag(flag)
+
+
 def call(command, *args, **kwargs):
     """Call a subprocess passing the given arguments.
 
@@ -72,7 +113,13 @@ def call(command, *args, **kwargs):
 
 
 def build_config(cfg):
-    """Build and save the jujushell server config."""
+    """Build and save the jujushell server config.
+
+    The config file is replaced atomically, and only if its content changed.
+    Ports are only opened or closed when they differ from the ones used by
+    the previous charm config. Return the sorted names of the changed server
+    options as a tuple, which is empty if the config file did not change.
+    """
     juju_addrs = (
         _get_string(cfg, 'juju-addrs') or
         os.getenv('JUJU_API_ADDRESSES'))
@@ -88,27 +135,190 @@ def build_config(cfg):
     previous_cfg = getattr(cfg, '_prev_dict', {}) or {}
     previous_ports = get_ports(previous_cfg)
     for port in current_ports:
-        hookenv.open_port(port)
+        if port not in previous_ports:
+            hookenv.open_port(port)
     for port in previous_ports:
         if port not in current_ports:
             hookenv.close_port(port)
 
+    users, patterns = allowed_users(cfg)
+    limited = bool(cfg.get('limit-termserver'))
     data = {
-        'allowed-users': _get_string(cfg, 'allowed-users').split(),
-        'juju-addrs': juju_addrs.split(),
+        # Patterns are also included in the list of users, so that servers
+        # not supporting patterns deny access rather than allowing everyone.
+        'allowed-users': sorted(users + patterns),
+        'juju-addrs': _ranked_addresses(juju_addrs.split()),
         'juju-cert': juju_cert,
-        'image-name': IMAGE_NAME,
+        'image-name': image_name(limited=limited),
         'log-level': cfg['log-level'],
         'lxd-socket-path': _lxd_socket(),
         'port': current_ports[0],
-        'profiles': (PROFILE_TERMSERVER, PROFILE_TERMSERVER_LIMITED),
+        'profiles': termserver_profiles(limited=limited),
         'session-timeout': cfg.get('session-timeout', 0),
         'welcome-message': _get_string(cfg, 'welcome-message'),
     }
+    expiry_action = _get_string(cfg, 'session-expiry-action') or 'stop'
+    if expiry_action not in ('stop', 'freeze'):
+        raise ValueError(
+            'invalid session expiry action: {}'.format(expiry_action))
+    if expiry_action != 'stop':
+        data['session-expiry-action'] = expiry_action
+    if patterns:
+        data['allowed-user-patterns'] = patterns
+    if users or patterns:
+        data['allowed-users-fingerprint'] = hashlib.sha256(
+            json.dumps([users, patterns]).encode('utf-8')).hexdigest()
     if cfg['tls']:
         data.update(_build_tls_config(cfg))
-    with open(config_path(), 'w') as stream:
-        yaml.safe_dump(data, stream=stream)
+    content = yaml.safe_dump(data)
+    try:
+        with open(config_path()) as f:
+            previous = yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        previous = {}
+    if not _write_file(config_path(), content.encode('utf-8')):
+        return ()
+    # Compare the loaded values, as sequences are saved as lists.
+    current = yaml.safe_load(content)
+    return tuple(sorted(
+        key for key in set(previous).union(current)
+        if previous.get(key) != current.get(key)))
+
+
+def allowed_users(cfg):
+    """Return the users allowed to access the service.
+
+    Users are specified by the "allowed-users" option and by the optional
+    "allowed-users" resource, which includes white space separated users, with
+    comments starting with "#". Entries including "*" are glob patterns, for
+    instance "*@external" for all external users.
+
+    Return the sorted unique user names and patterns as two lists. Empty lists
+    mean that all users are allowed.
+    """
+    entries = set(_get_string(cfg, 'allowed-users').split())
+    try:
+        with open(allowed_users_path()) as f:
+            for line in f:
+                entries.update(line.split('#', 1)[0].split())
+    except FileNotFoundError:
+        pass
+    users = sorted(entry for entry in entries if '*' not in entry)
+    patterns = sorted(entry for entry in entries if '*' in entry)
+    return users, patterns
+
+
+def validate_config(cfg):
+    """Check the charm config without applying it.
+
+    Raise a ValueError describing the first invalid option found.
+    """
+    for option, values in (
+            ('lxc-cpu-placement', ('none', 'numa')),
+            ('memory-pressure-action', ('freeze', 'stop')),
+            ('session-expiry-action', ('stop', 'freeze'))):
+        value = _get_string(cfg, option)
+        if value and value not in values:
+            raise ValueError('invalid {}: {}'.format(option, value))
+    _lxd_bridge_config(cfg)
+    cpu_layout(cfg, numa_nodes())
+
+
+def _write_file(path, content):
+    """Atomically write the given bytes to the file at the given path.
+
+    The content is written to a temporary file which is then renamed, so that
+    readers never see a partially written file. Nothing is written if the
+    file already has the given content. Return whether the file changed.
+    """
+    try:
+        if _file_sha256(path) == hashlib.sha256(content).hexdigest():
+            return False
+    except FileNotFoundError:
+        pass
+    target = path + '.new'
+    with open(target, 'wb') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(target, path)
+    return True
+
+
+def _ranked_addresses(addrs):
+    """Rank the given controller addresses starting from the ranking used
+    for the previous config, and store the result in the unit data.
+    """
+    from charmhelpers.core import unitdata
+    kv = unitdata.kv()
+    ranked = rank_addresses(
+        addrs, previous=kv.get('jujushell.juju-addrs') or ())
+    kv.set('jujushell.juju-addrs', ranked)
+    return ranked
+
+
+def rank_addresses(addrs, timeout=2, previous=()):
+    """Return the given controller addresses ranked by reachability and RTT.
+
+    Addresses are provided as "host:port" strings, and they are probed
+    concurrently by opening TCP connections with the given timeout in seconds.
+    Reachable addresses come first, and unreachable ones keep their order at
+    the end. The ranking starts from the previous one if provided, with new
+    addresses appended in their original order, and an address only moves
+    ahead of another one when it is significantly faster, so that jitter
+    between probes does not change the ranking.
+    """
+    addrs = list(addrs)
+    if len(addrs) < 2:
+        return addrs
+    with futures.ThreadPoolExecutor(max_workers=len(addrs)) as pool:
+        rtts = dict(zip(addrs, pool.map(
+            _probe_address, addrs, [timeout] * len(addrs))))
+    base = [addr for addr in previous if addr in rtts]
+    base += [addr for addr in addrs if addr not in base]
+    ranked = []
+    for addr in base:
+        if rtts[addr] is None:
+            continue
+        index = len(ranked)
+        while index and _significantly_faster(
+                rtts[addr], rtts[ranked[index - 1]]):
+            index -= 1
+        ranked.insert(index, addr)
+    return ranked + [addr for addr in base if rtts[addr] is None]
+
+
+def _significantly_faster(rtt, other):
+    """Report whether the given RTT is significantly lower than the other.
+
+    The RTT must be less than half the other one, and lower by at least 5ms.
+    """
+    return rtt < other * _RTT_RATIO and other - rtt >= _RTT_MIN_DIFF
+
+
+# Define the ratio and the minimum difference in seconds required for an
+# address to be ranked ahead of another one.
+_RTT_RATIO = 0.5
+_RTT_MIN_DIFF = 0.005
+
+
+def _probe_address(address, timeout):
+    """Return the time in seconds required to connect to the given address.
+
+    Return None if the address is not valid or not reachable.
+    """
+    host, _, port = address.rpartition(':')
+    try:
+        port = int(port)
+    except ValueError:
+        return None
+    start = time.monotonic()
+    try:
+        with socket.create_connection((host.strip('[]'), port), timeout):
+            pass
+    except OSError:
+        return None
+    return time.monotonic() - start
 
 
 def _build_tls_config(cfg):
@@ -124,9 +334,34 @@ def _build_tls_config(cfg):
             'tls-cert': base64.b64decode(cert).decode('utf-8'),
             'tls-key': base64.b64decode(key).decode('utf-8'),
         }
-    # Automatically generate a self-signed certificate.
-    key, cert = _get_self_signed_cert()
-    return {'tls-cert': cert, 'tls-key': key}
+    # Automatically generate a self-signed certificate. The certificate is
+    # stored in the unit data, so that the server config does not change
+    # every time it is rendered. It is generated again when the unit address
+    # changes, or when it is about to expire.
+    from charmhelpers.core import unitdata
+    kv = unitdata.kv()
+    address = hookenv.unit_public_ip()
+    now = int(time.time())
+    stored = kv.get('jujushell.self-signed-cert')
+    if (not isinstance(stored, dict) or stored['address'] != address or
+            stored['expires'] - now < _CERT_RENEWAL_DAYS * 24 * 60 * 60):
+        hookenv.log('generating a self-signed certificate for {}'.format(
+            address))
+        key, cert = _get_self_signed_cert(address)
+        stored = {
+            'address': address,
+            'cert': cert,
+            'expires': now + _CERT_DAYS * 24 * 60 * 60,
+            'key': key,
+        }
+        kv.set('jujushell.self-signed-cert', stored)
+    return {'tls-cert': stored['cert'], 'tls-key': stored['key']}
+
+
+# Define for how many days self-signed certificates are valid, and how many
+# days before they expire they are generated again.
+_CERT_DAYS = 365
+_CERT_RENEWAL_DAYS = 30
 
 
 def get_ports(cfg):
@@ -144,43 +379,234 @@ def get_ports(cfg):
 
 
 def update_lxc_quotas(cfg):
-    """Update the default profile to include resource limits from config."""
+    """Update the termserver profiles to include resource limits from config.
+
+    Limits for the full and limited termserver profiles are specified by
+    options prefixed with "lxc-quota-" and "limited-lxc-quota-" respectively.
+    The profiles are never stacked, so each set of limits is complete. Only
+    limits that differ from the current ones are applied.
+    """
     hookenv.status_set('maintenance', 'updating LXC quotas')
-    call(LXC, 'profile', 'set', PROFILE_TERMSERVER, 'limits.cpu',
-         _get_string(cfg, 'lxc-quota-cpu-cores'))
-    call(LXC, 'profile', 'set', PROFILE_TERMSERVER, 'limits.cpu.allowance',
-         _get_string(cfg, 'lxc-quota-cpu-allowance'))
-    call(LXC, 'profile', 'set', PROFILE_TERMSERVER, 'limits.memory',
-         _get_string(cfg, 'lxc-quota-ram'))
-    call(LXC, 'profile', 'set', PROFILE_TERMSERVER, 'limits.processes',
-         _get_string(cfg, 'lxc-quota-processes'))
+    client = _lxd_client()
+    for name, prefix in (
+            (PROFILE_TERMSERVER, 'lxc-quota-'),
+            (PROFILE_LIMITED_TERMSERVER, 'limited-lxc-quota-')):
+        profile = client.api.profiles[name]
+        current = profile.get().json()['metadata']
+        diff = _lxd_diff(current, _lxc_quotas(cfg, prefix))
+        if diff:
+            hookenv.log('updating LXC quotas for profile {}: {}'.format(
+                name, diff))
+            profile.patch(json=diff)
+
+
+def _lxc_quotas(cfg, prefix):
+    """Return the profile config and devices for resource limits from config.
+
+    Limits are retrieved from options with the given prefix. Empty values are
+    used to unset limits.
+    """
+    def get(key):
+        return _get_string(cfg, prefix + key)
+
+    def get_count(key):
+        # A zero count means no limit, while a zero priority is meaningful.
+        return '' if cfg.get(prefix + key) == 0 else get(key)
+    devices = _termserver_devices()
+    devices['root'].update({
+        'limits.read': get('disk-read'),
+        'limits.write': get('disk-write'),
+        'size': get('disk'),
+    })
+    devices['eth0'].update({
+        'limits.ingress': get('net-ingress'),
+        'limits.egress': get('net-egress'),
+    })
+    return {
+        'config': {
+            'limits.cpu': get_count('cpu-cores'),
+            'limits.cpu.allowance': get('cpu-allowance'),
+            'limits.cpu.priority': get('cpu-priority'),
+            'limits.memory': get('ram'),
+            'limits.memory.swap': str(
+                bool(cfg.get(prefix + 'swap', True))).lower(),
+            'limits.processes': get_count('processes'),
+        },
+        'devices': devices,
+    }
+
+
+def numa_nodes(root='/sys/devices/system/node'):
+    """Return the host NUMA topology as a sequence of CPU id tuples, one per
+    node.
+
+    If the topology is not available, all CPUs are assumed to belong to a
+    single node.
+    """
+    nodes = []
+    try:
+        names = sorted(
+            (name for name in os.listdir(root) if name.startswith('node') and
+             name[4:].isdigit()), key=lambda name: int(name[4:]))
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        with open(os.path.join(root, name, 'cpulist')) as f:
+            cpus = _parse_cpulist(f.read())
+        if cpus:
+            nodes.append(cpus)
+    if not nodes:
+        nodes.append(tuple(range(os.cpu_count() or 1)))
+    return tuple(nodes)
+
+
+def cpu_layout(cfg, nodes):
+    """Split host CPUs between the jujushell service and containers.
+
+    The first "jujushell-reserved-cpus" CPUs are reserved for the jujushell
+    service. Return a tuple (reserved, nodes) where reserved is a tuple of CPU
+    ids and nodes is the NUMA topology available to containers.
+    """
+    count = cfg.get('jujushell-reserved-cpus') or 0
+    reserved = tuple(sorted(cpu for node in nodes for cpu in node)[:count])
+    available = tuple(
+        tuple(cpu for cpu in node if cpu not in reserved) for node in nodes)
+    available = tuple(node for node in available if node)
+    if not available:
+        raise ValueError('no CPUs left for containers')
+    return reserved, available
+
+
+def place_containers(cfg, nodes=None):
+    """Pin termserver containers to CPUs, spreading them across NUMA nodes.
+
+    This is only done when "lxc-cpu-placement" is set to "numa". Each
+    container is assigned the number of CPUs specified by its CPU quota, taken
+    from the least loaded node, so that it does not span multiple nodes.
+    Containers already pinned are left where they are. When placement is
+    disabled, previously pinned containers are unpinned.
+
+    Return the new placements as a dict mapping container names to CPU lists.
+    """
+    placement = _get_string(cfg, 'lxc-cpu-placement') or 'none'
+    client = _lxd_client()
+    response = client.api.containers.get(params={'recursion': 1})
+    containers = response.json()['metadata']
+    if placement != 'numa':
+        for container in containers:
+            if container['config'].get(_CPUS_KEY):
+                hookenv.log('unpinning container {}'.format(
+                    container['name']))
+                client.api.containers[container['name']].patch(json={
+                    'config': {'limits.cpu': '', _CPUS_KEY: ''}})
+        return {}
+    _, nodes = cpu_layout(cfg, nodes or numa_nodes())
+    load = {cpu: 0 for node in nodes for cpu in node}
+    unplaced = []
+    for container in containers:
+        cpus = _parse_cpulist(container['config'].get(_CPUS_KEY, ''))
+        if cpus and all(cpu in load for cpu in cpus):
+            for cpu in cpus:
+                load[cpu] += 1
+        else:
+            unplaced.append(container)
+    # Sessions are all started with the termserver variant selected in config.
+    limited = cfg.get('limit-termserver')
+    prefix = 'limited-lxc-quota-' if limited else 'lxc-quota-'
+    count = max(int(cfg.get(prefix + 'cpu-cores') or 1), 1)
+    placements = {}
+    for container in unplaced:
+        # Pick the node with the lowest load per CPU, and then its least used
+        # CPUs.
+        node = min(nodes, key=lambda n: sum(load[c] for c in n) / len(n))
+        cpus = tuple(sorted(
+            sorted(node, key=lambda c: (load[c], c))[:count]))
+        for cpu in cpus:
+            load[cpu] += 1
+        cpulist = _format_cpulist(cpus)
+        hookenv.log('pinning container {} to CPUs {}'.format(
+            container['name'], cpulist))
+        client.api.containers[container['name']].patch(json={
+            'config': {'limits.cpu': cpulist, _CPUS_KEY: cpulist}})
+        placements[container['name']] = cpulist
+    return placements
+
+
+# Define the container config key used to record CPU placements.
+_CPUS_KEY = 'user.jujushell.cpus'
+
+
+def _parse_cpulist(cpulist):
+    """Parse a CPU list like "0-3,8" and return a tuple of CPU ids."""
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        start, _, end = part.partition('-')
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return tuple(cpus)
+
+
+def _format_cpulist(cpus):
+    """Format the given CPU ids as a list of ranges, e.g. "0-3,8-8".
+
+    Single CPUs are formatted as ranges too, as LXD would otherwise interpret
+    them as a number of CPUs.
+    """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join('{}-{}'.format(start, end) for start, end in ranges)
 
 
 def _get_string(cfg, key):
-    value = str(cfg.get(key, '') or '')
-    return value.strip()
+    """Return the given option as a string.
+
+    Only missing and None values are returned as empty strings, so that
+    zero values are preserved.
+    """
+    value = cfg.get(key)
+    if value is None:
+        return ''
+    return str(value).strip()
 
 
 def _get_juju_cert(path):
     """Return the certificate to use when connecting to the controller.
 
     The certificate is provided in PEM format and it is retrieved by parsing
-    agent.conf.
+    agent.conf. The certificate is cached in the unit data, and agent.conf is
+    only parsed again when its path, size or modification time change.
     """
+    from charmhelpers.core import unitdata
+    info = os.stat(path)
+    key = [path, info.st_size, info.st_mtime_ns]
+    kv = unitdata.kv()
+    cached = kv.get('jujushell.juju-cert') or {}
+    if cached.get('key') == key:
+        return cached['cert']
     with open(path) as stream:
-        return yaml.safe_load(stream)['cacert']
+        cert = yaml.safe_load(stream)['cacert']
+    kv.set('jujushell.juju-cert', {'key': key, 'cert': cert})
+    return cert
 
 
-def _get_self_signed_cert():
-    """Create and return a self signed TLS certificate."""
+def _get_self_signed_cert(address):
+    """Create and return a self signed TLS certificate for the given
+    address.
+    """
     call('openssl', 'req',
          '-x509',
          '-newkey', 'rsa:4096',
          '-keyout', 'key.pem',
          '-out', 'cert.pem',
-         '-days', '365',
+         '-days', str(_CERT_DAYS),
          '-nodes',
-         '-subj', '/C=GB/ST=London/L=London/O=Canonical/OU=JAAS/CN=0.0.0.0')
+         '-subj', '/C=GB/ST=London/L=London/O=Canonical/OU=JAAS/CN={}'.format(
+             address))
     with open('key.pem') as keyfile:
         key = keyfile.read()
     with open('cert.pem') as certfile:
@@ -206,60 +632,343 @@ def save_resource(name, path):
     set_flag('jujushell.resource.available.{}'.format(name))
 
 
+def save_optional_resource(name, path):
+    """Retrieve a resource if available and save it in the given path.
+
+    Return whether the resource has been saved. If the resource is not
+    available, any file previously saved in the given path is removed, so that
+    stale resources are never used.
+    """
+    try:
+        save_resource(name, path)
+    except OSError:
+        if os.path.exists(path):
+            os.remove(path)
+        return False
+    return True
+
+
+def save_image_resource(name, path, alias):
+    """Retrieve the image resource with the given name and save it in path.
+
+    The optional "<name>-sha256" resource is saved alongside the image. When
+    the file at the given path is the source of the image currently referred
+    to by the given alias, the full resource is only downloaded if required:
+    the local file is reused if the published checksum refers to the current
+    image, and the new image is reconstructed if a "<name>-delta" resource is
+    available. In all other cases, or if reconstructing the image fails, the
+    full resource is retrieved.
+
+    Raise an OSError if the image cannot be retrieved.
+    """
+    save_optional_resource(name + '-sha256', checksum_path(path))
+    checksum = read_checksum(path)
+    current = _current_fingerprint(path, alias)
+    if current is not None:
+        if checksum == current:
+            hookenv.log('reusing {} for resource {!r}'.format(path, name))
+            set_flag('jujushell.resource.available.{}'.format(name))
+            return
+        if _apply_delta_resource(name + '-delta', path, checksum):
+            set_flag('jujushell.resource.available.{}'.format(name))
+            return
+    save_resource(name, path)
+
+
+def _current_fingerprint(path, alias):
+    """Return the fingerprint of the image at the given path.
+
+    Return None if the file does not exist or if it is not the image currently
+    referred to by the given alias in LXD. The file is only hashed if no
+    fingerprint has been recorded for it.
+    """
+    if not os.path.exists(path):
+        return None
+    import pylxd  # Imported here because pylxd is not immediately available.
+    try:
+        fingerprint = _lxd_client().images.get_by_alias(alias).fingerprint
+    except (OSError, pylxd.exceptions.LXDAPIException) as err:
+        hookenv.log('cannot retrieve image {}: {}'.format(alias, err))
+        return None
+    current = _recorded_fingerprint(path)
+    if current is None:
+        current = _file_sha256(path)
+        _record_fingerprint(path, current)
+    if current != fingerprint:
+        hookenv.log('{} is not the source of image {}'.format(path, alias))
+        return None
+    return fingerprint
+
+
+def _apply_delta_resource(name, path, checksum):
+    """Update the file at the given path with the delta resource with the given
+    name, which is expected to be in the VCDIFF format produced by xdelta3.
+
+    If a checksum is provided, it is used to verify the resulting file.
+    Return whether the file has been updated.
+    """
+    delta = hookenv.resource_get(name)
+    if not delta or not os.path.getsize(delta):
+        hookenv.log('delta resource {!r} not available'.format(name))
+        return False
+    target = path + '.new'
+    try:
+        call(XDELTA3, '-d', '-f', '-s', path, delta, target)
+        if checksum is not None and _file_sha256(target) != checksum:
+            raise OSError('{} does not match the published checksum {}'.format(
+                target, checksum))
+    except OSError as err:
+        hookenv.log('cannot apply delta resource {!r}: {}'.format(name, err))
+        if os.path.exists(target):
+            os.remove(target)
+        return False
+    os.rename(target, path)
+    hookenv.log('resource {!r} applied to {!r}'.format(name, path))
+    return True
+
+
+def _file_sha256(path):
+    """Return the SHA256 digest of the file at the given path."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 def install_service():
-    """Installs the jujushell systemd service."""
+    """Installs the jujushell systemd service.
+
+    The systemd unit is only replaced, enabled and reloaded if its content
+    changed. Return whether the unit changed.
+    """
+    from charmhelpers.core import templating
     # Render the jujushell systemd service module.
     hookenv.status_set('maintenance', 'creating systemd module')
-    templating.render(
-        'jujushell.service', '/usr/lib/systemd/user/jujushell.service', {
-            'jujushell': jujushell_path(),
-            'jujushell_config': config_path(),
-        }, perms=775)
+    cfg = hookenv.config()
+    reserved, _ = cpu_layout(cfg, numa_nodes())
+    context = service_limits(cfg)
+    context.update({
+        'cpu_affinity': ' '.join(map(str, reserved)),
+        'jujushell': jujushell_path(),
+        'jujushell_config': config_path(),
+    })
+    content = templating.render('jujushell.service', None, context)
+    changed = _write_file(service_path(), content.encode('utf-8'))
     # Build the configuration file for jujushell.
     hookenv.log('building jujushell config.yaml after installing service')
-    build_config(hookenv.config())
-    # Enable the jujushell module.
-    hookenv.status_set('maintenance', 'enabling systemd module')
-    call('systemctl', 'enable', '/usr/lib/systemd/user/jujushell.service')
-    call('systemctl', 'daemon-reload')
+    build_config(cfg)
+    if changed:
+        # Enable the jujushell module.
+        hookenv.status_set('maintenance', 'enabling systemd module')
+        call('systemctl', 'enable', service_path())
+        call('systemctl', 'daemon-reload')
     set_flag('jujushell.service.installed')
     hookenv.status_set('maintenance', 'jujushell installed')
+    return changed
+
+
+def service_path():
+    """Get the location for the jujushell systemd unit."""
+    return '/usr/lib/systemd/user/jujushell.service'
+
+
+def service_limits(cfg):
+    """Return the resource controls for the jujushell systemd unit.
+
+    Controls are returned as a dict mapping template variables to values.
+    Controls whose options are not set are not included, so that the systemd
+    defaults are used.
+    """
+    limits = {
+        'restart_delay': max(cfg.get('service-restart-delay') or 0, 1),
+    }
+    for key, option in (
+            ('cpu_quota', 'service-cpu-quota'),
+            ('memory_high', 'service-memory-high'),
+            ('tasks_max', 'service-tasks-max')):
+        value = _get_string(cfg, option)
+        if value:
+            limits[key] = value
+    for key, option in (
+            ('cpu_weight', 'service-cpu-weight'),
+            ('limit_nofile', 'service-limit-nofile'),
+            ('nice', 'service-nice'),
+            ('watchdog', 'service-watchdog')):
+        value = cfg.get(option) or 0
+        if value:
+            limits[key] = value
+    return limits
+
+
+def import_lxd_images(images):
+    """Import the given images into lxd concurrently.
+
+    Images are provided as a sequence of (name, path) tuples. Flags are set for
+    all images successfully imported. If any import fails, the first error is
+    raised once all imports have completed.
+    """
+    with futures.ThreadPoolExecutor(max_workers=max(len(images), 1)) as pool:
+        jobs = [pool.submit(_import_lxd_image, name, path)
+                for name, path in images]
+    errors = []
+    for (name, _), job in zip(images, jobs):
+        try:
+            job.result()
+        except Exception as err:
+            hookenv.log('cannot import image {}: {}'.format(name, err))
+            errors.append(err)
+            continue
+        set_flag('jujushell.lxd.image.imported.{}'.format(name))
+    if errors:
+        raise errors[0]
 
 
 def import_lxd_image(name, path):
     """Import the image with the given name from the given path into lxd."""
+    _import_lxd_image(name, path)
+    set_flag('jujushell.lxd.image.imported.{}'.format(name))
+
+
+def _import_lxd_image(name, path):
+    """Import the image and make the given alias refer to it.
+
+    This function does not set flags, and it is therefore safe to call it from
+    threads other than the main one.
+    """
+    client = _lxd_client()
+    checksum = read_checksum(path)
+    if (checksum is not None and checksum == _recorded_fingerprint(path) and
+            _image_has_alias(client, checksum, name)):
+        # The fast path: the image is already in place, and it is not even
+        # required to read its content. This is only done if the checksum has
+        # been verified against this very file, as the published checksum may
+        # be stale, for instance if only the image resource has been updated.
+        hookenv.log('image {} already exists with alias {}'.format(
+            checksum, name))
+        return
+
     # Load the whole file into memory as this is necessary when creating the
     # image.
     with open(path, 'rb') as f:
         data = f.read()
-    h = hashlib.sha256()
-    h.update(data)
-    fingerprint = h.hexdigest()
-    hookenv.log('{} has fingerprint {}'.format(path, fingerprint))
+    with futures.ThreadPoolExecutor(max_workers=1) as pool:
+        # When a checksum has been published, the fingerprint is already known
+        # and hashing the data is only required to verify it, so it can be
+        # done in the background.
+        digest = pool.submit(lambda: hashlib.sha256(data).hexdigest())
+        fingerprint = checksum or digest.result()
+        hookenv.log('{} has fingerprint {}'.format(path, fingerprint))
 
-    client = _lxd_client()
-    image = None
-    alias = None
-    for img in client.images.all():
+        images = client.images.all()
+        image, alias = _find_image(images, fingerprint, name)
+        if (image is not None and checksum is not None and
+                digest.result() != checksum):
+            # The published checksum refers to an existing image, likely a
+            # previous revision of the resource: use the actual fingerprint,
+            # so that the new image is imported and the alias moved to it.
+            fingerprint = digest.result()
+            hookenv.log('ignoring stale checksum {} for {}'.format(
+                checksum, path))
+            image, alias = _find_image(images, fingerprint, name)
+        if image is None:
+            hookenv.status_set('maintenance',
+                               'importing image {}'.format(fingerprint))
+            image = client.images.create(data, wait=True)
+            if digest.result() != fingerprint:
+                image.delete(wait=True)
+                msg = '{} does not match the published checksum {}'.format(
+                    path, fingerprint)
+                hookenv.log(msg)
+                raise OSError(msg)
+    if alias is None:
+        image.add_alias(name, '')
+    elif alias.fingerprint != fingerprint:
+        alias.delete_alias(name)
+        image.add_alias(name, '')
+    _record_fingerprint(path, fingerprint)
+
+
+def _find_image(images, fingerprint, name):
+    """Return the image with the given fingerprint and the image referred to
+    by the given alias, among the given images.
+
+    None is returned for images which are not found.
+    """
+    image = alias = None
+    for img in images:
         if img.fingerprint == fingerprint:
             hookenv.log('image {} already exists'.format(fingerprint))
             image = img
         for al in img.aliases:
             if al.get('name') == name:
                 hookenv.log('alias {} currently refers to image {}'.format(
-                    name,
-                    img.fingerprint))
+                    name, img.fingerprint))
                 alias = img
-    if image is None:
-        hookenv.status_set('maintenance',
-                           'importing image {}'.format(fingerprint))
-        image = client.images.create(data, wait=True)
-    if alias is None:
-        image.add_alias(name, '')
-    elif alias.fingerprint != fingerprint:
-        alias.delete_alias(name)
-        image.add_alias(name, '')
-    set_flag('jujushell.lxd.image.imported.{}'.format(name))
+    return image, alias
+
+
+def _recorded_fingerprint(path):
+    """Return the fingerprint recorded for the file at the given path.
+
+    Return None if no fingerprint has been recorded, or if the file changed
+    since then.
+    """
+    try:
+        info = os.stat(path)
+        with open(path + '.fingerprint') as f:
+            size, mtime, fingerprint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if [size, mtime] != [info.st_size, info.st_mtime_ns]:
+        return None
+    return fingerprint
+
+
+def _record_fingerprint(path, fingerprint):
+    """Record the verified fingerprint of the file at the given path."""
+    info = os.stat(path)
+    with open(path + '.fingerprint', 'w') as f:
+        json.dump([info.st_size, info.st_mtime_ns, fingerprint], f)
+
+
+def _image_has_alias(client, fingerprint, name):
+    """Report whether the image with the given fingerprint has the given alias.
+
+    Only a single LXD API call is made.
+    """
+    import pylxd  # Imported here because pylxd is not immediately available.
+    try:
+        image = client.images.get(fingerprint)
+    except pylxd.exceptions.NotFound:
+        return False
+    return any(al.get('name') == name for al in image.aliases)
+
+
+def checksum_path(path):
+    """Get the location for the published checksum of the given file."""
+    return path + '.sha256'
+
+
+def read_checksum(path):
+    """Return the published SHA256 checksum for the file at the given path.
+
+    The checksum is read from a sidecar file in the format used by sha256sum.
+    Return None if no checksum has been published for the file.
+    Raise a ValueError if the checksum is not valid.
+    """
+    try:
+        with open(checksum_path(path)) as f:
+            content = f.read().split()
+    except FileNotFoundError:
+        return None
+    if not content:
+        return None
+    checksum = content[0].lower()
+    if len(checksum) != 64 or set(checksum) - set('0123456789abcdef'):
+        raise ValueError('invalid checksum for {}: {!r}'.format(
+            path, content[0]))
+    return checksum
 
 
 def _lxd_client():
@@ -284,59 +993,300 @@ def _lxd_socket():
     raise IOError('cannot find LXD socket')
 
 
-def setup_lxd():
+def setup_lxd(cfg):
     """Configure LXD."""
     # When running LXD commands, use a working directory that's surely
     # available also from the perspective of confined LXD.
-    cwd = '/'
-    client = _lxd_client()
-    initialized = False
-    for net in client.networks.all():
-        if net.name == 'jujushellbr0':
-            initialized = True
-            break
-    if not initialized:
-        call(_LXD_INIT_COMMAND, shell=True, cwd=cwd)
-    call(_LXD_WAIT_COMMAND, shell=True, cwd=cwd)
+    call(_LXD_WAIT_COMMAND, shell=True, cwd='/')
+    reconcile_lxd(cfg)
+    update_lxd_storage(cfg)
     set_flag('jujushell.lxd.configured')
 
 
-# Define the command used to initialize LXD.
-_LXD_INIT_COMMAND = """
-cat <<EOF | {lxd} init --preseed
-networks:
-- name: jujushellbr0
-  type: bridge
-  config:
-    ipv4.address: auto
-    ipv6.address: none
-storage_pools:
-- name: jujushellstorage
-  driver: zfs
-profiles:
-- name: {termserver}
-  devices:
-    root:
-      path: /
-      pool: jujushellstorage
-      type: disk
-    eth0:
-      name: eth0
-      nictype: bridged
-      parent: jujushellbr0
-      type: nic
-- name: {termserver_limited}
-  config:
-    user.user-data: |
-      #cloud-config
-      users:
-      - name: ubuntu
-        shell: /bin/bash
-EOF
-""".format(
-    lxd=LXD,
-    termserver=PROFILE_TERMSERVER,
-    termserver_limited=PROFILE_TERMSERVER_LIMITED)
+def reconcile_lxd(cfg):
+    """Make LXD networks, storage pools and profiles match the desired state.
+
+    The current state is retrieved with a single API call for each kind of
+    object, and only differences are applied, so that this is cheap enough to
+    be called on every update-status hook. Keys not included in the desired
+    state, like resource limits, are left untouched.
+
+    Return the applied changes as a sequence of (action, kind, name) tuples.
+    """
+    client = _lxd_client()
+    changes = []
+    for kind, objects in _lxd_desired_state(cfg):
+        collection = client.api[kind]
+        response = collection.get(params={'recursion': 1})
+        current = {obj['name']: obj for obj in response.json()['metadata']}
+        for obj in objects:
+            name = obj['name']
+            if name not in current:
+                hookenv.log('creating LXD {} {}'.format(kind, name))
+                collection.post(json=_lxd_strip(obj))
+                changes.append(('create', kind, name))
+                continue
+            diff = _lxd_diff(current[name], obj)
+            if not diff:
+                continue
+            hookenv.log('updating LXD {} {}: {}'.format(kind, name, diff))
+            if None in diff.get('devices', {}).values():
+                # Devices cannot be removed by patching.
+                collection[name].put(json=_lxd_merge(current[name], diff))
+            else:
+                collection[name].patch(json=diff)
+            changes.append(('update', kind, name))
+    return tuple(changes)
+
+
+def _lxd_diff(current, desired):
+    """Return the changes required for the current LXD object to match the
+    desired one, suitable for a PATCH request.
+
+    Return an empty dict if the object does not need to be updated.
+    """
+    diff = {}
+    current_config = current.get('config') or {}
+    config = {
+        key: value for key, value in desired.get('config', {}).items()
+        if not _lxd_create_only(key, value) and
+        current_config.get(key, '') != value
+    }
+    if config:
+        diff['config'] = config
+    current_devices = current.get('devices') or {}
+    devices = {}
+    for name, device in desired.get('devices', {}).items():
+        current_device = current_devices.get(name)
+        if device is None:
+            # The device must not exist.
+            if current_device is not None:
+                devices[name] = None
+            continue
+        current_device = current_device or {}
+        if any(current_device.get(k, '') != v for k, v in device.items()):
+            # Devices are replaced as a whole when patching. Empty values are
+            # used to unset keys.
+            devices[name] = {
+                k: v for k, v in dict(current_device, **device).items() if v}
+    if devices:
+        diff['devices'] = devices
+    return diff
+
+
+def _lxd_merge(current, diff):
+    """Apply the given diff to the current LXD object.
+
+    Return the resulting object, suitable for a PUT request.
+    """
+    config = dict(current.get('config') or {}, **diff.get('config', {}))
+    devices = dict(current.get('devices') or {}, **diff.get('devices', {}))
+    return {
+        'config': {k: v for k, v in config.items() if v},
+        'description': current.get('description', ''),
+        'devices': {k: v for k, v in devices.items() if v is not None},
+    }
+
+
+def _lxd_strip(obj):
+    """Return a copy of the given desired LXD object without empty values.
+
+    Empty values are used in the desired state to unset keys, and therefore
+    they must not be included when creating objects.
+    """
+    obj = dict(obj)
+    if 'config' in obj:
+        obj['config'] = {k: v for k, v in obj['config'].items() if v}
+    if 'devices' in obj:
+        obj['devices'] = {
+            name: {k: v for k, v in device.items() if v}
+            for name, device in obj['devices'].items() if device is not None
+        }
+    return obj
+
+
+def _lxd_create_only(key, value):
+    """Report whether the given configuration key and value must only be used
+    when creating LXD objects.
+    """
+    return key in ('size', 'source') or value == 'auto'
+
+
+def _lxd_desired_state(cfg):
+    """Return the desired LXD objects as a sequence of (kind, objects) tuples.
+
+    Objects are expressed as in the LXD API, and they are returned in the order
+    in which they must be created. Devices set to None must not exist.
+    """
+    cache_size = _get_string(cfg, 'cache-volume-size')
+
+    def devices():
+        # Return the devices of the full and limited termserver profiles.
+        return dict(_termserver_devices(), cache={
+            'path': CACHE_PATH,
+            'pool': STORAGE_POOL,
+            'readonly': 'true',
+            'source': CACHE_VOLUME,
+            'type': 'disk',
+        } if cache_size else None)
+    return (
+        ('networks', [{
+            'name': NETWORK_BRIDGE,
+            'type': 'bridge',
+            'config': _lxd_bridge_config(cfg),
+        }]),
+        ('storage-pools', [{
+            'name': STORAGE_POOL,
+            'driver': 'zfs',
+            'config': _lxd_storage_config(cfg),
+        }]),
+        ('storage-pools/{}/volumes/custom'.format(STORAGE_POOL), [{
+            'name': CACHE_VOLUME,
+            'config': {'size': cache_size},
+        }] if cache_size else []),
+        ('profiles', [{
+            'name': PROFILE_TERMSERVER,
+            'config': {},
+            'devices': devices(),
+        }, {
+            'name': PROFILE_TERMSERVER_LIMITED,
+            'config': {
+                'user.user-data': _LIMITED_USER_DATA,
+            },
+            'devices': {},
+        }, {
+            'name': PROFILE_LIMITED_TERMSERVER,
+            'config': {},
+            'devices': devices(),
+        }]),
+    )
+
+
+def populate_cache_volume(cfg):
+    """Populate the shared cache volume mounted by termserver containers.
+
+    The "cache-populate-command" is run in a temporary container created from
+    the termserver image, with the cache volume mounted read-write at the same
+    path used by termserver containers.
+    """
+    command = _get_string(cfg, 'cache-populate-command')
+    if not (_get_string(cfg, 'cache-volume-size') and command):
+        return
+    hookenv.status_set('maintenance', 'populating the cache volume')
+    # Remove leftovers from previous failures.
+    exterminate_containers(name=_CACHE_BUILDER)
+    client = _lxd_client()
+    devices = _termserver_devices()
+    devices['cache'] = {
+        'path': CACHE_PATH,
+        'pool': STORAGE_POOL,
+        'source': CACHE_VOLUME,
+        'type': 'disk',
+    }
+    container = client.containers.create({
+        'name': _CACHE_BUILDER,
+        'source': {'type': 'image', 'alias': IMAGE_NAME},
+        'profiles': [],
+        'devices': devices,
+    }, wait=True)
+    try:
+        container.start(wait=True)
+        call(LXC, 'exec', _CACHE_BUILDER, '--', 'sh', '-c', command)
+    finally:
+        if container.status.lower() == 'running':
+            container.stop(wait=True)
+        container.delete(wait=True)
+
+
+# Define the name of the container used to populate the cache volume.
+_CACHE_BUILDER = 'jujushell-cache-builder'
+
+
+def _termserver_devices():
+    """Return the devices used by termserver containers."""
+    return {
+        'root': {
+            'path': '/',
+            'pool': STORAGE_POOL,
+            'type': 'disk',
+        },
+        'eth0': {
+            'name': 'eth0',
+            'nictype': 'bridged',
+            'parent': NETWORK_BRIDGE,
+            'type': 'nic',
+        },
+    }
+
+
+def _lxd_bridge_config(cfg):
+    """Return the LXD bridge network configuration from the charm config.
+
+    Raise a ValueError if the bridge address or DHCP range are not valid.
+    """
+    address = _get_string(cfg, 'lxd-bridge-ipv4-address') or 'auto'
+    mtu = cfg.get('lxd-bridge-mtu') or 0
+    config = {
+        'bridge.mtu': str(mtu) if mtu > 0 else '',
+        'ipv4.address': address,
+        'ipv4.dhcp.ranges': '',
+        'ipv6.address': 'none',
+    }
+    size = cfg.get('lxd-bridge-dhcp-range-size') or 0
+    if size > 0 and address != 'auto':
+        config['ipv4.dhcp.ranges'] = _dhcp_range(address, size)
+    return config
+
+
+def _dhcp_range(address, size):
+    """Return a DHCP range with the given size in the given bridge subnet.
+
+    The range starts right after the bridge address, and it is truncated if
+    the subnet is too small.
+    """
+    interface = ipaddress.IPv4Interface(address)
+    start = interface.ip + 1
+    last = interface.network.broadcast_address - 1
+    if start > last:
+        raise ValueError('no room for DHCP in {}'.format(address))
+    end = start + min(size - 1, int(last) - int(start))
+    return '{}-{}'.format(start, end)
+
+
+_LIMITED_USER_DATA = """#cloud-config
+users:
+- name: ubuntu
+  shell: /bin/bash
+"""
+
+
+def update_lxd_storage(cfg):
+    """Update the storage pool properties not managed by LXD."""
+    compression = _get_string(cfg, 'lxd-storage-compression')
+    if compression:
+        hookenv.status_set('maintenance', 'updating LXD storage')
+        # Compression is a ZFS dataset property. The ZFS pool is named after
+        # the LXD storage pool.
+        call('zfs', 'set', 'compression=' + compression, STORAGE_POOL)
+
+
+def _lxd_storage_config(cfg):
+    """Return the LXD storage pool configuration from the charm config."""
+    config = {
+        'volume.zfs.use_refquota': str(
+            bool(cfg.get('lxd-storage-use-refquota'))).lower(),
+        'zfs.clone_copy': _get_string(cfg, 'lxd-storage-clone-copy') or 'true',
+    }
+    source = _get_string(cfg, 'lxd-storage-source')
+    size = _get_string(cfg, 'lxd-storage-size')
+    if source:
+        config['source'] = source
+    elif size:
+        config['size'] = size
+    return config
+
+
+# Define the command used to wait for LXD to be ready.
 _LXD_WAIT_COMMAND = '{} waitready --timeout=30'.format(LXD)
 
 
@@ -353,20 +1303,942 @@ def exterminate_containers(name=None, only_stopped=False, dry=False):
     client = _lxd_client()
     removed = []
     for container in client.containers.all():
-        if name and (container.name != name):
-            continue
-        is_running = container.status.lower() == 'running'
-        if only_stopped and is_running:
+        if not _should_exterminate(
+                container.name, container.status, name, only_stopped):
             continue
         removed.append(container.name)
         if dry:
             continue
-        if is_running:
+        if container.status.lower() == 'running':
             container.stop(wait=True)
         container.delete()
     return tuple(removed)
 
 
+def _should_exterminate(container_name, status, name, only_stopped):
+    """Report whether the container with the given name and status must be
+    removed when exterminating containers with the given options.
+    """
+    if name and container_name != name:
+        return False
+    return not (only_stopped and status.lower() == 'running')
+
+
+def relaunch_containers(cfg, name=None, concurrency=4, dry=False):
+    """Relaunch user containers on the current termserver image.
+
+    Containers are outdated when they have been created from an image which
+    is no longer referred to by the alias of the termserver variant selected
+    in config, or when their termserver profiles do not match that variant.
+    If the container name is provided, only the container with the given
+    name is relaunched if outdated. Up to the given number of containers are
+    relaunched concurrently. If dry is True, then do not actually relaunch
+    containers. See _relaunch_container for a description of the process.
+
+    Return the names of relaunched containers as a sequence, and a dict
+    mapping the names of containers which could not be relaunched to the
+    corresponding error messages.
+    """
+    import pylxd  # Imported here because pylxd is not immediately available.
+    client = _lxd_client()
+    limited = bool(cfg.get('limit-termserver'))
+    alias = image_name(limited=limited)
+    try:
+        fingerprint = client.images.get_by_alias(alias).fingerprint
+    except pylxd.exceptions.NotFound:
+        hookenv.log('cannot relaunch containers: image {} not found'.format(
+            alias))
+        return (), {}
+    response = client.api.containers.get(params={'recursion': 1})
+    outdated = []
+    for container in response.json()['metadata']:
+        if ((name and container['name'] != name) or
+                container['name'] == _CACHE_BUILDER or
+                container['name'].startswith(_RELAUNCH_PREFIX)):
+            continue
+        current = container.get('profiles') or []
+        profiles = _session_profiles(current, limited)
+        base = container['config'].get('volatile.base_image')
+        if base != fingerprint or profiles != current:
+            outdated.append((container, profiles))
+    if dry:
+        return tuple(sorted(c['name'] for c, _ in outdated)), {}
+    relaunched, failed = [], {}
+    with futures.ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+        jobs = {
+            pool.submit(_relaunch_container, cfg, container, alias, profiles):
+            container['name'] for container, profiles in outdated
+        }
+        for job in futures.as_completed(jobs):
+            try:
+                job.result()
+            except (OSError, pylxd.exceptions.LXDAPIException) as err:
+                hookenv.log('cannot relaunch container {}: {}'.format(
+                    jobs[job], err))
+                failed[jobs[job]] = str(err)
+            else:
+                relaunched.append(jobs[job])
+    return tuple(sorted(relaunched)), failed
+
+
+def _session_profiles(profiles, limited):
+    """Return the given container profiles with the termserver profiles
+    replaced by the ones for the given termserver variant.
+    """
+    termserver = (
+        PROFILE_TERMSERVER, PROFILE_TERMSERVER_LIMITED,
+        PROFILE_LIMITED_TERMSERVER)
+    return [p for p in profiles if p not in termserver] + list(
+        termserver_profiles(limited=limited))
+
+
+def _relaunch_container(cfg, container, alias, profiles):
+    """Relaunch the given container, as returned by the raw LXD API, from the
+    image with the given alias, using the given profiles.
+
+    A snapshot of the container is taken first. If home volumes are enabled
+    and the container does not have one yet, one is created and the home
+    directory is copied into it. The container is then stopped and renamed,
+    and a new container with the same name, user config and devices,
+    including the home volume, is created from the image and started if the
+    original container was running. The original container is removed at the
+    end.
+
+    On failure, the new container is removed, and the original one is renamed
+    back, restored from its snapshot, which is then removed, and started if it
+    was running, before raising the error. This function does not set flags,
+    and it is therefore safe to call it from threads other than the main one.
+    """
+    name = container['name']
+    status = container['status'].lower()
+    snapshot = _RELAUNCH_PREFIX + 'snapshot'
+    client = _lxd_client()
+    old = client.containers.get(name)
+    backup = _RELAUNCH_PREFIX + hashlib.sha256(
+        name.encode('utf-8')).hexdigest()[:12]
+    devices = dict(container.get('devices') or {})
+    hookenv.log('relaunching container {} from image {}'.format(name, alias))
+    old.snapshots.create(snapshot, wait=True)
+    new = None
+    try:
+        if 'home' not in devices and _get_string(cfg, 'home-volume-size'):
+            devices['home'] = _migrate_home(cfg, client, old, status)
+        if old.status.lower() != 'stopped':
+            old.stop(force=True, wait=True)
+        old.rename(backup, wait=True)
+        new = client.containers.create({
+            'name': name,
+            'source': {'type': 'image', 'alias': alias},
+            'profiles': profiles,
+            'config': {
+                key: value for key, value in container['config'].items()
+                if not key.startswith('volatile.')
+            },
+            'devices': devices,
+        }, wait=True)
+        if status == 'running':
+            new.start(wait=True)
+    except Exception:
+        hookenv.log('rolling back container {}'.format(name))
+        if new is not None:
+            if new.status.lower() != 'stopped':
+                new.stop(force=True, wait=True)
+            new.delete(wait=True)
+        if old.name != name:
+            old.rename(name, wait=True)
+        if old.status.lower() != 'stopped':
+            old.stop(force=True, wait=True)
+        old.restore_snapshot(snapshot, wait=True)
+        old.snapshots.get(snapshot).delete(wait=True)
+        if status == 'running':
+            old.start(wait=True)
+        raise
+    old.delete(wait=True)
+
+
+def _migrate_home(cfg, client, container, status):
+    """Copy the home directory of the given container into its home volume.
+
+    The volume is created with the size specified by "home-volume-size" if it
+    does not exist, and temporarily attached to the container, which is
+    started if required. Files already in the volume, for instance left by a
+    previous container of the same user, are preserved. Home volumes must be
+    enabled. Return the home device to be mounted at the home directory.
+    """
+    import pylxd  # Imported here because pylxd is not immediately available.
+    size = _get_string(cfg, 'home-volume-size')
+    path = _get_string(cfg, 'home-volume-path') or '/home/ubuntu'
+    volume = _HOME_VOLUME_PREFIX + container.name
+    collection = client.api['storage-pools/{}/volumes/custom'.format(
+        STORAGE_POOL)]
+    try:
+        collection[volume].get()
+    except pylxd.exceptions.NotFound:
+        hookenv.log('creating home volume {}'.format(volume))
+        collection.post(json={'name': volume, 'config': {'size': size}})
+    client.api.containers[container.name].patch(json={'devices': {
+        'home-migration': {
+            'path': _MIGRATION_PATH,
+            'pool': STORAGE_POOL,
+            'source': volume,
+            'type': 'disk',
+        },
+    }})
+    if status == 'frozen':
+        container.unfreeze(wait=True)
+    elif status != 'running':
+        container.start(wait=True)
+    call(LXC, 'exec', container.name, '--', 'sh', '-c',
+         'cp -an {path}/. {mnt} && chown ubuntu:ubuntu {mnt}'.format(
+             path=pipes.quote(path), mnt=_MIGRATION_PATH))
+    return {
+        'path': path,
+        'pool': STORAGE_POOL,
+        'source': volume,
+        'type': 'disk',
+    }
+
+
+# Define the prefix for names of containers and snapshots used while
+# relaunching containers, and the path where home volumes are mounted while
+# migrating home directories.
+_RELAUNCH_PREFIX = 'jujushell-relaunch-'
+_MIGRATION_PATH = '/mnt/jujushell-home'
+
+
+def reconcile_home_volumes(cfg, now=None):
+    """Provision, attach and garbage collect per-user home volumes.
+
+    Containers are created by the jujushell server, one per user, so volumes
+    are provisioned lazily: stopped containers without a home device get a
+    custom volume named after the container, with the size specified by
+    "home-volume-size", mounted at "home-volume-path". A volume is reused if
+    a container with the same name is created again for the same user.
+    Containers which have already run hold user state and the skeleton files
+    of the image in their home directory, so that is copied into the volume
+    first, as done when relaunching containers. Volumes are never attached to
+    running or frozen containers: use the relaunch-containers action to move
+    those to home volumes. New volumes are owned by root, so they are handed
+    to the ubuntu user the first time their container is seen running.
+
+    The last time each volume has been used is recorded in its configuration,
+    and volumes whose container has been removed are deleted after being idle
+    for "home-volume-expiry" days.
+
+    Return the names of the containers to which a volume has been attached
+    and the names of the removed volumes, as a tuple of two sequences.
+    """
+    import pylxd  # Imported here because pylxd is not immediately available.
+    size = _get_string(cfg, 'home-volume-size')
+    path = _get_string(cfg, 'home-volume-path') or '/home/ubuntu'
+    expiry = (cfg.get('home-volume-expiry') or 0) * 24 * 60 * 60
+    now = int(now or time.time())
+    client = _lxd_client()
+    response = client.api.containers.get(params={'recursion': 1})
+    containers = {c['name']: c for c in response.json()['metadata']}
+    collection = client.api['storage-pools/{}/volumes/custom'.format(
+        STORAGE_POOL)]
+    response = collection.get(params={'recursion': 1})
+    volumes = {
+        v['name']: v for v in response.json()['metadata']
+        if v['name'].startswith(_HOME_VOLUME_PREFIX)
+    }
+    attached = []
+    for name, container in sorted(containers.items()):
+        if not size or name == _CACHE_BUILDER:
+            continue
+        status = container['status'].lower()
+        home = (container.get('devices') or {}).get('home')
+        if home is not None:
+            volume = home.get('source')
+            if status == 'running' and volume in volumes:
+                _own_home_volume(collection, volumes[volume], name, path)
+            continue
+        if status != 'stopped':
+            continue
+        volume = _HOME_VOLUME_PREFIX + name
+        if _parse_timestamp(container.get('last_used_at')):
+            hookenv.log('moving home directory of container {} to {}'.format(
+                name, volume))
+            try:
+                _move_home(cfg, client, container)
+            except (OSError, pylxd.exceptions.LXDAPIException) as err:
+                hookenv.log('cannot move home directory of container {}: '
+                            '{}'.format(name, err))
+                continue
+            volumes.setdefault(volume, {'name': volume, 'config': {}})
+            attached.append(name)
+            continue
+        if volume not in volumes:
+            hookenv.log('creating home volume {}'.format(volume))
+            volumes[volume] = {'name': volume, 'config': {'size': size}}
+            collection.post(json=volumes[volume])
+        hookenv.log('attaching home volume {} to container {}'.format(
+            volume, name))
+        client.api.containers[name].patch(json={'devices': {'home': {
+            'path': path,
+            'pool': STORAGE_POOL,
+            'source': volume,
+            'type': 'disk',
+        }}})
+        attached.append(name)
+    removed = []
+    for volume, obj in sorted(volumes.items()):
+        config = obj.get('config') or {}
+        last_used = int(config.get(_LAST_USED_KEY) or 0)
+        if volume[len(_HOME_VOLUME_PREFIX):] in containers or not last_used:
+            # Only record usage once per hour, to avoid patching volumes on
+            # every hook.
+            if now - last_used >= 60 * 60:
+                collection[volume].patch(json={'config': {
+                    _LAST_USED_KEY: str(now)}})
+            continue
+        if expiry and now - last_used > expiry:
+            hookenv.log('removing idle home volume {}'.format(volume))
+            collection[volume].delete()
+            removed.append(volume)
+    return tuple(attached), tuple(removed)
+
+
+def _move_home(cfg, client, container):
+    """Move the home directory of the given stopped container, as returned
+    by the raw LXD API, to its home volume.
+
+    The container is started to copy its home directory into the volume, see
+    _migrate_home, and stopped again. The volume is then mounted at the home
+    directory, replacing the temporary device used for the copy, which can
+    only be removed by replacing the whole container configuration.
+    """
+    name = container['name']
+    obj = client.containers.get(name)
+    home = _migrate_home(cfg, client, obj, 'stopped')
+    obj.stop(force=True, wait=True)
+    update = {
+        key: container[key] for key in (
+            'architecture', 'config', 'description', 'ephemeral', 'profiles')
+        if key in container
+    }
+    update['devices'] = dict(container.get('devices') or {}, home=home)
+    client.api.containers[name].put(json=update)
+
+
+def _own_home_volume(collection, volume, name, path):
+    """Hand the given home volume, mounted at path in the running container
+    with the given name, to the ubuntu user if not done already.
+
+    Custom volumes are owned by root when first mounted. Failures are logged
+    and the operation is retried by a later call, as containers can be
+    stopped or frozen at any time by the jujushell server.
+    """
+    config = volume.setdefault('config', {})
+    if config.get(_OWNED_KEY):
+        return
+    try:
+        call(LXC, 'exec', name, '--', 'chown', 'ubuntu:ubuntu', path)
+    except OSError as err:
+        hookenv.log('cannot change the owner of home volume {}: {}'.format(
+            volume['name'], err))
+        return
+    collection[volume['name']].patch(json={'config': {_OWNED_KEY: 'true'}})
+    config[_OWNED_KEY] = 'true'
+
+
+# Define the prefix for home volume names, the volume config key used to
+# record when volumes have been last used, and the one used to record that
+# volumes have been handed to the ubuntu user.
+_HOME_VOLUME_PREFIX = 'jujushell-home-'
+_LAST_USED_KEY = 'user.jujushell.last-used'
+_OWNED_KEY = 'user.jujushell.owned'
+
+
+def reap_containers(cfg, now=None):
+    """Enforce the later tiers of the session lifecycle.
+
+    The jujushell server stops or freezes containers when sessions expire,
+    depending on "session-expiry-action". Containers frozen for longer than
+    "frozen-container-timeout" minutes are then stopped, and containers
+    stopped for longer than "stopped-container-timeout" minutes are removed.
+    A zero timeout disables the corresponding tier.
+
+    LXD does not record when containers changed state, so the state and the
+    time it was first seen are recorded in the container config. Containers
+    are stopped without waiting, and they are removed by a later call.
+
+    Return the applied actions as a sequence of (action, name) tuples.
+    """
+    timeouts = {
+        'frozen': (cfg.get('frozen-container-timeout') or 0) * 60,
+        'stopped': (cfg.get('stopped-container-timeout') or 0) * 60,
+    }
+    if not any(timeouts.values()):
+        return ()
+    now = int(now or time.time())
+    client = _lxd_client()
+    response = client.api.containers.get(params={'recursion': 1})
+    actions = []
+    for container in response.json()['metadata']:
+        name, status = container['name'], container['status'].lower()
+        if name == _CACHE_BUILDER or status not in timeouts:
+            continue
+        state, _, since = container['config'].get(
+            _STATE_KEY, '').partition(':')
+        if state != status:
+            client.api.containers[name].patch(json={'config': {
+                _STATE_KEY: '{}:{}'.format(status, now)}})
+            continue
+        timeout = timeouts[status]
+        if not timeout or now - int(since) < timeout:
+            continue
+        if status == 'frozen':
+            hookenv.log('stopping frozen container {}'.format(name))
+            client.api.containers[name].state.put(json={
+                'action': 'stop', 'force': True})
+            actions.append(('stop', name))
+        else:
+            hookenv.log('removing stopped container {}'.format(name))
+            client.api.containers[name].delete()
+            actions.append(('delete', name))
+    return tuple(actions)
+
+
+# Define the container config key used to record container states and when
+# they have been first seen, as "<state>:<timestamp>".
+_STATE_KEY = 'user.jujushell.state-since'
+
+
+def memory_pressure(path='/proc/pressure/memory'):
+    """Return the host memory pressure.
+
+    The pressure is the percentage of time, over the last 10 seconds, in
+    which at least one task was stalled waiting for memory. Return None if
+    the kernel does not provide pressure stall information.
+    """
+    try:
+        with open(path) as f:
+            for line in f:
+                kind, *fields = line.split()
+                if kind == 'some':
+                    values = dict(field.split('=', 1) for field in fields)
+                    return float(values['avg10'])
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+def relieve_memory_pressure(cfg, now=None, path='/proc/pressure/memory'):
+    """Freeze or stop the most idle containers under host memory pressure.
+
+    When the memory pressure read from the given path reaches
+    "memory-pressure-threshold", up to "memory-pressure-batch" running
+    containers are frozen or stopped, depending on "memory-pressure-action".
+    The pressure is an average, so it only decreases some time after acting:
+    containers are therefore handled in small batches on every call, until
+    the pressure falls below the threshold.
+
+    Containers are ranked by their average CPU usage since they have been
+    started, and the ones using more memory are handled first when their
+    usage is the same. The current pressure and the number of containers
+    handled so far are stored for collect-metrics.
+
+    Return the applied actions as a sequence of (action, name) tuples.
+    """
+    threshold = float(cfg.get('memory-pressure-threshold') or 0)
+    pressure = memory_pressure(path)
+    stats = memory_pressure_stats()
+    actions = []
+    if threshold > 0 and pressure is not None and pressure >= threshold:
+        action = _get_string(cfg, 'memory-pressure-action') or 'freeze'
+        if action not in ('freeze', 'stop'):
+            raise ValueError(
+                'invalid memory pressure action: {}'.format(action))
+        batch = max(cfg.get('memory-pressure-batch') or 1, 1)
+        client = _lxd_client()
+        for name in _idle_containers(client, now)[:batch]:
+            hookenv.log('{} container {} under memory pressure ({})'.format(
+                {'freeze': 'freezing', 'stop': 'stopping'}[action], name,
+                pressure))
+            state = {'action': action}
+            if action == 'stop':
+                state['force'] = True
+            client.api.containers[name].state.put(json=state)
+            actions.append((action, name))
+    key = {'freeze': 'frozen', 'stop': 'stopped'}
+    for action, _ in actions:
+        stats[key[action]] += 1
+    stats['pressure'] = pressure or 0
+    _write_file(
+        memory_pressure_stats_path(),
+        json.dumps(stats, sort_keys=True).encode('utf-8'))
+    return tuple(actions)
+
+
+def _idle_containers(client, now=None):
+    """Return the names of running containers, the most idle first."""
+    now = int(now or time.time())
+    response = client.api.containers.get(params={'recursion': 1})
+    ranked = []
+    for container in response.json()['metadata']:
+        name = container['name']
+        if (name == _CACHE_BUILDER or
+                container['status'].lower() != 'running'):
+            continue
+        state = client.api.containers[name].state.get().json()['metadata']
+        started = _parse_timestamp(container.get('last_used_at'))
+        uptime = max(now - started, 1) if started else 1
+        cpu = (state.get('cpu') or {}).get('usage', 0) / uptime
+        memory = (state.get('memory') or {}).get('usage', 0)
+        ranked.append((cpu, -memory, name))
+    return [name for _, _, name in sorted(ranked)]
+
+
+def running_status(actions=(), cluster=None):
+    """Return the unit status message for a running service.
+
+    The message reports the containers handled in the given memory pressure
+    actions, as returned by relieve_memory_pressure. If the capacity of the
+    units in the cluster is provided, as returned by cluster_capacity, and it
+    includes more than one unit, the free container slots in the cluster are
+    reported too.
+    """
+    message = 'jujushell running'
+    if actions:
+        counts = {}
+        for action, _ in actions:
+            counts[action] = counts.get(action, 0) + 1
+        # Frozen containers are not stopped, so they are reported apart.
+        handled = ', '.join(
+            '{} container{} {}'.format(
+                counts[action], '' if counts[action] == 1 else 's', state)
+            for action, state in (('freeze', 'frozen'), ('stop', 'stopped'))
+            if action in counts)
+        message += ' (memory pressure: {})'.format(handled)
+    if cluster and len(cluster) > 1:
+        message += ', cluster: {} free slots on {} units'.format(
+            sum(c['free-slots'] for c in cluster.values()), len(cluster))
+    return message
+
+
+def memory_pressure_stats_path():
+    """Get the location for the memory pressure statistics."""
+    return os.path.join(hookenv.charm_dir(), 'files', 'memory-pressure.json')
+
+
+def memory_pressure_stats():
+    """Return the memory pressure statistics stored by the charm.
+
+    Statistics are returned as a dict with the last seen memory pressure and
+    the number of containers frozen and stopped to relieve it.
+    """
+    stats = {'frozen': 0, 'pressure': 0, 'stopped': 0}
+    try:
+        with open(memory_pressure_stats_path()) as f:
+            stats.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+    return stats
+
+
+def memory_pressure_metrics():
+    """Return the memory pressure statistics as Juju metrics.
+
+    Metrics are returned as a dict mapping metric names, as defined in
+    metrics.yaml, to their values.
+    """
+    stats = memory_pressure_stats()
+    return {
+        'memory_pressure': stats['pressure'],
+        'memory_pressure_frozen_containers': stats['frozen'],
+        'memory_pressure_stopped_containers': stats['stopped'],
+    }
+
+
+def unit_capacity(cfg, containers=None):
+    """Return the container capacity of this unit.
+
+    The capacity is returned as a dict with the number of existing containers,
+    the maximum number of containers and the number of free container slots.
+    If "max-containers" is not set, the maximum is derived from the host
+    memory and the memory quota for containers of the termserver variant in
+    use. LXD is only queried if the number of existing containers is not
+    provided.
+    """
+    if containers is None:
+        client = _lxd_client()
+        containers = len(client.api.containers.get().json()['metadata'])
+    maximum = cfg.get('max-containers') or 0
+    if maximum <= 0:
+        limited = cfg.get('limit-termserver')
+        prefix = 'limited-lxc-quota-' if limited else 'lxc-quota-'
+        quota = parse_size(_get_string(cfg, prefix + 'ram') or '256MB')
+        maximum = _host_memory() // quota
+    return {
+        'containers': containers,
+        'free-slots': max(maximum - containers, 0),
+        'max-containers': maximum,
+    }
+
+
+def publish_capacity(cfg, containers=None):
+    """Publish the unit capacity on the peer and website relations.
+
+    On the website relation, the capacity is used to weight this unit in a
+    haproxy compatible service definition. See unit_capacity for a
+    description of the arguments. Return the capacity.
+    """
+    capacity = unit_capacity(cfg, containers=containers)
+    address = hookenv.unit_private_ip()
+    port = get_ports(cfg)[0]
+    data = {key: str(value) for key, value in capacity.items()}
+    data.update({'address': address, 'port': str(port)})
+    for relation_id in hookenv.relation_ids('cluster'):
+        hookenv.relation_set(relation_id=relation_id, relation_settings=data)
+    services = website_services(address, port, capacity)
+    for relation_id in hookenv.relation_ids('website'):
+        hookenv.relation_set(
+            relation_id=relation_id, relation_settings={'services': services})
+    return capacity
+
+
+def website_services(address, port, capacity):
+    """Return the haproxy services definition for this unit as YAML.
+
+    Sessions are bound to containers living in a specific unit, so clients are
+    balanced with a consistent hash of their source address, and kept on the
+    same unit when they reconnect. Units are weighted by their free container
+    slots, and units without free slots only receive reconnecting clients.
+    """
+    unit = hookenv.local_unit().replace('/', '-')
+    weight = min(capacity['free-slots'], 256)
+    return yaml.safe_dump([{
+        'service_name': 'jujushell',
+        'service_host': '0.0.0.0',
+        'service_port': port,
+        'service_options': [
+            'balance source',
+            'hash-type consistent',
+            'stick-table type ip size 200k expire 12h',
+            'stick on src',
+            'timeout tunnel 1h',
+        ],
+        'servers': [
+            [unit, address, port, 'check weight {}'.format(weight)],
+        ],
+    }])
+
+
+def cluster_capacity():
+    """Return the capacity published by peer units.
+
+    The capacity is returned as a dict mapping unit names to dicts including
+    the address, port, number of containers and free container slots.
+    """
+    capacity = {}
+    for relation_id in hookenv.relation_ids('cluster'):
+        for unit in hookenv.related_units(relation_id):
+            data = hookenv.relation_get(unit=unit, rid=relation_id) or {}
+            if 'free-slots' not in data:
+                continue
+            capacity[unit] = {
+                'address': data.get('address'),
+                'containers': int(data['containers']),
+                'free-slots': int(data['free-slots']),
+                'max-containers': int(data['max-containers']),
+                'port': int(data['port']),
+            }
+    return capacity
+
+
+def container_inventory():
+    """Return a summary of the containers existing in the unit.
+
+    Containers are returned as a sequence of dicts including the container
+    name and status, and the creation and last usage times as Unix timestamps.
+    A single LXD API call is made.
+    """
+    client = _lxd_client()
+    response = client.api.containers.get(params={'recursion': 1})
+    return tuple({
+        'name': container['name'],
+        'status': container['status'],
+        'created': _parse_timestamp(container.get('created_at')),
+        'last-used': _parse_timestamp(container.get('last_used_at')),
+    } for container in response.json()['metadata'])
+
+
+def publish_inventory(inventory=None):
+    """Publish the unit container inventory on the peer relation.
+
+    The inventory is encoded as a compact JSON list of
+    [name, status, created, last-used] lists. If the inventory is not
+    provided, it is retrieved from LXD. Return the inventory.
+    """
+    if inventory is None:
+        inventory = container_inventory()
+    data = json.dumps([
+        [c['name'], c['status'], c['created'], c['last-used']]
+        for c in inventory
+    ], separators=(',', ':'))
+    for relation_id in hookenv.relation_ids('cluster'):
+        hookenv.relation_set(
+            relation_id=relation_id, relation_settings={'inventory': data})
+    return inventory
+
+
+def inventory_snapshot_path():
+    """Get the location for the inventory snapshot."""
+    return os.path.join(hookenv.charm_dir(), 'files', 'inventory.json')
+
+
+def refresh_inventory_snapshot(cfg, now=None):
+    """Take a snapshot of the LXD objects in the unit and store it.
+
+    The snapshot is a dict including the container inventory, as returned by
+    container_inventory, the number of containers in each state, the number
+    of images and the space used in the storage pool in bytes, or None if
+    not available. It also includes when it has been taken and when it
+    expires, after "inventory-ttl" seconds, as Unix timestamps. Three LXD API
+    calls are made. Return the snapshot.
+    """
+    import pylxd  # Imported here because pylxd is not immediately available.
+    now = int(now or time.time())
+    containers = container_inventory()
+    states = {}
+    for container in containers:
+        status = container['status'].lower()
+        states[status] = states.get(status, 0) + 1
+    client = _lxd_client()
+    try:
+        response = client.api['storage-pools'][STORAGE_POOL].resources.get()
+    except pylxd.exceptions.NotFound:
+        space = {}
+    else:
+        space = response.json()['metadata'].get('space') or {}
+    snapshot = {
+        'containers': containers,
+        'disk-total': space.get('total'),
+        'disk-used': space.get('used'),
+        'expires': now + (cfg.get('inventory-ttl') or 0),
+        'images': len(client.images.all()),
+        'states': states,
+        'updated': now,
+    }
+    _write_file(
+        inventory_snapshot_path(),
+        json.dumps(snapshot, sort_keys=True).encode('utf-8'))
+    return snapshot
+
+
+def inventory_snapshot(now=None):
+    """Return the stored inventory snapshot, without querying LXD.
+
+    See refresh_inventory_snapshot for a description of the snapshot. Return
+    None if there is no snapshot or if it expired.
+    """
+    now = int(now or time.time())
+    try:
+        with open(inventory_snapshot_path()) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if snapshot['expires'] < now:
+        return None
+    snapshot['containers'] = tuple(snapshot['containers'])
+    return snapshot
+
+
+def inventory_metrics(now=None):
+    """Return the stored inventory snapshot as Juju metrics.
+
+    Metrics are returned as a dict mapping metric names, as defined in
+    metrics.yaml, to their values. The dict is empty if there is no valid
+    snapshot.
+    """
+    snapshot = inventory_snapshot(now=now)
+    if snapshot is None:
+        return {}
+    metrics = {
+        'inventory_{}_containers'.format(status): snapshot['states'].get(
+            status, 0)
+        for status in ('running', 'frozen', 'stopped')
+    }
+    metrics['inventory_images'] = snapshot['images']
+    if snapshot['disk-used'] is not None:
+        metrics['inventory_disk_used'] = snapshot['disk-used']
+    return metrics
+
+
+def cluster_inventory():
+    """Return the container inventories published by peer units.
+
+    The inventories are returned as a dict mapping unit names to sequences of
+    containers, as returned by container_inventory.
+    """
+    inventories = {}
+    for relation_id in hookenv.relation_ids('cluster'):
+        for unit in hookenv.related_units(relation_id):
+            data = hookenv.relation_get(
+                attribute='inventory', unit=unit, rid=relation_id)
+            if not data:
+                continue
+            inventories[unit] = tuple({
+                'name': name,
+                'status': status,
+                'created': created,
+                'last-used': last_used,
+            } for name, status, created, last_used in json.loads(data))
+    return inventories
+
+
+def request_cluster_exterminate(name=None, only_stopped=False, dry=False):
+    """Remove containers across all units in the cluster.
+
+    This must be called from the leader unit. The request is broadcast to all
+    units through leader settings, so that each unit removes its own
+    containers concurrently, selecting them from its live LXD state. Requests
+    expire after ten minutes, so that units joining later ignore them. The
+    request is handled immediately by the local unit. See
+    exterminate_containers for a description of the arguments.
+
+    Return the request id and the names of the containers removed from the
+    local unit. Results from all units can be retrieved later by calling
+    cluster_exterminate_results.
+    """
+    request = json.dumps({
+        'id': uuid.uuid4().hex,
+        'name': name,
+        'only-stopped': only_stopped,
+        'dry': dry,
+        'expires': int(time.time()) + _EXTERMINATE_REQUEST_TTL,
+    })
+    hookenv.leader_set({'exterminate-request': request})
+    return json.loads(request)['id'], handle_exterminate_request(request)
+
+
+def handle_exterminate_request(request):
+    """Remove local containers as requested by the leader.
+
+    The request is provided as JSON, as set by request_cluster_exterminate.
+    Requests are only handled once, and only if not expired. The result,
+    including the names of the removed containers or the error preventing
+    their removal, is stored in the unit data and published on the peer
+    relation, so that the leader can report what each unit actually did.
+    Return the names of removed containers.
+    """
+    if not request:
+        return ()
+    import pylxd  # Imported here because pylxd is not immediately available.
+    from charmhelpers.core import unitdata
+    request = json.loads(request)
+    kv = unitdata.kv()
+    if kv.get('jujushell.exterminate-request') == request['id']:
+        return ()
+    kv.set('jujushell.exterminate-request', request['id'])
+    if request.get('expires', 0) < time.time():
+        hookenv.log('ignoring expired exterminate request {}'.format(
+            request['id']))
+        return ()
+    result = {'id': request['id']}
+    removed = ()
+    try:
+        removed = exterminate_containers(
+            name=request['name'], only_stopped=request['only-stopped'],
+            dry=request.get('dry', False))
+    except (OSError, pylxd.exceptions.LXDAPIException) as err:
+        hookenv.log('cannot remove containers as requested by the leader: '
+                    '{}'.format(err))
+        result['error'] = str(err)
+    else:
+        hookenv.log('removed containers as requested by the leader: '
+                    '{}'.format(', '.join(removed)))
+        result['removed'] = removed
+    data = json.dumps(result, separators=(',', ':'))
+    kv.set('jujushell.exterminate-result', data)
+    for relation_id in hookenv.relation_ids('cluster'):
+        hookenv.relation_set(
+            relation_id=relation_id,
+            relation_settings={'exterminate-result': data})
+    return removed
+
+
+# Define for how long cluster exterminate requests are valid, in seconds.
+_EXTERMINATE_REQUEST_TTL = 10 * 60
+
+
+def cluster_exterminate_results(request_id):
+    """Return the results of the cluster exterminate request with the given
+    id, as reported by the local unit and its peers.
+
+    Results are returned as a dict mapping unit names to dicts including
+    either the names of the removed containers as "removed", or the error
+    message as "error". Units which have not handled the request yet are
+    mapped to None.
+    """
+    from charmhelpers.core import unitdata
+    results = {
+        hookenv.local_unit(): unitdata.kv().get(
+            'jujushell.exterminate-result'),
+    }
+    for relation_id in hookenv.relation_ids('cluster'):
+        for unit in hookenv.related_units(relation_id):
+            results[unit] = hookenv.relation_get(
+                attribute='exterminate-result', unit=unit, rid=relation_id)
+    for unit, data in results.items():
+        result = json.loads(data) if data else {}
+        if result.get('id') != request_id:
+            results[unit] = None
+            continue
+        result.pop('id')
+        if 'removed' in result:
+            result['removed'] = tuple(result['removed'])
+        results[unit] = result
+    return results
+
+
+def _parse_timestamp(value):
+    """Parse the given LXD timestamp and return it as a Unix timestamp.
+
+    Return 0 if the timestamp is not available.
+    """
+    if not value or value.startswith('0001-01-01'):
+        return 0
+    # LXD timestamps include nanoseconds and a time zone.
+    dt = datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    offset = 0
+    zone = value[19:].lstrip('.0123456789')
+    if zone and zone[0] in '+-':
+        hours, _, minutes = zone[1:].partition(':')
+        offset = (int(hours) * 60 + int(minutes or 0)) * 60
+        if zone[0] == '+':
+            offset = -offset
+    return int(dt.replace(tzinfo=datetime.timezone.utc).timestamp()) + offset
+
+
+def parse_size(value):
+    """Parse the given size using LXD suffixes, and return it in bytes.
+
+    Both decimal (e.g. MB) and binary (e.g. MiB) suffixes are supported.
+    Raise a ValueError if the size is not valid.
+    """
+    value = value.strip()
+    for index, prefix in enumerate('kMGTPE', 1):
+        for suffix, base in ((prefix + 'iB', 1024), (prefix + 'B', 1000)):
+            if value.endswith(suffix):
+                number = value[:-len(suffix)].strip()
+                return int(float(number) * base ** index)
+    if value.endswith('B'):
+        value = value[:-1]
+    return int(value)
+
+
+def _host_memory():
+    """Return the total host memory in bytes."""
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) * 1024
+    raise OSError('cannot find total memory in /proc/meminfo')
+
+
 def service_url(config):
     """Retrieve the jujushell service URL by looking at the given config."""
     schema, host = 'http', 'localhost'
@@ -15,7 +15,9 @@ from charms.reactive import (
     clear_flag,
     set_flag,
     when,
+    when_any,
     when_not,
+    when_not_all,
 )
 
 
@@ -35,10 +37,114 @@ def install():
 def upgrade_charm():
     clear_flag('jujushell.resource.available.jujushell')
     clear_flag('jujushell.resource.available.termserver')
+    clear_flag('jujushell.resource.available.limited-termserver')
     clear_flag('jujushell.lxd.image.imported.termserver')
+    clear_flag('jujushell.lxd.image.imported.termserver-limited')
+    clear_flag('jujushell.acl.fetched')
     set_flag('jujushell.restart')
 
 
+@hook('update-status')
+def update_status():
+    config = hookenv.config()
+    try:
+        jujushell.validate_config(config)
+    except ValueError as err:
+        hookenv.status_set('blocked', 'invalid config: {}'.format(err))
+        return
+    # Every step is run even if previous ones fail, so that a single LXD
+    # error does not prevent the unit from being maintained.
+    failures = []
+    if is_flag_set('jujushell.service.installed'):
+        # Pick up changes not driven by the charm config, like the rotation
+        # of the controller CA certificate. The server only reads its config
+        # when started, and restarting it drops all sessions, so the restart
+        # is left to the next config change or to the restart action when
+        # only harmless options changed, like the ranking of addresses.
+        changed = _run_step(
+            failures, 'build the config', jujushell.build_config, config)
+        if changed and is_flag_set('jujushell.running'):
+            if set(changed).difference(_DEFERRED_OPTIONS):
+                hookenv.log('jujushell config changed: {}'.format(
+                    ', '.join(changed)))
+                set_flag('jujushell.restart')
+            else:
+                hookenv.log('jujushell config changed: restart pending')
+                set_flag('jujushell.restart.pending')
+    actions, cluster = (), None
+    if is_flag_set('jujushell.lxd.configured'):
+        for description, func in (
+                ('reconcile LXD', jujushell.reconcile_lxd),
+                ('place containers', jujushell.place_containers),
+                ('reconcile home volumes', jujushell.reconcile_home_volumes),
+                ('reap containers', jujushell.reap_containers)):
+            _run_step(failures, description, func, config)
+        actions = _run_step(
+            failures, 'relieve memory pressure',
+            jujushell.relieve_memory_pressure, config) or ()
+        snapshot = _run_step(
+            failures, 'refresh the inventory',
+            jujushell.refresh_inventory_snapshot, config)
+        containers = None
+        if snapshot is not None:
+            containers = snapshot['containers']
+        capacity = _run_step(
+            failures, 'publish the capacity', jujushell.publish_capacity,
+            config, containers=None if containers is None else len(containers))
+        if capacity is not None and hookenv.is_leader():
+            # Report the capacity of the whole cluster on the leader.
+            cluster = _run_step(
+                failures, 'read the cluster capacity',
+                jujushell.cluster_capacity)
+            if cluster is not None:
+                cluster[hookenv.local_unit()] = capacity
+        _run_step(
+            failures, 'publish the inventory', jujushell.publish_inventory,
+            containers)
+    if is_flag_set('jujushell.running'):
+        message = jujushell.running_status(actions, cluster=cluster)
+        if is_flag_set('jujushell.restart.pending'):
+            message += ', restart pending to apply config changes'
+        if failures:
+            message += ', failed to {}'.format(', '.join(failures))
+        hookenv.status_set('active', message)
+
+
+# Define the server options whose changes do not require an immediate restart
+# of the service when found by update-status.
+_DEFERRED_OPTIONS = frozenset(['juju-addrs'])
+
+
+def _run_step(failures, description, func, *args, **kwargs):
+    """Call the given function with the given arguments and return its result.
+
+    Errors are logged and the description is added to failures, so that the
+    remaining steps of the hook can still be run. Return None on failure.
+    """
+    try:
+        return func(*args, **kwargs)
+    except Exception as err:
+        hookenv.log('cannot {}: {}'.format(description, err),
+                    level=hookenv.ERROR)
+        failures.append(description)
+
+
+@hook('cluster-relation-joined', 'cluster-relation-changed',
+      'website-relation-joined')
+def publish_unit_data():
+    if is_flag_set('jujushell.lxd.configured'):
+        jujushell.publish_capacity(hookenv.config())
+        jujushell.publish_inventory()
+
+
+@hook('leader-settings-changed')
+def leader_settings_changed():
+    if is_flag_set('jujushell.lxd.configured'):
+        jujushell.handle_exterminate_request(
+            hookenv.leader_get('exterminate-request'))
+        jujushell.publish_inventory()
+
+
 @hook('start')
 def start():
     set_flag('jujushell.start')
@@ -56,6 +162,13 @@ def install_zfsutils():
     apt.queue_install(['zfsutils-linux'])
 
 
+@when('jujushell.install')
+@when_not('apt.installed.xdelta3')
+def install_xdelta3():
+    hookenv.status_set('maintenance', 'installing xdelta3')
+    apt.queue_install(['xdelta3'])
+
+
 @when('jujushell.install')
 @when_not('jujushell.resource.available.jujushell')
 def install_jujushell():
@@ -76,21 +189,35 @@ def install_jujushell():
 def install_termserver():
     hookenv.status_set('maintenance', 'fetching termserver')
     try:
-        # TODO for now, we save both termserver resources. In the future, this
-        # may be streamlined to only save one at a time as needed.
-        jujushell.save_resource(
-            'termserver', jujushell.termserver_path())
-        jujushell.save_resource(
-            'limited-termserver', jujushell.termserver_path(limited=True))
-    except OSError as err:
+        # Both termserver images are saved, so that they can be imported
+        # together and switching between them is instantaneous.
+        jujushell.save_image_resource(
+            'termserver', jujushell.termserver_path(),
+            jujushell.image_name())
+        jujushell.save_image_resource(
+            'limited-termserver', jujushell.termserver_path(limited=True),
+            jujushell.image_name(limited=True))
+    except (OSError, ValueError) as err:
         hookenv.status_set(
             'blocked', 'termserver resource not available: {}'.format(err))
 
 
+@when('jujushell.install')
+@when_not('jujushell.acl.fetched')
+def install_allowed_users():
+    jujushell.save_optional_resource(
+        'allowed-users', jujushell.allowed_users_path())
+    set_flag('jujushell.acl.fetched')
+    if (is_flag_set('jujushell.service.installed') and
+            jujushell.build_config(hookenv.config())):
+        set_flag('jujushell.restart')
+
+
 @when('jujushell.resource.available.jujushell')
 @when_not('jujushell.service.installed')
 def install_service():
-    jujushell.install_service()
+    if jujushell.install_service() and is_flag_set('jujushell.running'):
+        set_flag('jujushell.restart')
 
 
 @when('jujushell.install')
@@ -99,19 +226,51 @@ def install_service():
 def setup_lxd():
     hookenv.status_set('maintenance', 'configuring lxd')
     host.add_user_to_group('ubuntu', 'lxd')
-    jujushell.setup_lxd()
+    jujushell.setup_lxd(hookenv.config())
 
 
 @when('jujushell.lxd.configured')
-@when_not('jujushell.lxd.image.imported.termserver')
+@when_not_all('jujushell.lxd.image.imported.termserver',
+              'jujushell.lxd.image.imported.termserver-limited')
 def import_image():
     hookenv.status_set('maintenance', 'importing termserver images')
-    limited = hookenv.config()['limit-termserver']
-    jujushell.import_lxd_image(
-        'termserver', jujushell.termserver_path(limited=limited))
+    # Both termserver variants are imported, so that switching between them
+    # only requires the jujushell configuration to be updated.
+    images = []
+    for limited in (False, True):
+        name = jujushell.image_name(limited=limited)
+        if not is_flag_set('jujushell.lxd.image.imported.{}'.format(name)):
+            images.append((name, jujushell.termserver_path(limited=limited)))
+    jujushell.import_lxd_images(images)
+    # Refresh the cache volume with the new image.
+    clear_flag('jujushell.cache.populated')
 
 
 @when('jujushell.lxd.image.imported.termserver')
+@when_not('jujushell.cache.populated')
+def populate_cache():
+    try:
+        jujushell.populate_cache_volume(hookenv.config())
+    except OSError as err:
+        # The flag is left unset so that populating the cache is retried.
+        hookenv.status_set(
+            'blocked', 'cannot populate the cache volume: {}'.format(err))
+        return
+    set_flag('jujushell.cache.populated')
+
+
+@when('config.changed.cache-volume-size')
+def cache_volume_size_changed():
+    clear_flag('jujushell.cache.populated')
+
+
+@when('config.changed.cache-populate-command')
+def cache_populate_command_changed():
+    clear_flag('jujushell.cache.populated')
+
+
+@when('jujushell.lxd.image.imported.termserver')
+@when('jujushell.lxd.image.imported.termserver-limited')
 @when('jujushell.resource.available.jujushell')
 @when('jujushell.service.installed')
 @when('jujushell.start')
@@ -121,10 +280,12 @@ def start_service():
     host.service_start('jujushell')
     hookenv.status_set('active', 'jujushell running')
     clear_flag('jujushell.restart')
+    clear_flag('jujushell.restart.pending')
     set_flag('jujushell.running')
 
 
 @when('jujushell.lxd.image.imported.termserver')
+@when('jujushell.lxd.image.imported.termserver-limited')
 @when('jujushell.resource.available.jujushell')
 @when('jujushell.service.installed')
 @when('jujushell.restart')
@@ -133,6 +294,7 @@ def restart_service():
     host.service_restart('jujushell')
     hookenv.status_set('active', 'jujushell running')
     clear_flag('jujushell.restart')
+    clear_flag('jujushell.restart.pending')
 
 
 @when('jujushell.running')
@@ -145,11 +307,34 @@ def stop_service():
 @when('config.changed')
 def config_changed():
     config = hookenv.config()
-    jujushell.build_config(config)
+    try:
+        jujushell.validate_config(config)
+    except ValueError as err:
+        hookenv.status_set('blocked', 'invalid config: {}'.format(err))
+        return
+    changed = jujushell.build_config(config)
     if is_flag_set('jujushell.lxd.configured'):
+        jujushell.reconcile_lxd(config)
         jujushell.update_lxc_quotas(config)
-        clear_flag('jujushell.lxd.image.imported.termserver')
-    set_flag('jujushell.restart')
+        jujushell.update_lxd_storage(config)
+        jujushell.place_containers(config)
+    if changed or is_flag_set('jujushell.restart.pending'):
+        set_flag('jujushell.restart')
+
+
+@when_any('config.changed.jujushell-reserved-cpus',
+          'config.changed.service-limit-nofile',
+          'config.changed.service-tasks-max',
+          'config.changed.service-cpu-weight',
+          'config.changed.service-cpu-quota',
+          'config.changed.service-memory-high',
+          'config.changed.service-nice',
+          'config.changed.service-restart-delay',
+          'config.changed.service-watchdog')
+def service_options_changed():
+    # Render the systemd service again with the new CPU affinity and resource
+    # controls. The service is restarted only if the unit changed.
+    clear_flag('jujushell.service.installed')
 
 
 @when('website.available')
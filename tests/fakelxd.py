@@ -0,0 +1,363 @@
+# Copyright 2017 Canonical Ltd.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+"""A stateful in-process fake of the LXD server, for tests and benchmarks.
+
+The fake implements the subset of the pylxd client used by the charm: image
+and container managers, and the raw API for networks, storage pools, storage
+volumes, profiles and containers. Every API call is recorded, it can be made
+slower by configuring a latency, and container operations can be made to
+fail.
+"""
+
+import hashlib
+import threading
+import time
+
+import pylxd
+
+
+class FakeLXD:
+    """A fake LXD server, providing a pylxd compatible client."""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = []
+        self.objects = {}
+        self.images = {}
+        # Map container names to the state in which operations on them must
+        # fail, or to None if creating them must fail.
+        self.fail = {}
+        self._lock = threading.Lock()
+
+    def client(self):
+        """Return a pylxd compatible client connected to this server."""
+        return _Client(self)
+
+    def add(self, kind, obj):
+        """Add the given object to the given kind of objects.
+
+        The kind is the API path of the collection, like "profiles" or
+        "storage-pools/default/volumes/custom". Return the object.
+        """
+        obj = dict(obj)
+        obj.setdefault('config', {})
+        obj.setdefault('description', '')
+        obj.setdefault('devices', {})
+        self.objects.setdefault(kind, {})[obj['name']] = obj
+        return obj
+
+    def add_container(self, name, status='Running', **kwargs):
+        """Add a container with the given name and status."""
+        kwargs.update(name=name, status=status)
+        kwargs.setdefault('profiles', ['default'])
+        return self.add('containers', kwargs)
+
+    def add_image(self, data, aliases=()):
+        """Add an image with the given content and aliases.
+
+        Return the image fingerprint.
+        """
+        fingerprint = hashlib.sha256(data).hexdigest()
+        self.images[fingerprint] = [{'name': name} for name in aliases]
+        return fingerprint
+
+    def count(self, method=None):
+        """Return the number of API calls, optionally only with the given
+        HTTP method.
+        """
+        return sum(1 for m, _ in self.calls if method in (None, m))
+
+    def request(self, method, path):
+        """Record an API call and wait for the configured latency."""
+        with self._lock:
+            self.calls.append((method, path))
+        if self.latency:
+            time.sleep(self.latency)
+
+    def collection(self, kind):
+        """Return the objects of the given kind as a dict keyed by name."""
+        return self.objects.setdefault(kind, {})
+
+
+class _Response:
+    """A response from the raw API."""
+
+    def __init__(self, metadata, status_code=200):
+        self.status_code = status_code
+        self._metadata = metadata
+
+    def json(self):
+        if self.status_code != 200:
+            return {'type': 'error', 'error': 'not found',
+                    'error_code': self.status_code}
+        return {'type': 'sync', 'metadata': self._metadata}
+
+
+class _APINode:
+    """A node of the raw API, like client.api.profiles["default"]."""
+
+    def __init__(self, lxd, path):
+        self._lxd = lxd
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name.replace('_', '-')]
+
+    def __getitem__(self, name):
+        return _APINode(self._lxd, '/'.join(filter(None, (self._path, name))))
+
+    def _split(self):
+        """Return the collection and name for this node.
+
+        The name is None if the node is a collection.
+        """
+        if self._path.rpartition('/')[2] in _COLLECTIONS:
+            return self._path, None
+        kind, _, name = self._path.rpartition('/')
+        return kind, name
+
+    def get(self, params=None):
+        self._lxd.request('GET', self._path)
+        kind, name = self._split()
+        objects = self._lxd.collection(kind)
+        if name is None:
+            if (params or {}).get('recursion'):
+                return _Response([dict(obj) for obj in objects.values()])
+            return _Response(
+                ['/1.0/{}/{}'.format(kind, name) for name in objects])
+        return _Response(dict(self._object()))
+
+    def post(self, json=None):
+        self._lxd.request('POST', self._path)
+        if json['name'] in self._lxd.collection(self._path):
+            raise pylxd.exceptions.Conflict(_Response(None, 409))
+        self._lxd.add(self._path, json)
+        return _Response({})
+
+    def put(self, json=None):
+        self._lxd.request('PUT', self._path)
+        self._object().update(json)
+        return _Response({})
+
+    def patch(self, json=None):
+        self._lxd.request('PATCH', self._path)
+        obj = self._object()
+        for key, value in json.items():
+            if key in ('config', 'devices'):
+                # Config keys and devices are merged, devices are replaced as
+                # a whole.
+                obj[key] = dict(obj.get(key) or {}, **value)
+            else:
+                obj[key] = value
+        return _Response({})
+
+    def delete(self):
+        self._lxd.request('DELETE', self._path)
+        self._object()
+        kind, name = self._split()
+        del self._lxd.collection(kind)[name]
+        return _Response({})
+
+    def _object(self):
+        """Return the object at this node.
+
+        Raise pylxd.exceptions.NotFound if the object does not exist, as the
+        pylxd raw API does for 404 responses.
+        """
+        kind, name = self._split()
+        obj = self._lxd.collection(kind).get(name)
+        if obj is None:
+            raise pylxd.exceptions.NotFound(_Response(None, 404))
+        return obj
+
+
+# Define the last path segments of API collections.
+_COLLECTIONS = frozenset((
+    'containers', 'custom', 'networks', 'profiles', 'storage-pools'))
+
+
+class _Image:
+    """An image, as returned by the pylxd image manager."""
+
+    def __init__(self, lxd, fingerprint):
+        self._lxd = lxd
+        self.fingerprint = fingerprint
+
+    @property
+    def aliases(self):
+        return list(self._lxd.images[self.fingerprint])
+
+    def add_alias(self, name, description):
+        self._lxd.request('POST', 'images/aliases')
+        self._lxd.images[self.fingerprint].append({'name': name})
+
+    def delete_alias(self, name):
+        self._lxd.request('DELETE', 'images/aliases/' + name)
+        self._lxd.images[self.fingerprint] = [
+            al for al in self._lxd.images[self.fingerprint]
+            if al['name'] != name]
+
+    def delete(self, wait=False):
+        self._lxd.request('DELETE', 'images/' + self.fingerprint)
+        del self._lxd.images[self.fingerprint]
+
+
+class _Images:
+    """The pylxd image manager."""
+
+    def __init__(self, lxd):
+        self._lxd = lxd
+
+    def all(self):
+        self._lxd.request('GET', 'images')
+        return [_Image(self._lxd, fp) for fp in self._lxd.images]
+
+    def get(self, fingerprint):
+        self._lxd.request('GET', 'images/' + fingerprint)
+        if fingerprint not in self._lxd.images:
+            raise pylxd.exceptions.NotFound(_Response(None, 404))
+        return _Image(self._lxd, fingerprint)
+
+    def get_by_alias(self, alias):
+        self._lxd.request('GET', 'images/aliases/' + alias)
+        for fingerprint, aliases in self._lxd.images.items():
+            if any(al['name'] == alias for al in aliases):
+                return _Image(self._lxd, fingerprint)
+        raise pylxd.exceptions.NotFound(_Response(None, 404))
+
+    def create(self, data, wait=False):
+        self._lxd.request('POST', 'images')
+        return _Image(self._lxd, self._lxd.add_image(data))
+
+
+class _Container:
+    """A container, as returned by the pylxd container manager."""
+
+    def __init__(self, lxd, obj):
+        self._lxd = lxd
+        self._obj = obj
+        self.name = obj['name']
+        self.snapshots = _Snapshots(self)
+
+    @property
+    def status(self):
+        return self._obj['status']
+
+    def start(self, wait=False, **kwargs):
+        self._set_state('Running')
+
+    def stop(self, wait=False, **kwargs):
+        self._set_state('Stopped')
+
+    def unfreeze(self, wait=False, **kwargs):
+        self._set_state('Running')
+
+    def _set_state(self, status):
+        self._lxd.request('PUT', 'containers/{}/state'.format(self.name))
+        if self._lxd.fail.get(self.name) == status:
+            raise pylxd.exceptions.LXDAPIException(_Response(None, 500))
+        self._obj['status'] = status
+
+    def rename(self, name, wait=False):
+        self._lxd.request('POST', 'containers/' + self.name)
+        containers = self._lxd.collection('containers')
+        self._obj['name'] = name
+        containers[name] = containers.pop(self.name)
+        self.name = name
+
+    def restore_snapshot(self, name, wait=False):
+        self._lxd.request('PUT', 'containers/' + self.name)
+        snapshot = self._obj['snapshots'][name]
+        self._obj.update(
+            {key: value for key, value in snapshot.items()
+             if key not in ('name', 'snapshots', 'status')})
+
+    def delete(self, wait=False):
+        self._lxd.request('DELETE', 'containers/' + self.name)
+        del self._lxd.collection('containers')[self.name]
+
+
+class _Snapshots:
+    """The snapshot manager of a container."""
+
+    def __init__(self, container):
+        self._container = container
+
+    def create(self, name, stateful=False, wait=False):
+        container = self._container
+        container._lxd.request(
+            'POST', 'containers/{}/snapshots'.format(container.name))
+        snapshots = container._obj.setdefault('snapshots', {})
+        if name in snapshots:
+            raise pylxd.exceptions.Conflict(_Response(None, 409))
+        snapshots[name] = {
+            key: value for key, value in container._obj.items()
+            if key != 'snapshots'}
+
+    def get(self, name):
+        container = self._container
+        container._lxd.request(
+            'GET', 'containers/{}/snapshots/{}'.format(container.name, name))
+        if name not in container._obj.get('snapshots', {}):
+            raise pylxd.exceptions.NotFound(_Response(None, 404))
+        return _Snapshot(container, name)
+
+
+class _Snapshot:
+    """A container snapshot, as returned by the snapshot manager."""
+
+    def __init__(self, container, name):
+        self._container = container
+        self.name = name
+
+    def delete(self, wait=False):
+        container = self._container
+        container._lxd.request(
+            'DELETE', 'containers/{}/snapshots/{}'.format(
+                container.name, self.name))
+        del container._obj['snapshots'][self.name]
+
+
+class _Containers:
+    """The pylxd container manager."""
+
+    def __init__(self, lxd):
+        self._lxd = lxd
+
+    def all(self):
+        self._lxd.request('GET', 'containers')
+        return [
+            _Container(self._lxd, obj)
+            for obj in list(self._lxd.collection('containers').values())]
+
+    def get(self, name):
+        self._lxd.request('GET', 'containers/' + name)
+        obj = self._lxd.collection('containers').get(name)
+        if obj is None:
+            raise pylxd.exceptions.NotFound(_Response(None, 404))
+        return _Container(self._lxd, obj)
+
+    def create(self, config, wait=False):
+        self._lxd.request('POST', 'containers')
+        if self._lxd.fail.get(config['name'], '') is None:
+            raise pylxd.exceptions.LXDAPIException(_Response(None, 500))
+        obj = dict(config, status='Stopped')
+        source = obj.pop('source', None) or {}
+        for fingerprint, aliases in self._lxd.images.items():
+            if {'name': source.get('alias')} in aliases:
+                obj['config'] = dict(
+                    obj.get('config') or {}, **{
+                        'volatile.base_image': fingerprint})
+        return _Container(self._lxd, self._lxd.add('containers', obj))
+
+
+class _Client:
+    """A pylxd compatible client."""
+
+    def __init__(self, lxd):
+        self.api = _APINode(lxd, '')
+        self.images = _Images(lxd)
+        self.containers = _Containers(lxd)
@@ -0,0 +1,315 @@
+# Copyright 2017 Canonical Ltd.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+"""A harness simulating the jujushell charm lifecycle.
+
+Hooks are run through the reactive bus, using the real handlers defined in
+reactive/jujushell.py and the real flag state machine. The apt layer, the
+charmhelpers functions interacting with Juju and the system, and LXD are
+faked, and expensive operations are counted for every hook.
+
+Run this module to print the counts for the default lifecycle:
+
+    python3 tests/lifecycle.py
+"""
+
+import collections
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+from unittest.mock import patch
+
+import yaml
+
+_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+_layer = os.path.join(_root, 'lib', 'charms', 'layer')
+sys.path.insert(0, _layer)
+sys.path.insert(0, os.path.dirname(__file__))
+
+# jujushell can only be imported after the layer directory has been added to
+# the python path.
+import jujushell  # noqa: E402
+
+from charmhelpers.core import unitdata  # noqa: E402
+from charms.reactive import (  # noqa: E402
+    bus,
+    clear_flag,
+    get_flags,
+    set_flag,
+)
+
+from fakelxd import FakeLXD  # noqa: E402
+
+
+# Define the hooks run by default, in order.
+LIFECYCLE = (
+    'install', 'config-changed', 'start', 'upgrade-charm', 'config-changed',
+    'update-status', 'stop',
+)
+
+# Define the operations counted for every hook.
+OPERATIONS = (
+    'subprocesses', 'lxd-calls', 'image-imports', 'renders',
+    'service-starts', 'service-restarts', 'service-stops',
+)
+
+
+class Unit:
+    """A simulated jujushell unit.
+
+    The unit starts with the default charm config, updated with the given
+    one, and with the given resources, provided as a dict mapping resource
+    names to their content.
+    """
+
+    def __init__(self, config=None, resources=None):
+        self.dir = tempfile.mkdtemp()
+        self.charm_dir = os.path.join(self.dir, 'charm')
+        os.makedirs(os.path.join(self.charm_dir, 'files'))
+        shutil.copy(os.path.join(_root, 'metadata.yaml'), self.charm_dir)
+        with open(os.path.join(self.dir, 'agent.conf'), 'w') as f:
+            yaml.safe_dump({'cacert': 'agent cert'}, f)
+        self.lxd = FakeLXD()
+        self.defaults = _config_defaults()
+        self.config = dict(self.defaults, **(config or {}))
+        self.previous_config = None
+        self.resources = resources or {
+            'jujushell': b'jujushell binary',
+            'limited-termserver': b'limited termserver image',
+            'termserver': b'termserver image',
+        }
+        self.counts = collections.Counter()
+        self.transitions = []
+        self.status = None
+        self.leader = False
+
+    def close(self):
+        """Remove the unit files."""
+        shutil.rmtree(self.dir)
+
+    def run(self, hook, **config):
+        """Run the given hook, after updating the config with the given one.
+
+        Config keys are provided with underscores instead of dashes. Return
+        the counts of expensive operations and the wall time as a dict.
+        """
+        self.config.update(
+            {key.replace('_', '-'): value for key, value in config.items()})
+        self.counts.clear()
+        lxd_calls, image_imports = self.lxd.count(), self._image_imports()
+        start = time.monotonic()
+        with self._patches(hook):
+            self._set_config_flags()
+            bus.dispatch()
+            for flag in get_flags():
+                if flag.startswith('config.changed'):
+                    clear_flag(flag)
+        elapsed = time.monotonic() - start
+        self.previous_config = dict(self.config)
+        self.counts['lxd-calls'] = self.lxd.count() - lxd_calls
+        self.counts['image-imports'] = self._image_imports() - image_imports
+        result = {op: self.counts[op] for op in OPERATIONS}
+        result['seconds'] = elapsed
+        self.transitions.append((hook, result))
+        return result
+
+    def flags(self):
+        """Return the flags currently set."""
+        with self._patches('flags'):
+            return sorted(get_flags())
+
+    def report(self):
+        """Return the operation counts for all hooks run as a table."""
+        header = ('hook',) + OPERATIONS + ('seconds',)
+        rows = [header]
+        for hook, result in self.transitions:
+            rows.append((hook,) + tuple(
+                str(result[op]) for op in OPERATIONS) + (
+                '{:.3f}'.format(result['seconds']),))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+        return '\n'.join(
+            '  '.join(cell.ljust(width) for cell, width in zip(row, widths))
+            for row in rows)
+
+    def _image_imports(self):
+        return self.lxd.calls.count(('POST', 'images'))
+
+    def _set_config_flags(self):
+        """Set config flags as the basic layer does at the start of hooks."""
+        previous = self.previous_config or {}
+        for key, value in self.config.items():
+            if self.previous_config is None or previous.get(key) != value:
+                set_flag('config.changed')
+                set_flag('config.changed.{}'.format(key))
+            for flag, condition in (
+                    ('config.set.', value not in ('', None, False)),
+                    ('config.default.', value == self.defaults.get(key))):
+                if condition:
+                    set_flag(flag + key)
+                else:
+                    clear_flag(flag + key)
+
+    def _patches(self, hook):
+        """Return a context manager faking Juju, the system and LXD."""
+        return _Patches(self, hook)
+
+    def _count(self, operation):
+        """Return a function counting the given operation when called."""
+        def count(*args, **kwargs):
+            self.counts[operation] += 1
+        return count
+
+    def _status_set(self, workload_state, message):
+        self.status = (workload_state, message)
+
+    def _resource_get(self, name):
+        content = self.resources.get(name)
+        if content is None:
+            return False
+        path = os.path.join(self.dir, 'resource-' + name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def _termserver_path(self, limited=False):
+        return os.path.join(
+            self.dir, 'termserver{}.tar.gz'.format('-limited' * limited))
+
+
+class _Config(dict):
+    """The charm config, as returned by hookenv.config."""
+
+    def __init__(self, config, previous):
+        super().__init__(config)
+        self._prev_dict = previous
+
+
+class _Patches:
+    """Fake Juju, the system and LXD while running a hook of a unit."""
+
+    def __init__(self, unit, hook):
+        self.unit = unit
+        self.hook = hook
+        self.patches = []
+
+    def __enter__(self):
+        _load_handlers()
+        unit = self.unit
+        config = _Config(unit.config, unit.previous_config)
+        env = {
+            'CHARM_DIR': unit.charm_dir,
+            'JUJU_API_ADDRESSES': '10.0.0.1:17070',
+            'JUJU_HOOK_NAME': self.hook,
+            'JUJU_UNIT_NAME': 'jujushell/0',
+            'UNIT_STATE_DB': os.path.join(unit.dir, 'unit-state.db'),
+        }
+        self.patches = [
+            patch.dict(os.environ, env),
+            patch.dict(sys.modules, {'charms.apt': _apt}),
+            patch.object(unitdata, '_KV', None),
+            patch('charmhelpers.core.hookenv.config', return_value=config),
+            patch('charmhelpers.core.hookenv.close_port'),
+            patch('charmhelpers.core.hookenv.is_leader', lambda: unit.leader),
+            patch('charmhelpers.core.hookenv.leader_get', return_value=None),
+            patch('charmhelpers.core.hookenv.local_unit',
+                  return_value='jujushell/0'),
+            patch('charmhelpers.core.hookenv.log'),
+            patch('charmhelpers.core.hookenv.open_port'),
+            patch('charmhelpers.core.hookenv.relation_ids', return_value=[]),
+            patch('charmhelpers.core.hookenv.resource_get',
+                  unit._resource_get),
+            patch('charmhelpers.core.hookenv.status_set', unit._status_set),
+            patch('charmhelpers.core.hookenv.unit_private_ip',
+                  return_value='10.0.0.2'),
+            patch('charmhelpers.core.hookenv.unit_public_ip',
+                  return_value='10.0.0.2'),
+            patch('charmhelpers.core.host.add_user_to_group'),
+            patch('charmhelpers.core.host.service_restart',
+                  unit._count('service-restarts')),
+            patch('charmhelpers.core.host.service_start',
+                  unit._count('service-starts')),
+            patch('charmhelpers.core.host.service_stop',
+                  unit._count('service-stops')),
+            patch('jujushell._get_self_signed_cert', self._self_signed_cert),
+            patch('jujushell._lxd_client', unit.lxd.client),
+            patch('jujushell._lxd_socket',
+                  return_value='/var/snap/lxd/common/lxd/unix.socket'),
+            patch('jujushell.call', unit._count('subprocesses')),
+            patch('jujushell._probe_address', return_value=0.001),
+            patch('jujushell.numa_nodes', return_value=((0, 1, 2, 3),)),
+            patch('charmhelpers.core.templating.render', self._render),
+            patch('jujushell.service_path',
+                  lambda: os.path.join(unit.dir, 'jujushell.service')),
+            patch('jujushell.termserver_path', unit._termserver_path),
+        ]
+        for p in self.patches:
+            p.start()
+        _apt.unit = unit
+
+    def __exit__(self, *exc_info):
+        unitdata.kv().flush()
+        unitdata.kv().close()
+        for p in reversed(self.patches):
+            p.stop()
+        _apt.unit = None
+
+    def _render(self, source, target, context, **kwargs):
+        # The content depends on the context, so that changes are detected.
+        self.unit.counts['renders'] += 1
+        return '{}: {}\n'.format(source, sorted(context.items()))
+
+    def _self_signed_cert(self, address):
+        # The certificate is created by running openssl.
+        self.unit.counts['subprocesses'] += 1
+        return 'key', 'cert'
+
+
+def _queue_install(packages):
+    """Fake the apt layer by installing packages right away."""
+    for package in packages:
+        _apt.unit.counts['subprocesses'] += 1
+        set_flag('apt.installed.{}'.format(package))
+
+
+# Define a fake apt layer.
+_apt = types.ModuleType('charms.apt')
+_apt.queue_install = _queue_install
+_apt.unit = None
+
+
+def _load_handlers():
+    """Register the reactive handlers defined by the charm, only once."""
+    if 'jujushell_reactive' in sys.modules:
+        return
+    path = os.path.join(_root, 'reactive', 'jujushell.py')
+    spec = importlib.util.spec_from_file_location('jujushell_reactive', path)
+    module = importlib.util.module_from_spec(spec)
+    layer = types.ModuleType('charms.layer')
+    layer.jujushell = jujushell
+    with patch.dict(sys.modules, {
+            'charms.apt': _apt,
+            'charms.layer': layer,
+            'charms.layer.jujushell': jujushell}):
+        spec.loader.exec_module(module)
+    sys.modules['jujushell_reactive'] = module
+
+
+def _config_defaults():
+    """Return the default charm config."""
+    with open(os.path.join(_root, 'config.yaml')) as f:
+        options = yaml.safe_load(f)['options']
+    return {key: option.get('default') for key, option in options.items()}
+
+
+if __name__ == '__main__':
+    unit = Unit()
+    try:
+        for hook in LIFECYCLE:
+            unit.run(hook)
+        print(unit.report())
+    finally:
+        unit.close()
@@ -2,27 +2,39 @@
 # Licensed under the AGPLv3, see LICENCE file for details.
 
 import base64
+import hashlib
+import json
 import os
+import random
 import shutil
+import socket
 import sys
 import tempfile
+import time
 import unittest
 from unittest.mock import (
     call,
+    MagicMock,
     Mock,
     patch,
 )
 
+from charmhelpers.core import unitdata
+import pylxd
 import yaml
 
 _root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 _layer = os.path.join(_root, 'lib', 'charms', 'layer')
 sys.path.insert(0, _layer)
 
+sys.path.insert(0, os.path.dirname(__file__))
+
 # jujushell can only be imported after the layer directory has been added to
 # the python path.
 import jujushell  # noqa: E402
 
+from fakelxd import FakeLXD  # noqa: E402
+
 
 @patch('charmhelpers.core.hookenv.log')
 class TestCall(unittest.TestCase):
@@ -73,29 +85,411 @@ class TestCall(unittest.TestCase):
         ])
 
 
+@patch('charmhelpers.core.hookenv.log')
+@patch('charmhelpers.core.hookenv.status_set')
 class TestUpdateLXCQuotas(unittest.TestCase):
 
-    def test_update_lxc_quotas(self):
+    def update(self, cfg, current, current_limited=None):
+        """Update quotas with the given current profiles.
+
+        Return the mock API nodes for the full and limited profiles.
+        """
+        if current_limited is None:
+            current_limited = lxd_desired_objects({})['profiles'][2]
+        profiles = {}
+        for name, obj in (
+                (jujushell.PROFILE_TERMSERVER, current),
+                (jujushell.PROFILE_LIMITED_TERMSERVER, current_limited)):
+            profiles[name] = MagicMock()
+            profiles[name].get().json.return_value = {'metadata': obj}
+        with patch('jujushell._lxd_client') as mock_client:
+            mock_client().api.profiles = profiles
+            jujushell.update_lxc_quotas(cfg)
+        return (
+            profiles[jujushell.PROFILE_TERMSERVER],
+            profiles[jujushell.PROFILE_LIMITED_TERMSERVER],
+        )
+
+    def test_update_lxc_quotas(self, mock_status_set, mock_log):
+        # All limits are applied with a single request.
         cfg = {
             'lxc-quota-cpu-cores': 1,
             'lxc-quota-cpu-allowance': '100%',
+            'lxc-quota-cpu-priority': 5,
+            'lxc-quota-disk': '10GB',
+            'lxc-quota-disk-read': '100iops',
+            'lxc-quota-disk-write': '20MB',
             'lxc-quota-ram': '256MB',
             'lxc-quota-processes': 100,
+            'lxc-quota-net-ingress': '10Mbit',
+            'lxc-quota-swap': False,
         }
-        with patch('jujushell.call') as mock_call:
-            jujushell.update_lxc_quotas(cfg)
-        expected_calls = [
-            call(jujushell.LXC, 'profile', 'set', jujushell.PROFILE_TERMSERVER,
-                 'limits.cpu', '1'),
-            call(jujushell.LXC, 'profile', 'set', jujushell.PROFILE_TERMSERVER,
-                 'limits.cpu.allowance', '100%'),
-            call(jujushell.LXC, 'profile', 'set', jujushell.PROFILE_TERMSERVER,
-                 'limits.memory', '256MB'),
-            call(jujushell.LXC, 'profile', 'set', jujushell.PROFILE_TERMSERVER,
-                 'limits.processes', '100'),
-        ]
-        mock_call.assert_has_calls(expected_calls)
-        self.assertEqual(mock_call.call_count, len(expected_calls))
+        profile, _ = self.update(
+            cfg, lxd_desired_objects({})['profiles'][0])
+        profile.patch.assert_called_once_with(json={
+            'config': {
+                'limits.cpu': '1',
+                'limits.cpu.allowance': '100%',
+                'limits.cpu.priority': '5',
+                'limits.memory': '256MB',
+                'limits.memory.swap': 'false',
+                'limits.processes': '100',
+            },
+            'devices': {
+                'root': {
+                    'limits.read': '100iops',
+                    'limits.write': '20MB',
+                    'path': '/',
+                    'pool': 'jujushellstorage',
+                    'size': '10GB',
+                    'type': 'disk',
+                },
+                'eth0': {
+                    'limits.ingress': '10Mbit',
+                    'name': 'eth0',
+                    'nictype': 'bridged',
+                    'parent': 'jujushellbr0',
+                    'type': 'nic',
+                },
+            },
+        })
+
+    def test_only_changes_applied(self, mock_status_set, mock_log):
+        # Unchanged limits are not applied again.
+        cfg = {
+            'lxc-quota-cpu-cores': 2,
+            'lxc-quota-ram': '256MB',
+            'lxc-quota-swap': True,
+        }
+        current = lxd_desired_objects({})['profiles'][0]
+        current['config'] = {
+            'limits.cpu': '1',
+            'limits.memory': '256MB',
+            'limits.memory.swap': 'true',
+        }
+        profile, _ = self.update(cfg, current)
+        profile.patch.assert_called_once_with(json={
+            'config': {'limits.cpu': '2'},
+        })
+
+    def test_nothing_changed(self, mock_status_set, mock_log):
+        # The profile is not updated if limits have not changed.
+        cfg = {
+            'lxc-quota-cpu-cores': 1,
+            'lxc-quota-disk': '10GB',
+        }
+        current = lxd_desired_objects({})['profiles'][0]
+        current['config'] = {
+            'limits.cpu': '1',
+            'limits.memory.swap': 'true',
+        }
+        current['devices']['root']['size'] = '10GB'
+        profile, _ = self.update(cfg, current)
+        self.assertFalse(profile.patch.called)
+
+    def test_zero_values(self, mock_status_set, mock_log):
+        # A zero CPU priority is applied, while zero counts mean no limit.
+        cfg = {
+            'lxc-quota-cpu-cores': 0,
+            'lxc-quota-cpu-priority': 0,
+            'lxc-quota-processes': 0,
+        }
+        current = lxd_desired_objects({})['profiles'][0]
+        current['config'] = {
+            'limits.cpu': '2',
+            'limits.memory.swap': 'true',
+            'limits.processes': '100',
+        }
+        profile, _ = self.update(cfg, current)
+        profile.patch.assert_called_once_with(json={
+            'config': {
+                'limits.cpu': '',
+                'limits.cpu.priority': '0',
+                'limits.processes': '',
+            },
+        })
+
+    def test_limited_profile(self, mock_status_set, mock_log):
+        # Limits for the limited profile are applied independently.
+        cfg = {
+            'lxc-quota-ram': '1GB',
+            'limited-lxc-quota-cpu-allowance': '50%',
+            'limited-lxc-quota-disk': '2GB',
+            'limited-lxc-quota-net-egress': '1Mbit',
+            'limited-lxc-quota-ram': '128MB',
+            'limited-lxc-quota-swap': False,
+        }
+        current = lxd_desired_objects({})['profiles'][0]
+        current['config'] = {
+            'limits.memory': '1GB',
+            'limits.memory.swap': 'true',
+        }
+        profile, limited = self.update(cfg, current)
+        self.assertFalse(profile.patch.called)
+        limited.patch.assert_called_once_with(json={
+            'config': {
+                'limits.cpu.allowance': '50%',
+                'limits.memory': '128MB',
+                'limits.memory.swap': 'false',
+            },
+            'devices': {
+                'root': {
+                    'path': '/',
+                    'pool': 'jujushellstorage',
+                    'size': '2GB',
+                    'type': 'disk',
+                },
+                'eth0': {
+                    'limits.egress': '1Mbit',
+                    'name': 'eth0',
+                    'nictype': 'bridged',
+                    'parent': 'jujushellbr0',
+                    'type': 'nic',
+                },
+            },
+        })
+
+    def test_limited_profile_independent(self, mock_status_set, mock_log):
+        # The limited profile is not stacked on the full one, so that empty
+        # and zero limited values mean no limit.
+        cfg = {
+            'lxc-quota-cpu-cores': 2,
+            'lxc-quota-disk': '10GB',
+            'lxc-quota-processes': 200,
+            'limited-lxc-quota-processes': 0,
+        }
+        current = lxd_desired_objects({})['profiles'][0]
+        current['config'] = {
+            'limits.cpu': '2',
+            'limits.memory.swap': 'true',
+            'limits.processes': '200',
+        }
+        current['devices']['root']['size'] = '10GB'
+        current_limited = lxd_desired_objects({})['profiles'][2]
+        current_limited['config'] = {
+            'limits.memory.swap': 'true',
+            'limits.processes': '100',
+        }
+        profile, limited = self.update(cfg, current, current_limited)
+        self.assertFalse(profile.patch.called)
+        limited.patch.assert_called_once_with(json={
+            'config': {'limits.processes': ''},
+        })
+
+
+class TestNUMANodes(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def make_node(self, name, cpulist):
+        os.mkdir(os.path.join(self.root, name))
+        with open(os.path.join(self.root, name, 'cpulist'), 'w') as f:
+            f.write(cpulist + '\n')
+
+    def test_numa_nodes(self):
+        # The NUMA topology is retrieved from sysfs.
+        self.make_node('node0', '0-3,8-11')
+        self.make_node('node1', '4-7,12-15')
+        self.make_node('node10', '16')
+        self.make_node('node2', '')
+        os.mkdir(os.path.join(self.root, 'power'))
+        self.assertEqual((
+            (0, 1, 2, 3, 8, 9, 10, 11),
+            (4, 5, 6, 7, 12, 13, 14, 15),
+            (16,),
+        ), jujushell.numa_nodes(root=self.root))
+
+    def test_no_topology(self):
+        # A single node is returned if the topology is not available.
+        with patch('os.cpu_count', return_value=4):
+            nodes = jujushell.numa_nodes(root=self.root + '/no-such')
+        self.assertEqual(((0, 1, 2, 3),), nodes)
+
+
+class TestCPULayout(unittest.TestCase):
+
+    nodes = ((0, 1, 2, 3), (4, 5, 6, 7))
+
+    def test_no_reserved_cpus(self):
+        # All CPUs are available to containers by default.
+        reserved, nodes = jujushell.cpu_layout({}, self.nodes)
+        self.assertEqual((), reserved)
+        self.assertEqual(self.nodes, nodes)
+
+    def test_reserved_cpus(self):
+        # The first CPUs are reserved for the jujushell service.
+        reserved, nodes = jujushell.cpu_layout(
+            {'jujushell-reserved-cpus': 2}, self.nodes)
+        self.assertEqual((0, 1), reserved)
+        self.assertEqual(((2, 3), (4, 5, 6, 7)), nodes)
+
+    def test_reserved_node(self):
+        # Nodes without available CPUs are excluded.
+        reserved, nodes = jujushell.cpu_layout(
+            {'jujushell-reserved-cpus': 4}, self.nodes)
+        self.assertEqual((0, 1, 2, 3), reserved)
+        self.assertEqual(((4, 5, 6, 7),), nodes)
+
+    def test_all_reserved(self):
+        # A ValueError is raised if no CPUs are left for containers.
+        with self.assertRaises(ValueError) as ctx:
+            jujushell.cpu_layout({'jujushell-reserved-cpus': 8}, self.nodes)
+        self.assertEqual('no CPUs left for containers', str(ctx.exception))
+
+
+class TestCPUList(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual((), jujushell._parse_cpulist(''))
+        self.assertEqual((3,), jujushell._parse_cpulist('3'))
+        self.assertEqual(
+            (0, 1, 2, 8), jujushell._parse_cpulist('0-2,8-8\n'))
+
+    def test_format(self):
+        self.assertEqual('', jujushell._format_cpulist(()))
+        self.assertEqual('3-3', jujushell._format_cpulist((3,)))
+        self.assertEqual('0-2,8-8', jujushell._format_cpulist((8, 0, 1, 2)))
+
+
+@patch('charmhelpers.core.hookenv.log')
+class TestPlaceContainers(unittest.TestCase):
+
+    nodes = ((0, 1, 2, 3), (4, 5, 6, 7))
+
+    def place(self, cfg, containers):
+        """Place the given containers. Return placements and the mock API."""
+        containers = [{
+            'name': name,
+            'config': config,
+            'profiles': profiles,
+        } for name, config, profiles in containers]
+        with patch('jujushell._lxd_client') as mock_client:
+            api = mock_client().api
+            api.containers.get().json.return_value = {'metadata': containers}
+            placements = jujushell.place_containers(cfg, nodes=self.nodes)
+        return placements, api
+
+    def test_spread_across_nodes(self, mock_log):
+        # Containers are spread across NUMA nodes.
+        cfg = {
+            'lxc-cpu-placement': 'numa',
+            'lxc-quota-cpu-cores': 2,
+            'limited-lxc-quota-cpu-cores': 1,
+        }
+        profiles = ['default', 'termserver']
+        placements, api = self.place(cfg, [
+            ('c1', {}, profiles),
+            ('c2', {}, profiles),
+            ('c3', {}, profiles),
+            ('c4', {}, profiles),
+        ])
+        self.assertEqual({
+            'c1': '0-1',
+            'c2': '4-5',
+            'c3': '2-3',
+            'c4': '6-7',
+        }, placements)
+        api.containers.__getitem__.assert_has_calls([
+            call('c1'), call().patch(json={'config': {
+                'limits.cpu': '0-1', 'user.jujushell.cpus': '0-1'}}),
+        ])
+
+    def test_limited(self, mock_log):
+        # The CPU quota for the termserver variant in use is applied, whatever
+        # the profiles of existing containers.
+        cfg = {
+            'limit-termserver': True,
+            'lxc-cpu-placement': 'numa',
+            'lxc-quota-cpu-cores': 2,
+            'limited-lxc-quota-cpu-cores': 1,
+        }
+        placements, api = self.place(cfg, [
+            ('c1', {}, ['default', 'termserver']),
+            ('c2', {}, ['default', 'termserver', 'termserver-limited']),
+        ])
+        self.assertEqual({'c1': '0-0', 'c2': '4-4'}, placements)
+
+        cfg['limit-termserver'] = False
+        placements, api = self.place(cfg, [
+            ('c1', {}, ['default', 'termserver', 'termserver-limited']),
+        ])
+        self.assertEqual({'c1': '0-1'}, placements)
+
+    def test_existing_placements(self, mock_log):
+        # Pinned containers are not moved, and they are taken into account.
+        cfg = {
+            'lxc-cpu-placement': 'numa',
+            'lxc-quota-cpu-cores': 2,
+        }
+        placements, api = self.place(cfg, [
+            ('c1', {'user.jujushell.cpus': '0-1'}, ['termserver']),
+            ('c2', {'user.jujushell.cpus': '4-4'}, ['termserver']),
+            ('c3', {}, ['termserver']),
+        ])
+        self.assertEqual({'c3': '5-6'}, placements)
+
+    def test_reserved_cpus(self, mock_log):
+        # Containers are not placed on CPUs reserved for the service, and they
+        # are moved if previously pinned there.
+        cfg = {
+            'jujushell-reserved-cpus': 4,
+            'lxc-cpu-placement': 'numa',
+            'lxc-quota-cpu-cores': 2,
+        }
+        placements, api = self.place(cfg, [
+            ('c1', {'user.jujushell.cpus': '0-1'}, ['termserver']),
+            ('c2', {}, ['termserver']),
+        ])
+        self.assertEqual({'c1': '4-5', 'c2': '6-7'}, placements)
+
+    def test_disabled(self, mock_log):
+        # Pinned containers are unpinned when placement is disabled.
+        placements, api = self.place({}, [
+            ('c1', {'user.jujushell.cpus': '0-1'}, ['termserver']),
+            ('c2', {}, ['termserver']),
+        ])
+        self.assertEqual({}, placements)
+        api.containers.__getitem__.assert_called_once_with('c1')
+        api.containers['c1'].patch.assert_called_once_with(json={
+            'config': {'limits.cpu': '', 'user.jujushell.cpus': ''}})
+
+
+class TestServiceLimits(unittest.TestCase):
+
+    def test_defaults(self):
+        # Only the restart delay is set by default.
+        self.assertEqual(
+            {'restart_delay': 1}, jujushell.service_limits({}))
+
+    def test_limits(self):
+        # Resource controls are returned when set.
+        self.assertEqual({
+            'cpu_quota': '200%',
+            'cpu_weight': 500,
+            'limit_nofile': 65536,
+            'memory_high': '2G',
+            'nice': -5,
+            'restart_delay': 5,
+            'tasks_max': '4096',
+            'watchdog': 30,
+        }, jujushell.service_limits({
+            'service-cpu-quota': '200%',
+            'service-cpu-weight': 500,
+            'service-limit-nofile': 65536,
+            'service-memory-high': ' 2G ',
+            'service-nice': -5,
+            'service-restart-delay': 5,
+            'service-tasks-max': '4096',
+            'service-watchdog': 30,
+        }))
+
+    def test_restart_delay(self):
+        # The restart delay is at least one second.
+        self.assertEqual({'restart_delay': 1}, jujushell.service_limits({
+            'service-restart-delay': 0,
+        }))
 
 
 class TestTermserverPath(unittest.TestCase):
@@ -109,9 +503,110 @@ class TestTermserverPath(unittest.TestCase):
             '/var/tmp/termserver-limited.tar.gz')
 
 
+class TestImageName(unittest.TestCase):
+
+    def test_image_name(self):
+        self.assertEqual(jujushell.image_name(), 'termserver')
+        self.assertEqual(
+            jujushell.image_name(limited=True), 'termserver-limited')
+
+
+class TestRankAddresses(unittest.TestCase):
+
+    def listen(self):
+        """Start listening on a local port and return the address."""
+        sock = socket.socket()
+        self.addCleanup(sock.close)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        return '127.0.0.1:{}'.format(sock.getsockname()[1])
+
+    def closed(self):
+        """Return a local address on which no one is listening."""
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return '127.0.0.1:{}'.format(sock.getsockname()[1])
+
+    def test_reachable_first(self):
+        # Unreachable addresses are moved to the end of the list.
+        addrs = [self.closed(), self.listen(), 'bad-address', self.listen()]
+        self.assertEqual(
+            [addrs[1], addrs[3], addrs[0], addrs[2]],
+            jujushell.rank_addresses(addrs, timeout=1))
+
+    def test_rtt(self):
+        # Faster addresses come first.
+        addrs = ['1.2.3.4:17070', '4.3.2.1:17070', '1.1.1.1:17070']
+        rtts = {addrs[0]: 0.2, addrs[1]: 0.01, addrs[2]: 0.011}
+        with patch('jujushell._probe_address', lambda addr, _: rtts[addr]):
+            ranked = jujushell.rank_addresses(addrs)
+        # Similar times do not change the original order.
+        self.assertEqual([addrs[1], addrs[2], addrs[0]], ranked)
+
+    def test_stable_under_jitter(self):
+        # The previous ranking is kept when RTTs only jitter.
+        addrs = ['1.2.3.4:17070', '4.3.2.1:17070', '1.1.1.1:17070']
+        rand = random.Random(42)
+        ranked = addrs
+        for _ in range(50):
+            rtts = {
+                addrs[0]: rand.uniform(0.02, 0.035),
+                addrs[1]: rand.uniform(0.02, 0.035),
+                addrs[2]: rand.uniform(0.1, 0.15),
+            }
+            with patch('jujushell._probe_address',
+                       lambda addr, _: rtts[addr]):
+                ranked = jujushell.rank_addresses(addrs, previous=ranked)
+            self.assertEqual(addrs, ranked)
+
+    def test_previous(self):
+        # The previous ranking is changed when reachability changes or when
+        # an address becomes significantly faster.
+        addrs = ['1.2.3.4:17070', '4.3.2.1:17070', '1.1.1.1:17070']
+        previous = [addrs[2], addrs[1], addrs[0]]
+        rtts = {addrs[0]: 0.01, addrs[1]: 0.012, addrs[2]: None}
+        with patch('jujushell._probe_address', lambda addr, _: rtts[addr]):
+            ranked = jujushell.rank_addresses(addrs, previous=previous)
+            self.assertEqual([addrs[1], addrs[0], addrs[2]], ranked)
+            rtts[addrs[2]] = 0.011
+            ranked = jujushell.rank_addresses(addrs, previous=ranked)
+            self.assertEqual([addrs[1], addrs[0], addrs[2]], ranked)
+            rtts[addrs[0]] = 0.001
+            ranked = jujushell.rank_addresses(addrs, previous=ranked)
+            self.assertEqual([addrs[0], addrs[1], addrs[2]], ranked)
+
+    def test_new_addresses(self):
+        # Addresses not previously ranked are appended, and removed addresses
+        # are ignored.
+        addrs = ['1.2.3.4:17070', '4.3.2.1:17070']
+        with patch('jujushell._probe_address', lambda addr, _: 0.01):
+            ranked = jujushell.rank_addresses(
+                addrs, previous=['1.1.1.1:17070', '4.3.2.1:17070'])
+        self.assertEqual([addrs[1], addrs[0]], ranked)
+
+    def test_concurrent(self):
+        # Addresses are probed concurrently.
+        def probe(addr, timeout):
+            time.sleep(0.2)
+            return 0.001
+        addrs = ['1.2.3.4:17070', '4.3.2.1:17070', '1.1.1.1:17070']
+        with patch('jujushell._probe_address', probe):
+            start = time.monotonic()
+            jujushell.rank_addresses(addrs)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_single_address(self):
+        # A single address is not probed.
+        with patch('jujushell._probe_address') as mock_probe:
+            self.assertEqual(
+                ['1.2.3.4:17070'], jujushell.rank_addresses(['1.2.3.4:17070']))
+        self.assertFalse(mock_probe.called)
+
+
 @patch('charmhelpers.core.hookenv.open_port')
 @patch('charmhelpers.core.hookenv.close_port')
 @patch('os.path.exists', lambda _: True)
+@patch('charmhelpers.core.hookenv.unit_public_ip', lambda: '1.2.3.4')
 class TestBuildConfig(unittest.TestCase):
 
     def setUp(self):
@@ -130,6 +625,15 @@ class TestBuildConfig(unittest.TestCase):
         # Add juju addresses as an environment variable.
         os.environ['JUJU_API_ADDRESSES'] = '1.2.3.4:17070 4.3.2.1:17070'
         self.addCleanup(os.environ.pop, 'JUJU_API_ADDRESSES')
+        # Use a fresh unit data store.
+        self.kv = unitdata.Storage(':memory:')
+        patcher = patch('charmhelpers.core.unitdata.kv', return_value=self.kv)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Do not probe controller addresses.
+        patcher = patch('jujushell._probe_address', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def get_config(self):
         """Return the YAML decoded configuration file that has been created."""
@@ -294,12 +798,76 @@ class TestBuildConfig(unittest.TestCase):
             '-out', 'cert.pem',
             '-days', '365',
             '-nodes',
-            '-subj', '/C=GB/ST=London/L=London/O=Canonical/OU=JAAS/CN=0.0.0.0')
+            '-subj', '/C=GB/ST=London/L=London/O=Canonical/OU=JAAS/CN=1.2.3.4')
         # Key files has been removed.
         self.assertEqual(['files'], os.listdir('.'))
         self.assertEqual(0, mock_close_port.call_count)
         mock_open_port.assert_called_once_with(4247)
 
+    def test_tls_generated_once(self, mock_close_port, mock_open_port):
+        # The self-signed certificate is reused when rendering the config.
+        cfg = {
+            'log-level': 'trace',
+            'port': 4247,
+            'tls': True,
+            'tls-cert': '',
+            'tls-key': '',
+        }
+        self.make_cert()
+        with patch('jujushell.call') as mock_call:
+            self.assertTrue(jujushell.build_config(cfg))
+            self.assertFalse(jujushell.build_config(cfg))
+        self.assertEqual(1, mock_call.call_count)
+        self.assertEqual('my cert', self.get_config()['tls-cert'])
+
+    def test_tls_generated_before_expiry(
+            self, mock_close_port, mock_open_port):
+        # The self-signed certificate is generated again before it expires.
+        cfg = {
+            'log-level': 'trace',
+            'port': 4247,
+            'tls': True,
+            'tls-cert': '',
+            'tls-key': '',
+        }
+        day = 24 * 60 * 60
+        with patch('jujushell.call') as mock_call:
+            with patch('time.time', return_value=1000 * day):
+                self.make_cert()
+                jujushell.build_config(cfg)
+            self.assertEqual(
+                1365 * day,
+                self.kv.get('jujushell.self-signed-cert')['expires'])
+            with patch('time.time', return_value=1334 * day):
+                self.assertFalse(jujushell.build_config(cfg))
+            with patch('time.time', return_value=1336 * day):
+                self.make_cert()
+                jujushell.build_config(cfg)
+        self.assertEqual(2, mock_call.call_count)
+
+    def test_tls_generated_when_address_changes(
+            self, mock_close_port, mock_open_port):
+        # The self-signed certificate is generated again for new addresses.
+        cfg = {
+            'log-level': 'trace',
+            'port': 4247,
+            'tls': True,
+            'tls-cert': '',
+            'tls-key': '',
+        }
+        # Certificates stored without their address are also replaced.
+        self.kv.set('jujushell.self-signed-cert', ['old key', 'old cert'])
+        with patch('jujushell.call') as mock_call:
+            self.make_cert()
+            jujushell.build_config(cfg)
+            self.assertEqual('my cert', self.get_config()['tls-cert'])
+            with patch('charmhelpers.core.hookenv.unit_public_ip',
+                       lambda: '4.3.2.1'):
+                self.make_cert()
+                jujushell.build_config(cfg)
+        self.assertEqual(2, mock_call.call_count)
+        self.assertTrue(mock_call.call_args[0][-1].endswith('/CN=4.3.2.1'))
+
     def test_tls_generated_when_key_is_missing(
             self, mock_close_port, mock_open_port):
         # TLS keys are generated if only one key is provided, not both.
@@ -450,6 +1018,22 @@ class TestBuildConfig(unittest.TestCase):
         self.assertEqual(0, mock_close_port.call_count)
         mock_open_port.assert_called_once_with(4247)
 
+    def test_juju_cert_cached(self, mock_close_port, mock_open_port):
+        # The agent file is only parsed again when it changes.
+        agent = os.path.join(os.environ['CHARM_DIR'], 'agent.conf')
+        with open(agent, 'w') as agentfile:
+            yaml.safe_dump({'cacert': 'agent cert'}, agentfile)
+        with patch('yaml.safe_load', wraps=yaml.safe_load) as mock_load:
+            self.assertEqual('agent cert', jujushell._get_juju_cert(agent))
+            self.assertEqual('agent cert', jujushell._get_juju_cert(agent))
+            self.assertEqual(1, mock_load.call_count)
+            # The CA certificate is rotated.
+            with open(agent, 'w') as agentfile:
+                yaml.safe_dump({'cacert': 'new agent cert'}, agentfile)
+            self.assertEqual(
+                'new agent cert', jujushell._get_juju_cert(agent))
+            self.assertEqual(2, mock_load.call_count)
+
     def test_provided_juju_addresses(self, mock_close_port, mock_open_port):
         # Juju addresses can be provided via the configuration.
         jujushell.build_config({
@@ -495,6 +1079,30 @@ class TestBuildConfig(unittest.TestCase):
         mock_close_port.assert_called_once_with(8042)
         mock_open_port.assert_called_once_with(443)
 
+    def test_same_ports(self, mock_close_port, mock_open_port):
+        # Ports are not opened again if they did not change.
+        Config = type('Config', (dict,), {'_prev_dict': None})
+        config = Config({'log-level': 'info', 'port': 4247, 'tls': False})
+        config._prev_dict = {'log-level': 'debug', 'port': 4247}
+        jujushell.build_config(config)
+        self.assertEqual(0, mock_close_port.call_count)
+        self.assertEqual(0, mock_open_port.call_count)
+
+    def test_changed(self, mock_close_port, mock_open_port):
+        # The config file is only written when its content changes.
+        cfg = {'log-level': 'info', 'port': 4247, 'tls': False}
+        self.assertTrue(jujushell.build_config(cfg))
+        path = 'files/config.yaml'
+        os.utime(path, (0, 0))
+        self.assertEqual((), jujushell.build_config(cfg))
+        self.assertEqual(0, os.stat(path).st_mtime)
+        # The names of the changed options are returned.
+        cfg['log-level'] = 'debug'
+        self.assertEqual(('log-level',), jujushell.build_config(cfg))
+        self.assertEqual('debug', self.get_config()['log-level'])
+        # Temporary files are not left behind.
+        self.assertEqual(['config.yaml'], os.listdir('files'))
+
     def test_error_no_juju_addresses(self, mock_close_port, mock_open_port):
         # A ValueError is raised if no Juju addresses can be retrieved.
         os.environ['JUJU_API_ADDRESSES'] = ''
@@ -517,7 +1125,9 @@ class TestBuildConfig(unittest.TestCase):
             'tls': False,
         })
         expected_config = {
-            'allowed-users': ['who', 'dalek', 'rose@external'],
+            'allowed-users': ['dalek', 'rose@external', 'who'],
+            'allowed-users-fingerprint': hashlib.sha256(
+                b'[["dalek", "rose@external", "who"], []]').hexdigest(),
             'image-name': 'termserver',
             'juju-addrs': ['1.2.3.4:17070', '4.3.2.1:17070'],
             'juju-cert': '',
@@ -535,6 +1145,50 @@ class TestBuildConfig(unittest.TestCase):
         self.assertEqual(0, mock_close_port.call_count)
         mock_open_port.assert_called_once_with(4247)
 
+    def test_allowed_users_patterns(self, mock_close_port, mock_open_port):
+        # Users can be provided by a resource, and as patterns.
+        with open(jujushell.allowed_users_path(), 'w') as f:
+            f.write('# Users.\nwho rose@external\n\n*@example.com # All.\n')
+        jujushell.build_config({
+            'allowed-users': 'who *@external',
+            'log-level': 'info',
+            'port': 4247,
+            'tls': False,
+        })
+        config = self.get_config()
+        self.assertEqual(
+            ['*@example.com', '*@external', 'rose@external', 'who'],
+            config['allowed-users'])
+        self.assertEqual(
+            ['*@example.com', '*@external'], config['allowed-user-patterns'])
+        fingerprint = config['allowed-users-fingerprint']
+        # The fingerprint only depends on the users.
+        jujushell.build_config({
+            'allowed-users': '*@example.com rose@external *@external',
+            'log-level': 'debug',
+            'port': 4247,
+            'tls': False,
+        })
+        self.assertEqual(
+            fingerprint, self.get_config()['allowed-users-fingerprint'])
+
+    def test_session_expiry_action(self, mock_close_port, mock_open_port):
+        # Containers can be frozen when sessions expire.
+        cfg = {
+            'log-level': 'info',
+            'port': 4247,
+            'session-expiry-action': 'freeze',
+            'session-timeout': 42,
+            'tls': False,
+        }
+        jujushell.build_config(cfg)
+        self.assertEqual('freeze', self.get_config()['session-expiry-action'])
+        cfg['session-expiry-action'] = 'explode'
+        with self.assertRaises(ValueError) as ctx:
+            jujushell.build_config(cfg)
+        self.assertEqual(
+            'invalid session expiry action: explode', str(ctx.exception))
+
     def test_session_timeout(self, mock_close_port, mock_open_port):
         # The session timeout value is properly generated.
         jujushell.build_config({
@@ -562,6 +1216,40 @@ class TestBuildConfig(unittest.TestCase):
         self.assertEqual(0, mock_close_port.call_count)
         mock_open_port.assert_called_once_with(4247)
 
+    def test_limit_termserver(self, mock_close_port, mock_open_port):
+        # The limited termserver image is used when requested.
+        jujushell.build_config({
+            'limit-termserver': True,
+            'log-level': 'info',
+            'port': 4247,
+            'tls': False,
+        })
+        expected_config = {
+            'allowed-users': [],
+            'image-name': 'termserver-limited',
+            'juju-addrs': ['1.2.3.4:17070', '4.3.2.1:17070'],
+            'juju-cert': '',
+            'log-level': 'info',
+            'lxd-socket-path': '/var/lib/lxd/unix.socket',
+            'port': 4247,
+            'profiles': [
+                jujushell.PROFILE_LIMITED_TERMSERVER,
+                jujushell.PROFILE_TERMSERVER_LIMITED,
+            ],
+            'session-timeout': 0,
+            'welcome-message': '',
+        }
+        self.assertEqual(expected_config, self.get_config())
+
+    def test_previous_address_ranking(self, mock_close_port, mock_open_port):
+        # Controller addresses are ranked starting from the previous ranking.
+        self.kv.set('jujushell.juju-addrs', ['4.3.2.1:17070', '1.1.1.1:17070'])
+        cfg = {'log-level': 'info', 'port': 4247, 'tls': False}
+        jujushell.build_config(cfg)
+        expected = ['4.3.2.1:17070', '1.2.3.4:17070']
+        self.assertEqual(expected, self.get_config()['juju-addrs'])
+        self.assertEqual(expected, self.kv.get('jujushell.juju-addrs'))
+
     def test_welcome_message(self, mock_close_port, mock_open_port):
         # The welcome message is properly handled.
         jujushell.build_config({
@@ -590,6 +1278,35 @@ class TestBuildConfig(unittest.TestCase):
         mock_open_port.assert_called_once_with(4247)
 
 
+@patch('jujushell.numa_nodes', lambda: ((0, 1),))
+class TestValidateConfig(unittest.TestCase):
+
+    tests = [
+        ({}, None),
+        ({'lxc-cpu-placement': 'numa', 'session-expiry-action': 'freeze'},
+         None),
+        ({'lxc-cpu-placement': 'bad'}, 'invalid lxc-cpu-placement: bad'),
+        ({'memory-pressure-action': 'bad'},
+         'invalid memory-pressure-action: bad'),
+        ({'session-expiry-action': 'bad'},
+         'invalid session-expiry-action: bad'),
+        ({'lxd-bridge-ipv4-address': '10.0.0.1/32',
+          'lxd-bridge-dhcp-range-size': 10},
+         'no room for DHCP in 10.0.0.1/32'),
+        ({'jujushell-reserved-cpus': 2}, 'no CPUs left for containers'),
+    ]
+
+    def test_validate_config(self):
+        for cfg, want in self.tests:
+            with self.subTest(cfg=cfg):
+                if want is None:
+                    jujushell.validate_config(cfg)
+                    continue
+                with self.assertRaises(ValueError) as ctx:
+                    jujushell.validate_config(cfg)
+                self.assertEqual(want, str(ctx.exception))
+
+
 class TestGetPorts(unittest.TestCase):
 
     def test_with_dns_name(self):
@@ -656,6 +1373,193 @@ class TestSaveResource(unittest.TestCase):
         mock_get.assert_called_once_with('myresource')
 
 
+@patch('charmhelpers.core.hookenv.log')
+class TestSaveOptionalResource(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.resource = os.path.join(directory, 'resource')
+        with open(self.resource, 'w') as resource_file:
+            resource_file.write('resource content')
+        self.path = os.path.join(directory, 'target')
+
+    def test_resource_saved(self, mock_log):
+        # The resource is saved if available.
+        with patch('charmhelpers.core.hookenv.resource_get') as mock_get:
+            mock_get.return_value = self.resource
+            saved = jujushell.save_optional_resource('myresource', self.path)
+        self.assertTrue(saved)
+        with open(self.path) as target_file:
+            self.assertEqual('resource content', target_file.read())
+
+    def test_resource_not_available(self, mock_log):
+        # Previously saved files are removed if the resource is not available.
+        with open(self.path, 'w') as target_file:
+            target_file.write('stale content')
+        with patch('charmhelpers.core.hookenv.resource_get') as mock_get:
+            mock_get.return_value = False
+            saved = jujushell.save_optional_resource('myresource', self.path)
+        self.assertFalse(saved)
+        self.assertFalse(os.path.exists(self.path))
+
+
+@patch('charmhelpers.core.hookenv.log')
+class TestSaveImageResource(unittest.TestCase):
+
+    old_fingerprint = hashlib.sha256(b'old image').hexdigest()
+    new_fingerprint = hashlib.sha256(b'new image').hexdigest()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'termserver.tar.gz')
+        self.write(self.path, b'old image')
+        # Patch the LXD client so that the alias refers to the old image.
+        patcher = patch('jujushell._lxd_client')
+        mock_client = patcher.start()
+        self.addCleanup(patcher.stop)
+        mock_client().images.get_by_alias().fingerprint = self.old_fingerprint
+        # Patch flags.
+        patcher = patch('jujushell.set_flag')
+        self.mock_set_flag = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, path, content):
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def make_resources(self, **resources):
+        """Create the given resources and return a resource_get function."""
+        paths = {}
+        for name, content in resources.items():
+            path = os.path.join(self.directory, 'resource-' + name)
+            self.write(path, content)
+            paths[name.replace('_', '-')] = path
+        return lambda name: paths.get(name, False)
+
+    def patch_xdelta3(self, content):
+        """Patch calls to xdelta3 so that the given content is produced."""
+        def call(command, *args):
+            self.assertEqual(jujushell.XDELTA3, command)
+            self.assertEqual(('-d', '-f', '-s', self.path), args[:4])
+            self.write(args[-1], content)
+        return patch('jujushell.call', side_effect=call)
+
+    def test_no_current_image(self, mock_log):
+        # The full resource is retrieved if there is no local image.
+        os.remove(self.path)
+        resource_get = self.make_resources(
+            termserver=b'new image', termserver_delta=b'delta')
+        with patch('charmhelpers.core.hookenv.resource_get', resource_get):
+            with self.patch_xdelta3(b'new image') as mock_call:
+                jujushell.save_image_resource(
+                    'termserver', self.path, 'termserver')
+        self.assertFalse(mock_call.called)
+        self.assertEqual(b'new image', self.read(self.path))
+        self.mock_set_flag.assert_called_once_with(
+            'jujushell.resource.available.termserver')
+
+    def test_checksum_matches_current_image(self, mock_log):
+        # The local image is reused if the checksum refers to it.
+        resource_get = self.make_resources(
+            termserver=b'new image',
+            termserver_sha256=self.old_fingerprint.encode('ascii'))
+        with patch('charmhelpers.core.hookenv.resource_get', resource_get):
+            jujushell.save_image_resource(
+                'termserver', self.path, 'termserver')
+        self.assertEqual(b'old image', self.read(self.path))
+        self.mock_set_flag.assert_has_calls([
+            call('jujushell.resource.available.termserver-sha256'),
+            call('jujushell.resource.available.termserver'),
+        ])
+
+    def test_recorded_fingerprint(self, mock_log):
+        # The local image is only hashed if its fingerprint is not recorded.
+        for _ in range(2):
+            # Resources are moved when saved, so they are created again.
+            resource_get = self.make_resources(
+                termserver=b'new image',
+                termserver_sha256=self.old_fingerprint.encode('ascii'))
+            with patch('charmhelpers.core.hookenv.resource_get', resource_get):
+                with patch('jujushell._file_sha256',
+                           side_effect=jujushell._file_sha256) as mock_sha256:
+                    jujushell.save_image_resource(
+                        'termserver', self.path, 'termserver')
+        # The image has only been hashed the first time.
+        self.assertFalse(mock_sha256.called)
+        self.assertEqual(b'old image', self.read(self.path))
+        self.assertEqual(
+            self.old_fingerprint, jujushell._recorded_fingerprint(self.path))
+        self.mock_set_flag.assert_called_with(
+            'jujushell.resource.available.termserver')
+
+    def test_delta_applied(self, mock_log):
+        # The new image is reconstructed from the delta resource.
+        resource_get = self.make_resources(
+            termserver_delta=b'delta',
+            termserver_sha256=self.new_fingerprint.encode('ascii'))
+        with patch('charmhelpers.core.hookenv.resource_get', resource_get):
+            with self.patch_xdelta3(b'new image') as mock_call:
+                jujushell.save_image_resource(
+                    'termserver', self.path, 'termserver')
+        self.assertEqual(1, mock_call.call_count)
+        self.assertEqual(b'new image', self.read(self.path))
+        self.assertFalse(os.path.exists(self.path + '.new'))
+        self.mock_set_flag.assert_called_with(
+            'jujushell.resource.available.termserver')
+
+    def test_delta_verification_failure(self, mock_log):
+        # The full resource is retrieved if the reconstructed image does not
+        # match the published checksum.
+        resource_get = self.make_resources(
+            termserver=b'new image',
+            termserver_delta=b'delta',
+            termserver_sha256=self.new_fingerprint.encode('ascii'))
+        with patch('charmhelpers.core.hookenv.resource_get', resource_get):
+            with self.patch_xdelta3(b'corrupted image'):
+                jujushell.save_image_resource(
+                    'termserver', self.path, 'termserver')
+        self.assertEqual(b'new image', self.read(self.path))
+        self.assertFalse(os.path.exists(self.path + '.new'))
+
+    def test_delta_failure(self, mock_log):
+        # The full resource is retrieved if the delta cannot be applied.
+        resource_get = self.make_resources(
+            termserver=b'new image', termserver_delta=b'delta')
+        with patch('charmhelpers.core.hookenv.resource_get', resource_get):
+            with patch('jujushell.call', side_effect=OSError('bad delta')):
+                jujushell.save_image_resource(
+                    'termserver', self.path, 'termserver')
+        self.assertEqual(b'new image', self.read(self.path))
+
+    def test_no_delta(self, mock_log):
+        # The full resource is retrieved if no delta is available.
+        resource_get = self.make_resources(termserver=b'new image')
+        with patch('charmhelpers.core.hookenv.resource_get', resource_get):
+            with self.patch_xdelta3(b'new image') as mock_call:
+                jujushell.save_image_resource(
+                    'termserver', self.path, 'termserver')
+        self.assertFalse(mock_call.called)
+        self.assertEqual(b'new image', self.read(self.path))
+
+    def test_local_image_not_current(self, mock_log):
+        # Deltas are not applied if the local file is not the current image.
+        self.write(self.path, b'another image')
+        resource_get = self.make_resources(
+            termserver=b'new image', termserver_delta=b'delta')
+        with patch('charmhelpers.core.hookenv.resource_get', resource_get):
+            with self.patch_xdelta3(b'new image') as mock_call:
+                jujushell.save_image_resource(
+                    'termserver', self.path, 'termserver')
+        self.assertFalse(mock_call.called)
+        self.assertEqual(b'new image', self.read(self.path))
+
+
 @patch('charmhelpers.core.hookenv.log')
 class TestImportLXDImage(unittest.TestCase):
 
@@ -716,28 +1620,578 @@ class TestImportLXDImage(unittest.TestCase):
 
 
 @patch('charmhelpers.core.hookenv.log')
+@patch('charmhelpers.core.hookenv.status_set')
+class TestImportLXDImageWithChecksum(unittest.TestCase):
+
+    fingerprint = (
+        '1d65bf29403e4fb1767522a107c827b8884d16640cf0e3b18c4c1dd107e0d49d')
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'image')
+        with open(self.path, 'wb') as f:
+            f.write(b'AAAAAAAAAA')
+
+    def write_checksum(self, checksum):
+        with open(jujushell.checksum_path(self.path), 'w') as f:
+            f.write('{}  image\n'.format(checksum))
+
+    def test_fast_path(self, mock_status_set, mock_log):
+        # The image is not read if it already exists with the right alias.
+        self.write_checksum(self.fingerprint)
+        jujushell._record_fingerprint(self.path, self.fingerprint)
+        image = Mock()
+        image.aliases = [{'name': 'test', 'description': ''}]
+        with patch('jujushell._lxd_client') as mock_client:
+            mock_client().images.get.return_value = image
+            with patch('builtins.open', wraps=open) as mock_open:
+                jujushell.import_lxd_image('test', self.path)
+        mock_client().images.get.assert_called_once_with(self.fingerprint)
+        self.assertFalse(mock_client().images.all.called)
+        self.assertFalse(mock_client().images.create.called)
+        self.assertNotIn(call(self.path, 'rb'), mock_open.call_args_list)
+
+    def test_fast_path_unverified_checksum(self, mock_status_set, mock_log):
+        # The fast path is not taken if the checksum has not been verified
+        # against the current file, and it is then recorded.
+        self.write_checksum(self.fingerprint)
+        image = Mock()
+        image.fingerprint = self.fingerprint
+        image.aliases = [{'name': 'test', 'description': ''}]
+        with patch('jujushell._lxd_client') as mock_client:
+            mock_client().images.all.return_value = [image]
+            jujushell.import_lxd_image('test', self.path)
+        self.assertTrue(mock_client().images.all.called)
+        self.assertFalse(mock_client().images.create.called)
+        self.assertEqual(
+            self.fingerprint, jujushell._recorded_fingerprint(self.path))
+        # The recorded fingerprint is discarded when the file changes.
+        with open(self.path, 'wb') as f:
+            f.write(b'new image content')
+        self.assertIsNone(jujushell._recorded_fingerprint(self.path))
+
+    def test_stale_checksum(self, mock_status_set, mock_log):
+        # A new image is imported and the alias moved to it if the published
+        # checksum refers to the image currently in place.
+        stale = '2' * 64
+        self.write_checksum(stale)
+        jujushell._record_fingerprint(self.path, stale)
+        # The image file is then replaced with the same size.
+        os.utime(self.path, ns=(1, 1))
+        old = Mock()
+        old.fingerprint = stale
+        old.aliases = [{'name': 'test', 'description': ''}]
+        with patch('jujushell._lxd_client') as mock_client:
+            mock_client().images.get.return_value = old
+            mock_client().images.all.return_value = [old]
+            mock_client().images.create().fingerprint = self.fingerprint
+            jujushell.import_lxd_image('test', self.path)
+        mock_client().images.create.assert_called_with(
+            b'AAAAAAAAAA', wait=True)
+        new = mock_client().images.create()
+        self.assertFalse(new.delete.called)
+        old.delete_alias.assert_called_once_with('test')
+        new.add_alias.assert_called_once_with('test', '')
+        self.assertEqual(
+            self.fingerprint, jujushell._recorded_fingerprint(self.path))
+
+    def test_image_not_found(self, mock_status_set, mock_log):
+        # The image is uploaded if it does not exist, and then verified.
+        self.write_checksum(self.fingerprint)
+        with patch('jujushell._lxd_client') as mock_client:
+            mock_client().images.get.side_effect = (
+                pylxd.exceptions.NotFound(Mock()))
+            mock_client().images.all.return_value = ()
+            jujushell.import_lxd_image('test', self.path)
+        mock_client().images.create.assert_called_once_with(
+            b'AAAAAAAAAA', wait=True)
+        image = mock_client().images.create()
+        self.assertFalse(image.delete.called)
+        image.add_alias.assert_called_once_with('test', '')
+
+    def test_image_without_alias(self, mock_status_set, mock_log):
+        # The alias is added if the image already exists without it.
+        self.write_checksum(self.fingerprint)
+        image = Mock()
+        image.fingerprint = self.fingerprint
+        image.aliases = []
+        with patch('jujushell._lxd_client') as mock_client:
+            mock_client().images.get.return_value = image
+            mock_client().images.all.return_value = [image]
+            jujushell.import_lxd_image('test', self.path)
+        self.assertFalse(mock_client().images.create.called)
+        image.add_alias.assert_called_once_with('test', '')
+
+    def test_checksum_mismatch(self, mock_status_set, mock_log):
+        # The uploaded image is removed if it does not match the checksum.
+        self.write_checksum('2' * 64)
+        with patch('jujushell._lxd_client') as mock_client:
+            mock_client().images.get.side_effect = (
+                pylxd.exceptions.NotFound(Mock()))
+            mock_client().images.all.return_value = ()
+            with self.assertRaises(OSError) as ctx:
+                jujushell.import_lxd_image('test', self.path)
+        self.assertIn(
+            'does not match the published checksum', str(ctx.exception))
+        image = mock_client().images.create()
+        image.delete.assert_called_once_with(wait=True)
+        self.assertFalse(image.add_alias.called)
+
+
+class TestReadChecksum(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'image')
+
+    def write_checksum(self, content):
+        with open(jujushell.checksum_path(self.path), 'w') as f:
+            f.write(content)
+
+    def test_sha256sum_format(self):
+        # Checksums in the sha256sum format are properly parsed.
+        self.write_checksum('{}  image.tar.gz\n'.format('AB' * 32))
+        self.assertEqual('ab' * 32, jujushell.read_checksum(self.path))
+
+    def test_checksum_only(self):
+        # The file name can be omitted.
+        self.write_checksum('ab' * 32)
+        self.assertEqual('ab' * 32, jujushell.read_checksum(self.path))
+
+    def test_not_found(self):
+        # None is returned if no checksum has been published.
+        self.assertIsNone(jujushell.read_checksum(self.path))
+
+    def test_empty(self):
+        # None is returned if the published checksum is empty.
+        self.write_checksum('\n')
+        self.assertIsNone(jujushell.read_checksum(self.path))
+
+    def test_invalid(self):
+        # A ValueError is raised if the checksum is not valid.
+        self.write_checksum('bad-wolf  image.tar.gz')
+        with self.assertRaises(ValueError) as ctx:
+            jujushell.read_checksum(self.path)
+        self.assertEqual(
+            "invalid checksum for {}: 'bad-wolf'".format(self.path),
+            str(ctx.exception))
+
+
+@patch('charmhelpers.core.hookenv.log')
+@patch('charmhelpers.core.hookenv.status_set')
+class TestImportLXDImages(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.paths = []
+        for name, content in (('full', b'AAAAAAAAAA'), ('limited', b'BBBB')):
+            path = os.path.join(directory, name)
+            with open(path, 'wb') as f:
+                f.write(content)
+            self.paths.append(path)
+
+    def test_import_all(self, mock_status_set, mock_log):
+        # All images are imported and flags are set.
+        with patch('jujushell._lxd_client') as mock_client:
+            mock_client().images.all.return_value = ()
+            with patch('jujushell.set_flag') as mock_set_flag:
+                jujushell.import_lxd_images([
+                    ('termserver', self.paths[0]),
+                    ('termserver-limited', self.paths[1]),
+                ])
+        mock_client().images.create.assert_has_calls([
+            call(b'AAAAAAAAAA', wait=True),
+            call(b'BBBB', wait=True),
+        ], any_order=True)
+        mock_client().images.create().add_alias.assert_has_calls([
+            call('termserver', ''),
+            call('termserver-limited', ''),
+        ], any_order=True)
+        mock_set_flag.assert_has_calls([
+            call('jujushell.lxd.image.imported.termserver'),
+            call('jujushell.lxd.image.imported.termserver-limited'),
+        ])
+
+    def test_import_failure(self, mock_status_set, mock_log):
+        # Flags are only set for successful imports, and the error is raised.
+        with patch('jujushell._lxd_client') as mock_client:
+            mock_client().images.all.return_value = ()
+            with patch('jujushell.set_flag') as mock_set_flag:
+                with self.assertRaises(FileNotFoundError):
+                    jujushell.import_lxd_images([
+                        ('termserver', self.paths[0]),
+                        ('termserver-limited', '/no/such/path'),
+                    ])
+        mock_set_flag.assert_called_once_with(
+            'jujushell.lxd.image.imported.termserver')
+
+    def test_no_images(self, mock_status_set, mock_log):
+        # Nothing happens if no images are provided.
+        with patch('jujushell._lxd_client') as mock_client:
+            jujushell.import_lxd_images([])
+        self.assertFalse(mock_client.called)
+
+
+def make_lxd_api(**objects):
+    """Return a mock LXD API exposing the given objects.
+
+    Objects are provided as lists of dicts for each kind of objects, e.g.
+    networks=[...], storage_pools=[...] and profiles=[...]. Other kinds of
+    objects are empty.
+    """
+    class API(dict):
+
+        def __missing__(self, kind):
+            collection = self[kind] = MagicMock()
+            collection.get.return_value.json.return_value = {
+                'metadata': objects.get(kind.replace('-', '_'), []),
+            }
+            return collection
+
+        def __getattr__(self, kind):
+            return self[kind]
+
+    return API()
+
+
+def lxd_desired_objects(cfg):
+    """Return the desired LXD objects for the given config as keyword args
+    suitable to be passed to make_lxd_api.
+    """
+    return {
+        kind.replace('-', '_'): objects
+        for kind, objects in jujushell._lxd_desired_state(cfg)
+    }
+
+
+@patch('charmhelpers.core.hookenv.log')
+@patch('charmhelpers.core.hookenv.status_set')
 class TestSetupLXD(unittest.TestCase):
 
-    def test_not_initialized(self, mock_log):
+    def test_setup_lxd(self, mock_status_set, mock_log):
+        # LXD is reconciled after being ready.
         with patch('jujushell._lxd_client') as mock_client:
-            mock_client().networks.all.return_value = ()
+            mock_client().api = make_lxd_api()
             with patch('jujushell.call') as mock_call:
-                jujushell.setup_lxd()
-        self.assertEqual(2, mock_call.call_count)
+                with patch('jujushell.set_flag') as mock_set_flag:
+                    jujushell.setup_lxd({'lxd-storage-compression': 'lz4'})
         mock_call.assert_has_calls([
-            call(jujushell._LXD_INIT_COMMAND, shell=True, cwd='/'),
             call(jujushell._LXD_WAIT_COMMAND, shell=True, cwd='/'),
+            call('zfs', 'set', 'compression=lz4', 'jujushellstorage'),
         ])
+        self.assertEqual(2, mock_call.call_count)
+        for kind in ('networks', 'storage-pools', 'profiles'):
+            self.assertTrue(mock_client().api[kind].post.called)
+        mock_set_flag.assert_called_once_with('jujushell.lxd.configured')
+
+
+@patch('charmhelpers.core.hookenv.log')
+class TestReconcileLXD(unittest.TestCase):
 
-    def test_initialized(self, mock_log):
+    def reconcile(self, cfg, **objects):
+        """Reconcile LXD with the given existing objects.
+
+        Return the changes and the mock LXD API.
+        """
+        api = make_lxd_api(**objects)
         with patch('jujushell._lxd_client') as mock_client:
-            net = Mock()
-            net.name = 'jujushellbr0'
-            mock_client().networks.all.return_value = [net]
-            with patch('jujushell.call') as mock_call:
-                jujushell.setup_lxd()
+            mock_client().api = api
+            changes = jujushell.reconcile_lxd(cfg)
+        return changes, api
+
+    def test_nothing_exists(self, mock_log):
+        # All objects are created in order.
+        changes, api = self.reconcile({})
+        self.assertEqual((
+            ('create', 'networks', 'jujushellbr0'),
+            ('create', 'storage-pools', 'jujushellstorage'),
+            ('create', 'profiles', 'termserver'),
+            ('create', 'profiles', 'termserver-limited'),
+            ('create', 'profiles', 'limited-termserver'),
+        ), changes)
+        desired = lxd_desired_objects({})
+        for kind in ('networks', 'storage-pools', 'profiles'):
+            api[kind].get.assert_called_once_with(params={'recursion': 1})
+            api[kind].post.assert_has_calls([
+                call(json=jujushell._lxd_strip(obj))
+                for obj in desired[kind.replace('-', '_')]])
+        # Empty values are not included when creating objects.
+        api['networks'].post.assert_called_once_with(json={
+            'name': 'jujushellbr0',
+            'type': 'bridge',
+            'config': {
+                'ipv4.address': 'auto',
+                'ipv6.address': 'none',
+            },
+        })
+
+    def test_nothing_changed(self, mock_log):
+        # No changes are applied when the current state is the desired one.
+        objects = lxd_desired_objects({})
+        # Values only used at creation time are ignored.
+        objects['networks'][0]['config']['ipv4.address'] = '10.0.3.1/24'
+        # Additional keys and devices are ignored.
+        objects['profiles'][0]['config'] = {'limits.cpu': '1'}
+        objects['profiles'][0]['devices']['root']['size'] = '10GB'
+        changes, api = self.reconcile({}, **objects)
+        self.assertEqual((), changes)
+        for collection in api.values():
+            self.assertFalse(collection.post.called)
+            self.assertFalse(collection.__getitem__.called)
+
+    def test_drift_corrected(self, mock_log):
+        # Only differences are applied.
+        objects = lxd_desired_objects({})
+        objects['storage_pools'][0]['config']['zfs.clone_copy'] = 'false'
+        objects['profiles'][0]['devices']['eth0']['parent'] = 'lxdbr0'
+        objects['profiles'][0]['devices']['eth0']['limits.egress'] = '1Mbit'
+        del objects['profiles'][1]
+        changes, api = self.reconcile({}, **objects)
+        self.assertEqual((
+            ('update', 'storage-pools', 'jujushellstorage'),
+            ('update', 'profiles', 'termserver'),
+            ('create', 'profiles', 'termserver-limited'),
+        ), changes)
+        api['storage-pools'].__getitem__.assert_called_once_with(
+            'jujushellstorage')
+        api['storage-pools']['jujushellstorage'].patch.assert_called_once_with(
+            json={'config': {'zfs.clone_copy': 'true'}})
+        api['profiles']['termserver'].patch.assert_called_once_with(json={
+            'devices': {
+                'eth0': {
+                    'limits.egress': '1Mbit',
+                    'name': 'eth0',
+                    'nictype': 'bridged',
+                    'parent': 'jujushellbr0',
+                    'type': 'nic',
+                },
+            },
+        })
+
+    def test_bridge_options(self, mock_log):
+        # Bridge options are applied to existing networks.
+        objects = lxd_desired_objects({})
+        objects['networks'][0]['config'].update({
+            'ipv4.address': '10.0.3.1/24',
+            'ipv4.dhcp.ranges': '10.0.3.2-10.0.3.42',
+        })
+        changes, api = self.reconcile({
+            'lxd-bridge-dhcp-range-size': 1000,
+            'lxd-bridge-ipv4-address': '10.100.0.1/22',
+            'lxd-bridge-mtu': 1400,
+        }, **objects)
+        self.assertEqual((('update', 'networks', 'jujushellbr0'),), changes)
+        api['networks']['jujushellbr0'].patch.assert_called_once_with(json={
+            'config': {
+                'bridge.mtu': '1400',
+                'ipv4.address': '10.100.0.1/22',
+                'ipv4.dhcp.ranges': '10.100.0.2-10.100.3.233',
+            },
+        })
+
+    def test_bridge_options_unset(self, mock_log):
+        # Bridge options are unset when reset to their defaults.
+        objects = lxd_desired_objects({})
+        objects['networks'][0]['config'].update({
+            'bridge.mtu': '1400',
+            'ipv4.dhcp.ranges': '10.0.3.2-10.0.3.42',
+        })
+        changes, api = self.reconcile({}, **objects)
+        api['networks']['jujushellbr0'].patch.assert_called_once_with(json={
+            'config': {
+                'bridge.mtu': '',
+                'ipv4.dhcp.ranges': '',
+            },
+        })
+
+    def test_cache_volume(self, mock_log):
+        # The cache volume is created and mounted by termserver containers.
+        objects = lxd_desired_objects({})
+        changes, api = self.reconcile({'cache-volume-size': '2GB'}, **objects)
+        kind = 'storage-pools/jujushellstorage/volumes/custom'
+        self.assertEqual((
+            ('create', kind, 'jujushell-cache'),
+            ('update', 'profiles', 'termserver'),
+            ('update', 'profiles', 'limited-termserver'),
+        ), changes)
+        api[kind].post.assert_called_once_with(json={
+            'name': 'jujushell-cache',
+            'config': {'size': '2GB'},
+        })
+        profiles = api['profiles']
+        self.assertEqual(
+            [call('termserver'), call('limited-termserver')],
+            profiles.__getitem__.call_args_list)
+        # The same mock is returned for both profiles.
+        self.assertEqual([call(json={
+            'devices': {
+                'cache': {
+                    'path': '/var/cache/jujushell',
+                    'pool': 'jujushellstorage',
+                    'readonly': 'true',
+                    'source': 'jujushell-cache',
+                    'type': 'disk',
+                },
+            },
+        })] * 2, profiles['termserver'].patch.call_args_list)
+
+    def test_cache_volume_disabled(self, mock_log):
+        # The cache device is removed when the cache volume is disabled.
+        objects = lxd_desired_objects({'cache-volume-size': '2GB'})
+        objects['profiles'][0]['description'] = 'termserver profile'
+        objects['profiles'][0]['config'] = {'limits.cpu': '1'}
+        changes, api = self.reconcile({}, **objects)
+        self.assertEqual((
+            ('update', 'profiles', 'termserver'),
+            ('update', 'profiles', 'limited-termserver'),
+        ), changes)
+        # The same mock is returned for both profiles.
+        profile = api['profiles']['termserver']
+        self.assertFalse(profile.patch.called)
+        self.assertEqual([call(json={
+            'config': {'limits.cpu': '1'},
+            'description': 'termserver profile',
+            'devices': jujushell._termserver_devices(),
+        }), call(json={
+            'config': {},
+            'description': '',
+            'devices': jujushell._termserver_devices(),
+        })], profile.put.call_args_list)
+
+    def test_storage_options(self, mock_log):
+        # Storage options are included in the desired state.
+        changes, api = self.reconcile({
+            'lxd-storage-clone-copy': 'rebase',
+            'lxd-storage-size': '50GB',
+            'lxd-storage-use-refquota': True,
+        })
+        api['storage-pools'].post.assert_called_once_with(json={
+            'name': 'jujushellstorage',
+            'driver': 'zfs',
+            'config': {
+                'size': '50GB',
+                'volume.zfs.use_refquota': 'true',
+                'zfs.clone_copy': 'rebase',
+            },
+        })
+
+    def test_storage_source(self, mock_log):
+        # The storage pool can be created on a block device, in which case the
+        # size is ignored.
+        changes, api = self.reconcile({
+            'lxd-storage-size': '50GB',
+            'lxd-storage-source': '/dev/sdb',
+        })
+        api['storage-pools'].post.assert_called_once_with(json={
+            'name': 'jujushellstorage',
+            'driver': 'zfs',
+            'config': {
+                'source': '/dev/sdb',
+                'volume.zfs.use_refquota': 'false',
+                'zfs.clone_copy': 'true',
+            },
+        })
+
+
+class TestDHCPRange(unittest.TestCase):
+
+    def test_dhcp_range(self):
+        # The range starts right after the bridge address.
+        self.assertEqual(
+            '10.0.3.2-10.0.3.11', jujushell._dhcp_range('10.0.3.1/24', 10))
+
+    def test_truncated(self):
+        # The range is truncated if the subnet is too small.
+        self.assertEqual(
+            '10.0.3.2-10.0.3.254', jujushell._dhcp_range('10.0.3.1/24', 1000))
+
+    def test_no_room(self):
+        # A ValueError is raised if there is no room for DHCP addresses.
+        with self.assertRaises(ValueError) as ctx:
+            jujushell._dhcp_range('10.0.3.254/24', 10)
+        self.assertEqual(
+            'no room for DHCP in 10.0.3.254/24', str(ctx.exception))
+
+
+@patch('charmhelpers.core.hookenv.status_set')
+class TestPopulateCacheVolume(unittest.TestCase):
+
+    cfg = {
+        'cache-populate-command': 'juju version',
+        'cache-volume-size': '2GB',
+    }
+
+    def populate(self, cfg):
+        with patch('jujushell._lxd_client') as mock_client:
+            container = mock_client().containers.create()
+            container.status = 'Running'
+            mock_client().containers.create.reset_mock()
+            with patch('jujushell.exterminate_containers') as mock_ext:
+                with patch('jujushell.call') as mcall:
+                    jujushell.populate_cache_volume(cfg)
+        return mock_client().containers.create, container, mock_ext, mcall
+
+    def test_populate(self, mock_status_set):
+        # The command is run in a temporary container.
+        create, container, mock_ext, mock_call = self.populate(self.cfg)
+        mock_ext.assert_called_once_with(name='jujushell-cache-builder')
+        config = create.call_args[0][0]
+        self.assertEqual('jujushell-cache-builder', config['name'])
+        self.assertEqual(
+            {'type': 'image', 'alias': 'termserver'}, config['source'])
+        self.assertEqual([], config['profiles'])
+        # The cache volume is writable.
+        self.assertEqual({
+            'path': '/var/cache/jujushell',
+            'pool': 'jujushellstorage',
+            'source': 'jujushell-cache',
+            'type': 'disk',
+        }, config['devices']['cache'])
+        container.start.assert_called_once_with(wait=True)
         mock_call.assert_called_once_with(
-            jujushell._LXD_WAIT_COMMAND, shell=True, cwd='/')
+            jujushell.LXC, 'exec', 'jujushell-cache-builder', '--',
+            'sh', '-c', 'juju version')
+        container.stop.assert_called_once_with(wait=True)
+        container.delete.assert_called_once_with(wait=True)
+
+    def test_failure(self, mock_status_set):
+        # The temporary container is removed if the command fails.
+        with patch('jujushell._lxd_client') as mock_client:
+            container = mock_client().containers.create()
+            container.status = 'Running'
+            with patch('jujushell.exterminate_containers'):
+                with patch('jujushell.call', side_effect=OSError('bad')):
+                    with self.assertRaises(OSError):
+                        jujushell.populate_cache_volume(self.cfg)
+        container.stop.assert_called_once_with(wait=True)
+        container.delete.assert_called_once_with(wait=True)
+
+    def test_disabled(self, mock_status_set):
+        # Nothing happens if the cache volume is not enabled.
+        for cfg in ({}, {'cache-volume-size': '2GB'}):
+            create, _, mock_ext, mock_call = self.populate(cfg)
+            self.assertFalse(create.called)
+            self.assertFalse(mock_call.called)
+
+
+@patch('charmhelpers.core.hookenv.status_set')
+class TestUpdateLXDStorage(unittest.TestCase):
+
+    def test_compression(self, mock_status_set):
+        # ZFS compression is applied to the storage pool.
+        with patch('jujushell.call') as mock_call:
+            jujushell.update_lxd_storage({'lxd-storage-compression': 'zstd'})
+        mock_call.assert_called_once_with(
+            'zfs', 'set', 'compression=zstd', 'jujushellstorage')
+
+    def test_no_compression(self, mock_status_set):
+        # Compression is left untouched if not specified.
+        with patch('jujushell.call') as mock_call:
+            jujushell.update_lxd_storage({})
+        self.assertFalse(mock_call.called)
 
 
 class TestExterminateContainers(unittest.TestCase):
@@ -921,6 +2375,1112 @@ class TestExterminateContainers(unittest.TestCase):
         }))
 
 
+@patch('charmhelpers.core.hookenv.log')
+class TestRelaunchContainers(unittest.TestCase):
+
+    cfg = {'home-volume-size': '1GB'}
+    volumes = 'storage-pools/jujushellstorage/volumes/custom'
+
+    def setUp(self):
+        self.lxd = FakeLXD()
+        self.old = self.lxd.add_image(b'old image')
+        self.new = self.lxd.add_image(b'new image', ['termserver'])
+        self.limited = self.lxd.add_image(
+            b'limited image', ['termserver-limited'])
+
+    def add_container(self, name, status='Running', image=None, **kwargs):
+        """Add a container created from the given image."""
+        kwargs.setdefault(
+            'profiles', ['default', 'termserver', 'termserver-limited'])
+        return self.lxd.add_container(name, status, config={
+            'limits.memory': '1GB',
+            'volatile.base_image': image or self.old,
+        }, **kwargs)
+
+    def relaunch(self, **kwargs):
+        """Relaunch containers and return the result and the calls to lxc."""
+        with patch('jujushell._lxd_client', self.lxd.client):
+            with patch('jujushell.call') as mock_call:
+                result = jujushell.relaunch_containers(self.cfg, **kwargs)
+        return result, mock_call
+
+    def test_relaunch(self, mock_log):
+        # Outdated containers are relaunched from the current image, and their
+        # home directory is moved to a home volume.
+        self.add_container('ts-running')
+        self.add_container('ts-stopped', 'Stopped')
+        self.add_container('ts-current', image=self.new)
+        result, mock_call = self.relaunch()
+        self.assertEqual((('ts-running', 'ts-stopped'), {}), result)
+        containers = self.lxd.collection('containers')
+        self.assertEqual(
+            ['ts-current', 'ts-running', 'ts-stopped'], sorted(containers))
+        running = containers['ts-running']
+        self.assertEqual('Running', running['status'])
+        self.assertEqual({
+            'limits.memory': '1GB',
+            'volatile.base_image': self.new,
+        }, running['config'])
+        self.assertEqual(
+            ['default', 'termserver', 'termserver-limited'],
+            running['profiles'])
+        self.assertEqual({'home': {
+            'path': '/home/ubuntu',
+            'pool': 'jujushellstorage',
+            'source': 'jujushell-home-ts-running',
+            'type': 'disk',
+        }}, running['devices'])
+        self.assertEqual('Stopped', containers['ts-stopped']['status'])
+        self.assertEqual(
+            ['jujushell-home-ts-running', 'jujushell-home-ts-stopped'],
+            sorted(self.lxd.collection(self.volumes)))
+        mock_call.assert_any_call(
+            jujushell.LXC, 'exec', 'ts-running', '--', 'sh', '-c',
+            'cp -an /home/ubuntu/. /mnt/jujushell-home && '
+            'chown ubuntu:ubuntu /mnt/jujushell-home')
+        self.assertEqual(2, mock_call.call_count)
+
+    def test_existing_home_volume(self, mock_log):
+        # Home directories are not copied if a home volume is already used.
+        device = {
+            'path': '/home/ubuntu',
+            'pool': 'jujushellstorage',
+            'source': 'jujushell-home-ts-1',
+            'type': 'disk',
+        }
+        self.add_container('ts-1', devices={'home': device})
+        result, mock_call = self.relaunch()
+        self.assertEqual((('ts-1',), {}), result)
+        self.assertFalse(mock_call.called)
+        container = self.lxd.collection('containers')['ts-1']
+        self.assertEqual({'home': device}, container['devices'])
+
+    def test_home_volumes_disabled(self, mock_log):
+        # Home directories are left in place if home volumes are disabled.
+        self.cfg = {'home-volume-size': ''}
+        self.add_container('ts-1')
+        result, mock_call = self.relaunch()
+        self.assertEqual((('ts-1',), {}), result)
+        self.assertFalse(mock_call.called)
+        self.assertEqual({}, self.lxd.collection(self.volumes))
+        container = self.lxd.collection('containers')['ts-1']
+        self.assertEqual({}, container['devices'])
+
+    def test_limited(self, mock_log):
+        # Containers are relaunched from the limited image when the limited
+        # termserver is in use.
+        self.cfg = dict(self.cfg, **{'limit-termserver': True})
+        limited = ['default', 'limited-termserver', 'termserver-limited']
+        self.add_container('ts-1', profiles=limited, devices={'home': {}})
+        self.add_container('ts-2', profiles=limited, image=self.limited)
+        self.add_container(
+            'ts-3', image=self.limited, devices={'home': {}})
+        result, _ = self.relaunch()
+        self.assertEqual((('ts-1', 'ts-3'), {}), result)
+        containers = self.lxd.collection('containers')
+        for name in ('ts-1', 'ts-3'):
+            container = containers[name]
+            self.assertEqual(
+                self.limited, container['config']['volatile.base_image'])
+            self.assertEqual(limited, container['profiles'])
+
+    def test_full_with_limited_profile(self, mock_log):
+        # Full sessions are relaunched with the full profile, even if they were
+        # created with the limited one.
+        full = ['default', 'termserver', 'termserver-limited']
+        limited = ['default', 'limited-termserver', 'termserver-limited']
+        self.add_container('ts-1', profiles=limited, devices={'home': {}})
+        self.add_container(
+            'ts-2', profiles=limited, image=self.new, devices={'home': {}})
+        self.add_container('ts-3', profiles=full, image=self.new)
+        result, _ = self.relaunch()
+        self.assertEqual((('ts-1', 'ts-2'), {}), result)
+        containers = self.lxd.collection('containers')
+        for name in ('ts-1', 'ts-2'):
+            container = containers[name]
+            self.assertEqual(
+                self.new, container['config']['volatile.base_image'])
+            self.assertEqual(full, container['profiles'])
+
+    def test_image_not_found(self, mock_log):
+        # Nothing is relaunched if the termserver image is not available.
+        self.lxd = FakeLXD()
+        self.lxd.add_container('ts-1', 'Running', config={})
+        result, mock_call = self.relaunch()
+        self.assertEqual(((), {}), result)
+        self.assertEqual(0, self.lxd.count('POST'))
+
+    def test_rollback(self, mock_log):
+        # Containers which cannot be relaunched are restored.
+        self.add_container('ts-bad')
+        self.add_container('ts-good')
+        self.lxd.fail['ts-bad'] = None
+        result, _ = self.relaunch(concurrency=1)
+        relaunched, failed = result
+        self.assertEqual(('ts-good',), relaunched)
+        self.assertEqual(['ts-bad'], list(failed))
+        container = self.lxd.collection('containers')['ts-bad']
+        self.assertEqual('Running', container['status'])
+        self.assertEqual(self.old, container['config']['volatile.base_image'])
+        # The temporary device used to move the home directory is removed.
+        self.assertEqual({}, container['devices'])
+        self.assertEqual(
+            ['ts-bad', 'ts-good'],
+            sorted(self.lxd.collection('containers')))
+        # The snapshot is removed, so that the container can be relaunched
+        # again, reusing its home volume.
+        self.assertEqual({}, container['snapshots'])
+        del self.lxd.fail['ts-bad']
+        result, _ = self.relaunch()
+        self.assertEqual((('ts-bad',), {}), result)
+        self.assertEqual(
+            ['jujushell-home-ts-bad', 'jujushell-home-ts-good'],
+            sorted(self.lxd.collection(self.volumes)))
+
+    def test_rollback_after_start(self, mock_log):
+        # New containers are removed if they cannot be started.
+        self.add_container('ts-1', devices={'home': {}})
+        self.lxd.fail['ts-1'] = 'Running'
+        with self.assertRaises(pylxd.exceptions.LXDAPIException):
+            with patch('jujushell._lxd_client', self.lxd.client):
+                jujushell._relaunch_container(
+                    self.cfg, self.lxd.collection('containers')['ts-1'],
+                    'termserver', ['default', 'termserver'])
+        container = self.lxd.collection('containers')['ts-1']
+        self.assertEqual('Stopped', container['status'])
+        self.assertEqual(self.old, container['config']['volatile.base_image'])
+        self.assertEqual(['ts-1'], list(self.lxd.collection('containers')))
+
+    def test_name(self, mock_log):
+        # A single container can be relaunched.
+        self.add_container('ts-1')
+        self.add_container('ts-2')
+        result, _ = self.relaunch(name='ts-2', dry=True)
+        self.assertEqual((('ts-2',), {}), result)
+
+    def test_dry(self, mock_log):
+        # Containers are not relaunched in dry mode.
+        self.add_container('ts-1')
+        self.add_container('jujushell-cache-builder')
+        result, mock_call = self.relaunch(dry=True)
+        self.assertEqual((('ts-1',), {}), result)
+        self.assertFalse(mock_call.called)
+        self.assertEqual(0, self.lxd.count('POST'))
+
+
+class TestUnitCapacity(unittest.TestCase):
+
+    def capacity(self, cfg, containers, memory=4 * 1024 ** 3):
+        with patch('jujushell._lxd_client') as mock_client:
+            mock_client().api.containers.get().json.return_value = {
+                'metadata': ['/1.0/containers/c{}'.format(i)
+                             for i in range(containers)],
+            }
+            with patch('jujushell._host_memory', return_value=memory):
+                return jujushell.unit_capacity(cfg)
+
+    def test_max_containers(self):
+        # The maximum number of containers can be provided.
+        capacity = self.capacity({'max-containers': 10}, 3)
+        self.assertEqual({
+            'containers': 3,
+            'free-slots': 7,
+            'max-containers': 10,
+        }, capacity)
+
+    def test_derived_from_memory(self):
+        # The maximum number of containers is derived from the host memory.
+        capacity = self.capacity({'lxc-quota-ram': '512MiB'}, 3)
+        self.assertEqual({
+            'containers': 3,
+            'free-slots': 5,
+            'max-containers': 8,
+        }, capacity)
+
+    def test_derived_from_limited_memory(self):
+        # The memory quota of limited containers is used when the limited
+        # termserver is in use.
+        capacity = self.capacity({
+            'limit-termserver': True,
+            'lxc-quota-ram': '512MiB',
+            'limited-lxc-quota-ram': '128MiB',
+        }, 3)
+        self.assertEqual(32, capacity['max-containers'])
+
+    def test_full(self):
+        # There are no free slots when the unit is full.
+        capacity = self.capacity({'max-containers': 2}, 3)
+        self.assertEqual(0, capacity['free-slots'])
+
+    def test_containers_provided(self):
+        # LXD is not queried if the number of containers is provided.
+        with patch('jujushell._lxd_client') as mock_client:
+            capacity = jujushell.unit_capacity(
+                {'max-containers': 10}, containers=4)
+        self.assertFalse(mock_client.called)
+        self.assertEqual(6, capacity['free-slots'])
+
+
+@patch('charmhelpers.core.hookenv.local_unit', lambda: 'jujushell/1')
+@patch('charmhelpers.core.hookenv.unit_private_ip', lambda: '10.0.0.1')
+class TestPublishCapacity(unittest.TestCase):
+
+    capacity = {'containers': 3, 'free-slots': 7, 'max-containers': 10}
+
+    def test_publish_capacity(self):
+        # The capacity is published on the peer and website relations.
+        relation_ids = {'cluster': ['cluster:0'], 'website': ['website:1']}
+        with patch('jujushell.unit_capacity', return_value=self.capacity):
+            with patch('charmhelpers.core.hookenv.relation_ids',
+                       relation_ids.get):
+                with patch('charmhelpers.core.hookenv.relation_set') as rset:
+                    capacity = jujushell.publish_capacity(
+                        {'port': 8047, 'tls': False})
+        self.assertEqual(self.capacity, capacity)
+        self.assertEqual(2, rset.call_count)
+        rset.assert_any_call(relation_id='cluster:0', relation_settings={
+            'address': '10.0.0.1',
+            'containers': '3',
+            'free-slots': '7',
+            'max-containers': '10',
+            'port': '8047',
+        })
+        rset.assert_any_call(relation_id='website:1', relation_settings={
+            'services': jujushell.website_services(
+                '10.0.0.1', 8047, self.capacity),
+        })
+
+    def test_website_services(self):
+        # Clients are balanced with a consistent hash of their address, and
+        # the unit is weighted by its free slots.
+        services = yaml.safe_load(
+            jujushell.website_services('10.0.0.1', 8047, self.capacity))
+        self.assertEqual(1, len(services))
+        service = services[0]
+        self.assertEqual('jujushell', service['service_name'])
+        self.assertEqual(8047, service['service_port'])
+        self.assertIn('balance source', service['service_options'])
+        self.assertIn('hash-type consistent', service['service_options'])
+        self.assertEqual(
+            [['jujushell-1', '10.0.0.1', 8047, 'check weight 7']],
+            service['servers'])
+
+
+class TestClusterCapacity(unittest.TestCase):
+
+    def test_cluster_capacity(self):
+        # The capacity published by peers is returned.
+        data = {
+            'jujushell/1': {
+                'address': '10.0.0.1',
+                'containers': '3',
+                'free-slots': '7',
+                'max-containers': '10',
+                'port': '8047',
+            },
+            # Units not publishing their capacity yet are ignored.
+            'jujushell/2': {},
+        }
+        with patch('charmhelpers.core.hookenv.relation_ids',
+                   return_value=['cluster:0']):
+            with patch('charmhelpers.core.hookenv.related_units',
+                       return_value=['jujushell/1', 'jujushell/2']):
+                with patch('charmhelpers.core.hookenv.relation_get',
+                           lambda unit, rid: data[unit]):
+                    capacity = jujushell.cluster_capacity()
+        self.assertEqual({
+            'jujushell/1': {
+                'address': '10.0.0.1',
+                'containers': 3,
+                'free-slots': 7,
+                'max-containers': 10,
+                'port': 8047,
+            },
+        }, capacity)
+
+
+@patch('charmhelpers.core.hookenv.log')
+class TestReconcileHomeVolumes(unittest.TestCase):
+
+    cfg = {
+        'home-volume-expiry': 2,
+        'home-volume-path': '/home/ubuntu',
+        'home-volume-size': '1GB',
+    }
+    kind = 'storage-pools/jujushellstorage/volumes/custom'
+    now = 1000000
+
+    def reconcile(self, cfg, containers=(), volumes=(), owned=(), used=(),
+                  error=None):
+        """Reconcile home volumes with the given containers and volumes.
+
+        Containers are provided as (name, status, devices) tuples, with the
+        names of the containers which have already run in used, volumes as
+        (name, last-used) tuples, with the names of the volumes already owned
+        by the ubuntu user in owned. Running commands fails with the given
+        error if provided. Return the result, the mock LXD API and the mock
+        used to run commands.
+        """
+        api = make_lxd_api(containers=[{
+            'name': name,
+            'status': status,
+            'devices': devices,
+            'profiles': ['default'],
+            'last_used_at': (
+                '2017-10-30T12:00:00Z' if name in used else
+                '0001-01-01T00:00:00Z'),
+        } for name, status, devices in containers])
+        api[self.kind].get().json.return_value = {'metadata': [{
+            'name': name,
+            'config': dict({'user.jujushell.last-used': last_used}, **(
+                {'user.jujushell.owned': 'true'} if name in owned else {})),
+        } for name, last_used in volumes]}
+
+        def get(name):
+            container = MagicMock()
+            container.name = name
+            return container
+
+        with patch('jujushell._lxd_client') as mock_client:
+            mock_client().api = api
+            mock_client().containers.get.side_effect = get
+            with patch('jujushell.call', side_effect=error) as mock_call:
+                result = jujushell.reconcile_home_volumes(cfg, now=self.now)
+        return result, api, mock_call
+
+    def test_attach_new_volume(self, mock_log):
+        # A volume is created and attached to stopped containers which have
+        # never run, so that live home directories are never hidden.
+        result, api, mock_call = self.reconcile(self.cfg, containers=[
+            ('ts-who', 'Stopped', {}),
+            ('ts-running', 'Running', {}),
+            ('ts-frozen', 'Frozen', {}),
+            ('ts-stopping', 'Stopping', {}),
+        ])
+        self.assertEqual((('ts-who',), ()), result)
+        api[self.kind].post.assert_called_once_with(json={
+            'name': 'jujushell-home-ts-who',
+            'config': {'size': '1GB'},
+        })
+        api.containers.__getitem__.assert_called_once_with('ts-who')
+        api.containers['ts-who'].patch.assert_called_once_with(json={
+            'devices': {'home': {
+                'path': '/home/ubuntu',
+                'pool': 'jujushellstorage',
+                'source': 'jujushell-home-ts-who',
+                'type': 'disk',
+            }},
+        })
+        # The volume cannot be handed to the user until the container runs.
+        self.assertFalse(mock_call.called)
+        # The volume usage is recorded.
+        api[self.kind]['jujushell-home-ts-who'].patch.assert_called_once_with(
+            json={'config': {'user.jujushell.last-used': '1000000'}})
+
+    def test_move_home(self, mock_log):
+        # The home directory of containers which have already run is copied
+        # into the volume before mounting it.
+        result, api, mock_call = self.reconcile(
+            self.cfg, containers=[('ts-who', 'Stopped', {'eth0': {}})],
+            used=['ts-who'])
+        self.assertEqual((('ts-who',), ()), result)
+        mock_call.assert_called_once_with(
+            jujushell.LXC, 'exec', 'ts-who', '--', 'sh', '-c',
+            'cp -an /home/ubuntu/. /mnt/jujushell-home && '
+            'chown ubuntu:ubuntu /mnt/jujushell-home')
+        self.assertFalse(api[self.kind].post.called)
+        # The container is stopped again, and the temporary device is
+        # replaced with the home device.
+        api.containers['ts-who'].put.assert_called_once_with(json={
+            'devices': {
+                'eth0': {},
+                'home': {
+                    'path': '/home/ubuntu',
+                    'pool': 'jujushellstorage',
+                    'source': 'jujushell-home-ts-who',
+                    'type': 'disk',
+                },
+            },
+            'profiles': ['default'],
+        })
+        api[self.kind]['jujushell-home-ts-who'].patch.assert_called_once_with(
+            json={'config': {'user.jujushell.last-used': '1000000'}})
+
+    def test_move_home_failure(self, mock_log):
+        # Failures moving home directories are logged and retried later.
+        result, api, _ = self.reconcile(
+            self.cfg, containers=[('ts-who', 'Stopped', {})],
+            used=['ts-who'], error=OSError('bad wolf'))
+        self.assertEqual(((), ()), result)
+        self.assertFalse(api.containers['ts-who'].put.called)
+        mock_log.assert_any_call(
+            'cannot move home directory of container ts-who: bad wolf')
+
+    def test_reuse_volume(self, mock_log):
+        # Existing volumes are attached to new containers for the same user.
+        last_used = str(self.now - 60)
+        result, api, _ = self.reconcile(
+            self.cfg, containers=[('ts-who', 'Stopped', {})],
+            volumes=[('jujushell-home-ts-who', last_used)])
+        self.assertEqual((('ts-who',), ()), result)
+        self.assertFalse(api[self.kind].post.called)
+        self.assertTrue(api.containers['ts-who'].patch.called)
+        # The volume usage has been recorded recently.
+        self.assertFalse(api[self.kind]['jujushell-home-ts-who'].patch.called)
+
+    def test_own_volume(self, mock_log):
+        # New volumes are handed to the ubuntu user once their container runs.
+        home = {'source': 'jujushell-home-ts-who'}
+        result, api, mock_call = self.reconcile(
+            self.cfg, containers=[('ts-who', 'Running', {'home': home})],
+            volumes=[('jujushell-home-ts-who', str(self.now))])
+        self.assertEqual(((), ()), result)
+        mock_call.assert_called_once_with(
+            jujushell.LXC, 'exec', 'ts-who', '--',
+            'chown', 'ubuntu:ubuntu', '/home/ubuntu')
+        api[self.kind]['jujushell-home-ts-who'].patch.assert_called_once_with(
+            json={'config': {'user.jujushell.owned': 'true'}})
+        self.assertFalse(api.containers['ts-who'].patch.called)
+
+    def test_own_volume_failure(self, mock_log):
+        # Failures changing the volume owner, for instance because the
+        # container is being stopped, are logged and retried later.
+        home = {'source': 'jujushell-home-ts-who'}
+        result, api, _ = self.reconcile(
+            self.cfg, containers=[('ts-who', 'Running', {'home': home})],
+            volumes=[('jujushell-home-ts-who', str(self.now))],
+            error=OSError('bad wolf'))
+        self.assertEqual(((), ()), result)
+        self.assertFalse(api[self.kind]['jujushell-home-ts-who'].patch.called)
+        mock_log.assert_any_call(
+            'cannot change the owner of home volume jujushell-home-ts-who: '
+            'bad wolf')
+
+    def test_already_attached(self, mock_log):
+        # Containers with a home device owned by the user are left alone.
+        home = {'source': 'jujushell-home-ts-who'}
+        result, api, mock_call = self.reconcile(
+            self.cfg, containers=[('ts-who', 'Running', {'home': home})],
+            volumes=[('jujushell-home-ts-who', str(self.now))],
+            owned=['jujushell-home-ts-who'])
+        self.assertEqual(((), ()), result)
+        self.assertFalse(api.containers['ts-who'].patch.called)
+        self.assertFalse(mock_call.called)
+
+    def test_remove_idle_volumes(self, mock_log):
+        # Volumes without a container are removed when idle for too long.
+        day = 24 * 60 * 60
+        result, api, _ = self.reconcile(self.cfg, volumes=[
+            ('jujushell-home-ts-old', str(self.now - 3 * day)),
+            ('jujushell-home-ts-new', str(self.now - day)),
+            ('jujushell-cache', ''),
+        ])
+        self.assertEqual(((), ('jujushell-home-ts-old',)), result)
+        volumes = api[self.kind]
+        volumes.__getitem__.assert_called_once_with('jujushell-home-ts-old')
+        volumes['jujushell-home-ts-old'].delete.assert_called_once_with()
+
+    def test_disabled(self, mock_log):
+        # Volumes are not provisioned if no size is specified, but idle
+        # volumes are still removed.
+        cfg = {'home-volume-expiry': 1}
+        result, api, _ = self.reconcile(
+            cfg, containers=[('ts-who', 'Running', {})],
+            volumes=[('jujushell-home-ts-old', '1')])
+        self.assertEqual(((), ('jujushell-home-ts-old',)), result)
+        self.assertFalse(api[self.kind].post.called)
+
+    def test_no_expiry(self, mock_log):
+        # Volumes are never removed when expiry is disabled.
+        cfg = dict(self.cfg, **{'home-volume-expiry': 0})
+        result, api, _ = self.reconcile(
+            cfg, volumes=[('jujushell-home-ts-old', '1')])
+        self.assertEqual(((), ()), result)
+
+
+@patch('charmhelpers.core.hookenv.log')
+class TestReapContainers(unittest.TestCase):
+
+    cfg = {'frozen-container-timeout': 10, 'stopped-container-timeout': 60}
+    now = 1000000
+
+    def reap(self, cfg, containers):
+        """Reap the given containers, provided as (name, status, state)
+        tuples. Return the actions and the mock LXD API.
+        """
+        api = make_lxd_api(containers=[{
+            'name': name,
+            'status': status,
+            'config': {'user.jujushell.state-since': state} if state else {},
+        } for name, status, state in containers])
+        with patch('jujushell._lxd_client') as mock_client:
+            mock_client().api = api
+            actions = jujushell.reap_containers(cfg, now=self.now)
+        return actions, api
+
+    def test_record_states(self, mock_log):
+        # The time at which containers change state is recorded.
+        actions, api = self.reap(self.cfg, [
+            ('ts-frozen', 'Frozen', ''),
+            ('ts-stopped', 'Stopped', 'frozen:1'),
+            ('ts-running', 'Running', ''),
+        ])
+        self.assertEqual((), actions)
+        api.containers.__getitem__.assert_has_calls([
+            call('ts-frozen'), call().patch(json={'config': {
+                'user.jujushell.state-since': 'frozen:1000000'}}),
+            call('ts-stopped'), call().patch(json={'config': {
+                'user.jujushell.state-since': 'stopped:1000000'}}),
+        ])
+        self.assertEqual(2, api.containers.__getitem__.call_count)
+
+    def test_tiers(self, mock_log):
+        # Frozen containers are stopped and stopped ones are removed after
+        # their timeouts.
+        actions, api = self.reap(self.cfg, [
+            ('ts-frozen-old', 'Frozen', 'frozen:{}'.format(self.now - 600)),
+            ('ts-frozen-new', 'Frozen', 'frozen:{}'.format(self.now - 599)),
+            ('ts-stopped-old', 'Stopped',
+             'stopped:{}'.format(self.now - 3600)),
+            ('ts-stopped-new', 'Stopped', 'stopped:{}'.format(self.now - 1)),
+        ])
+        self.assertEqual(
+            (('stop', 'ts-frozen-old'), ('delete', 'ts-stopped-old')),
+            actions)
+        api.containers.__getitem__.assert_has_calls([
+            call('ts-frozen-old'),
+            call().state.put(json={'action': 'stop', 'force': True}),
+            call('ts-stopped-old'), call().delete(),
+        ])
+
+    def test_disabled_tier(self, mock_log):
+        # Containers are not removed if the stopped tier is disabled.
+        cfg = {'frozen-container-timeout': 10}
+        actions, api = self.reap(cfg, [
+            ('ts-stopped', 'Stopped', 'stopped:1'),
+            ('jujushell-cache-builder', 'Frozen', 'frozen:1'),
+        ])
+        self.assertEqual((), actions)
+        self.assertFalse(api.containers.__getitem__.called)
+
+    def test_disabled(self, mock_log):
+        # LXD is not queried if all tiers are disabled.
+        with patch('jujushell._lxd_client') as mock_client:
+            self.assertEqual((), jujushell.reap_containers({}))
+        self.assertFalse(mock_client.called)
+
+
+class TestMemoryPressure(unittest.TestCase):
+
+    def write(self, content):
+        """Write the given pressure stall information to a file and return
+        its path.
+        """
+        f = tempfile.NamedTemporaryFile('w')
+        self.addCleanup(f.close)
+        f.write(content)
+        f.flush()
+        return f.name
+
+    def test_pressure(self):
+        # The pressure is the average "some" stall time in 10 seconds.
+        path = self.write(
+            'some avg10=12.50 avg60=3.00 avg300=1.00 total=4242\n'
+            'full avg10=1.00 avg60=0.50 avg300=0.10 total=42\n')
+        self.assertEqual(12.5, jujushell.memory_pressure(path))
+
+    def test_not_available(self):
+        # None is returned if pressure stall information is not available.
+        self.assertIsNone(jujushell.memory_pressure('/no/such/file'))
+        self.assertIsNone(jujushell.memory_pressure(self.write('bad\n')))
+
+
+@patch('charmhelpers.core.hookenv.log')
+class TestRelieveMemoryPressure(unittest.TestCase):
+
+    cfg = {'memory-pressure-threshold': 10, 'memory-pressure-batch': 2}
+    now = 1000000
+
+    def setUp(self):
+        self.charm_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.charm_dir)
+        os.mkdir(os.path.join(self.charm_dir, 'files'))
+        patcher = patch(
+            'charmhelpers.core.hookenv.charm_dir',
+            return_value=self.charm_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        f = tempfile.NamedTemporaryFile('w')
+        self.addCleanup(f.close)
+        f.write('some avg10=20.00 avg60=5.00 avg300=1.00 total=1\n')
+        f.flush()
+        self.path = f.name
+
+    def relieve(self, cfg, containers):
+        """Relieve memory pressure with the given containers, provided as
+        (name, status, started, cpu, memory) tuples. Return the actions and
+        a dict mapping container names to their mock API nodes.
+        """
+        api = make_lxd_api(containers=[{
+            'name': name,
+            'status': status,
+            'last_used_at': started,
+        } for name, status, started, _, _ in containers])
+        nodes = {}
+        for name, _, _, cpu, memory in containers:
+            node = nodes[name] = MagicMock()
+            node.state.get.return_value.json.return_value = {'metadata': {
+                'cpu': {'usage': cpu}, 'memory': {'usage': memory}}}
+        api.containers.__getitem__.side_effect = nodes.__getitem__
+        with patch('jujushell._lxd_client') as mock_client:
+            mock_client().api = api
+            actions = jujushell.relieve_memory_pressure(
+                cfg, now=self.now, path=self.path)
+        return actions, nodes
+
+    def test_freeze_idle_containers(self, mock_log):
+        # The most idle running containers are frozen.
+        started = '1970-01-12T13:45:40Z'  # 1000 seconds before now.
+        actions, nodes = self.relieve(self.cfg, [
+            ('ts-busy', 'Running', started, 9000, 1),
+            ('ts-idle-small', 'Running', started, 1000, 1),
+            ('ts-idle-large', 'Running', started, 1000, 2),
+            ('ts-stopped', 'Stopped', started, 0, 0),
+            ('jujushell-cache-builder', 'Running', started, 0, 0),
+        ])
+        self.assertEqual(
+            (('freeze', 'ts-idle-large'), ('freeze', 'ts-idle-small')),
+            actions)
+        nodes['ts-idle-large'].state.put.assert_called_once_with(
+            json={'action': 'freeze'})
+        self.assertFalse(nodes['ts-busy'].state.put.called)
+        self.assertFalse(nodes['ts-stopped'].state.get.called)
+        self.assertEqual({
+            'memory_pressure': 20.0,
+            'memory_pressure_frozen_containers': 2,
+            'memory_pressure_stopped_containers': 0,
+        }, jujushell.memory_pressure_metrics())
+
+    def test_cpu_usage_over_uptime(self, mock_log):
+        # Containers are ranked by their CPU usage since they started.
+        actions, nodes = self.relieve(
+            dict(self.cfg, **{'memory-pressure-batch': 1}), [
+                ('ts-new', 'Running', '1970-01-12T13:46:30Z', 100, 1),
+                ('ts-old', 'Running', '1970-01-12T13:30:00Z', 500, 1),
+            ])
+        self.assertEqual((('freeze', 'ts-old'),), actions)
+
+    def test_stop(self, mock_log):
+        # Containers can be stopped, and statistics are accumulated.
+        cfg = dict(self.cfg, **{'memory-pressure-action': 'stop'})
+        containers = [('ts-1', 'Running', '', 0, 0)]
+        self.relieve(cfg, containers)
+        actions, nodes = self.relieve(cfg, containers)
+        self.assertEqual((('stop', 'ts-1'),), actions)
+        nodes['ts-1'].state.put.assert_called_once_with(
+            json={'action': 'stop', 'force': True})
+        stats = jujushell.memory_pressure_stats()
+        self.assertEqual(2, stats['stopped'])
+
+    def test_below_threshold(self, mock_log):
+        # Nothing is done if the pressure is below the threshold, but the
+        # pressure is still recorded.
+        cfg = dict(self.cfg, **{'memory-pressure-threshold': 20.5})
+        with patch('jujushell._lxd_client') as mock_client:
+            actions = jujushell.relieve_memory_pressure(cfg, path=self.path)
+        self.assertEqual((), actions)
+        self.assertFalse(mock_client.called)
+        self.assertEqual(20, jujushell.memory_pressure_stats()['pressure'])
+
+    def test_disabled(self, mock_log):
+        # LXD is not queried if the threshold is not set.
+        with patch('jujushell._lxd_client') as mock_client:
+            actions = jujushell.relieve_memory_pressure({}, path=self.path)
+        self.assertEqual((), actions)
+        self.assertFalse(mock_client.called)
+
+    def test_invalid_action(self, mock_log):
+        # An error is raised if the action is not valid.
+        cfg = dict(self.cfg, **{'memory-pressure-action': 'bad'})
+        with self.assertRaises(ValueError) as ctx:
+            jujushell.relieve_memory_pressure(cfg, path=self.path)
+        self.assertEqual(
+            'invalid memory pressure action: bad', str(ctx.exception))
+
+    def test_no_stats(self, mock_log):
+        # Default statistics are returned if none have been stored.
+        self.assertEqual({
+            'memory_pressure': 0,
+            'memory_pressure_frozen_containers': 0,
+            'memory_pressure_stopped_containers': 0,
+        }, jujushell.memory_pressure_metrics())
+
+
+class TestRunningStatus(unittest.TestCase):
+
+    def test_no_actions(self):
+        self.assertEqual('jujushell running', jujushell.running_status())
+
+    def test_actions(self):
+        # Frozen and stopped containers are reported separately.
+        self.assertEqual(
+            'jujushell running (memory pressure: 2 containers frozen, '
+            '1 container stopped)',
+            jujushell.running_status((
+                ('freeze', 'ts-1'), ('stop', 'ts-2'), ('freeze', 'ts-3'))))
+
+    def test_only_frozen(self):
+        # Containers are not reported as stopped when only frozen.
+        self.assertEqual(
+            'jujushell running (memory pressure: 1 container frozen)',
+            jujushell.running_status((('freeze', 'ts-1'),)))
+
+    def test_cluster(self):
+        # The free slots in the cluster are reported when there are peers.
+        cluster = {
+            'jujushell/0': {'free-slots': 7},
+            'jujushell/1': {'free-slots': 3},
+        }
+        self.assertEqual(
+            'jujushell running, cluster: 10 free slots on 2 units',
+            jujushell.running_status(cluster=cluster))
+        del cluster['jujushell/1']
+        self.assertEqual(
+            'jujushell running', jujushell.running_status(cluster=cluster))
+
+
+class TestContainerInventory(unittest.TestCase):
+
+    def test_container_inventory(self):
+        # The inventory is retrieved with a single API call.
+        containers = [{
+            'name': 'c1',
+            'status': 'Running',
+            'created_at': '2018-05-01T10:00:00.123456789Z',
+            'last_used_at': '2018-05-02T10:00:00+02:00',
+        }, {
+            'name': 'c2',
+            'status': 'Stopped',
+            'created_at': '2018-05-01T10:00:00Z',
+            'last_used_at': '1970-01-01T00:00:00Z',
+        }]
+        with patch('jujushell._lxd_client') as mock_client:
+            api = mock_client().api
+            api.containers.get.return_value.json.return_value = {
+                'metadata': containers}
+            inventory = jujushell.container_inventory()
+        api.containers.get.assert_called_once_with(params={'recursion': 1})
+        self.assertEqual(({
+            'name': 'c1',
+            'status': 'Running',
+            'created': 1525168800,
+            'last-used': 1525248000,
+        }, {
+            'name': 'c2',
+            'status': 'Stopped',
+            'created': 1525168800,
+            'last-used': 0,
+        }), inventory)
+
+
+class TestParseTimestamp(unittest.TestCase):
+
+    tests = [
+        (None, 0),
+        ('0001-01-01T00:00:00Z', 0),
+        ('2018-05-01T10:00:00Z', 1525168800),
+        ('2018-05-01T10:00:00.123Z', 1525168800),
+        ('2018-05-01T12:00:00.123456789+02:00', 1525168800),
+        ('2018-05-01T08:30:00-01:30', 1525168800),
+    ]
+
+    def test_parse_timestamp(self):
+        for value, want in self.tests:
+            with self.subTest(value):
+                self.assertEqual(want, jujushell._parse_timestamp(value))
+
+
+class TestInventoryRelation(unittest.TestCase):
+
+    inventory = ({
+        'name': 'c1',
+        'status': 'Running',
+        'created': 1525168800,
+        'last-used': 1525248000,
+    },)
+
+    def test_publish_and_retrieve(self):
+        # The inventory published by a unit can be retrieved by its peers.
+        with patch('jujushell.container_inventory',
+                   return_value=self.inventory):
+            with patch('charmhelpers.core.hookenv.relation_ids',
+                       return_value=['cluster:0']):
+                with patch('charmhelpers.core.hookenv.relation_set') as rset:
+                    inventory = jujushell.publish_inventory()
+        self.assertEqual(self.inventory, inventory)
+        data = rset.call_args[1]['relation_settings']
+        self.assertEqual(
+            '[["c1","Running",1525168800,1525248000]]', data['inventory'])
+        data = {'jujushell/1': data['inventory'], 'jujushell/2': None}
+        with patch('charmhelpers.core.hookenv.relation_ids',
+                   return_value=['cluster:0']):
+            with patch('charmhelpers.core.hookenv.related_units',
+                       return_value=['jujushell/1', 'jujushell/2']):
+                with patch('charmhelpers.core.hookenv.relation_get',
+                           lambda attribute, unit, rid: data[unit]):
+                    inventories = jujushell.cluster_inventory()
+        self.assertEqual({'jujushell/1': self.inventory}, inventories)
+
+
+@patch('charmhelpers.core.hookenv.log')
+class TestInventorySnapshot(unittest.TestCase):
+
+    cfg = {'inventory-ttl': 600}
+    now = 1525248000
+    containers = (
+        {'name': 'c1', 'status': 'Running', 'created': 1, 'last-used': 2},
+        {'name': 'c2', 'status': 'Frozen', 'created': 3, 'last-used': 4},
+        {'name': 'c3', 'status': 'Running', 'created': 5, 'last-used': 6},
+    )
+
+    def setUp(self):
+        self.charm_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.charm_dir)
+        os.mkdir(os.path.join(self.charm_dir, 'files'))
+        patcher = patch(
+            'charmhelpers.core.hookenv.charm_dir',
+            return_value=self.charm_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def refresh(self, error=None):
+        """Refresh the snapshot and return it.
+
+        If provided, the given error is raised when querying the storage pool
+        resources.
+        """
+        with patch('jujushell._lxd_client') as mock_client:
+            resources = mock_client().api['storage-pools'][
+                'jujushellstorage'].resources
+            resources.get.side_effect = error
+            resources.get.return_value.json.return_value = {'metadata': {
+                'space': {'used': 1024, 'total': 4096}}}
+            mock_client().images.all.return_value = ['img1', 'img2']
+            with patch('jujushell.container_inventory',
+                       return_value=self.containers):
+                return jujushell.refresh_inventory_snapshot(
+                    self.cfg, now=self.now)
+
+    def test_refresh(self, mock_log):
+        # A snapshot is taken and stored.
+        snapshot = self.refresh()
+        expected = {
+            'containers': self.containers,
+            'disk-total': 4096,
+            'disk-used': 1024,
+            'expires': self.now + 600,
+            'images': 2,
+            'states': {'frozen': 1, 'running': 2},
+            'updated': self.now,
+        }
+        self.assertEqual(expected, snapshot)
+        self.assertEqual(
+            expected, jujushell.inventory_snapshot(now=self.now + 600))
+
+    def test_expired(self, mock_log):
+        # Expired snapshots are not returned.
+        self.refresh()
+        self.assertIsNone(jujushell.inventory_snapshot(now=self.now + 601))
+        self.assertEqual({}, jujushell.inventory_metrics(now=self.now + 601))
+
+    def test_no_snapshot(self, mock_log):
+        # None is returned if no snapshot has been taken.
+        self.assertIsNone(jujushell.inventory_snapshot())
+
+    def test_disk_not_available(self, mock_log):
+        # The disk usage is None if the storage pool cannot be queried.
+        snapshot = self.refresh(error=pylxd.exceptions.NotFound(Mock()))
+        self.assertIsNone(snapshot['disk-used'])
+        self.assertNotIn(
+            'inventory_disk_used', jujushell.inventory_metrics(now=self.now))
+
+    def test_metrics(self, mock_log):
+        # The snapshot is reported as metrics.
+        self.refresh()
+        self.assertEqual({
+            'inventory_disk_used': 1024,
+            'inventory_frozen_containers': 1,
+            'inventory_images': 2,
+            'inventory_running_containers': 2,
+            'inventory_stopped_containers': 0,
+        }, jujushell.inventory_metrics(now=self.now))
+
+
+@patch('charmhelpers.core.hookenv.log')
+@patch('charmhelpers.core.hookenv.local_unit', lambda: 'jujushell/0')
+@patch('charmhelpers.core.hookenv.relation_ids', lambda name: ['cluster:0'])
+class TestRequestClusterExterminate(unittest.TestCase):
+
+    def setUp(self):
+        self.store = {}
+        kv = Mock()
+        kv.get.side_effect = self.store.get
+        kv.set.side_effect = self.store.__setitem__
+        patcher = patch('charmhelpers.core.unitdata.kv', return_value=kv)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, **kwargs):
+        with patch('jujushell.exterminate_containers',
+                   return_value=('c0',)) as mock_exterminate:
+            with patch('charmhelpers.core.hookenv.leader_set') as lset:
+                with patch('charmhelpers.core.hookenv.relation_set'):
+                    result = jujushell.request_cluster_exterminate(**kwargs)
+        mock_exterminate.assert_called_once_with(**{
+            'name': None, 'only_stopped': False, 'dry': False, **kwargs})
+        return result, lset
+
+    def test_broadcast(self, mock_log):
+        # The request is sent to all units, and handled by the local one.
+        (request_id, removed), lset = self.request(only_stopped=True)
+        self.assertEqual(('c0',), removed)
+        request = json.loads(lset.call_args[0][0]['exterminate-request'])
+        self.assertEqual(32, len(request_id))
+        self.assertAlmostEqual(time.time() + 600, request.pop('expires'), -1)
+        self.assertEqual({
+            'id': request_id,
+            'name': None,
+            'only-stopped': True,
+            'dry': False,
+        }, request)
+
+    def test_dry(self, mock_log):
+        # Dry requests are also sent, so that units report what they would
+        # remove.
+        (request_id, removed), lset = self.request(name='c3', dry=True)
+        self.assertEqual(('c0',), removed)
+        request = json.loads(lset.call_args[0][0]['exterminate-request'])
+        self.assertTrue(request['dry'])
+
+    def test_results(self, mock_log):
+        # Results are reported from what each unit actually did.
+        (request_id, _), _ = self.request()
+        data = {
+            'jujushell/1': json.dumps({'id': request_id, 'removed': ['c1']}),
+            'jujushell/2': json.dumps({'id': request_id, 'error': 'boom'}),
+            'jujushell/3': json.dumps({'id': 'old', 'removed': ['c3']}),
+            'jujushell/4': None,
+        }
+        with patch('charmhelpers.core.hookenv.related_units',
+                   return_value=sorted(data)):
+            with patch('charmhelpers.core.hookenv.relation_get',
+                       lambda attribute, unit, rid: data[unit]):
+                results = jujushell.cluster_exterminate_results(request_id)
+        self.assertEqual({
+            'jujushell/0': {'removed': ('c0',)},
+            'jujushell/1': {'removed': ('c1',)},
+            'jujushell/2': {'error': 'boom'},
+            'jujushell/3': None,
+            'jujushell/4': None,
+        }, results)
+
+
+@patch('charmhelpers.core.hookenv.log')
+@patch('charmhelpers.core.hookenv.local_unit', lambda: 'jujushell/1')
+@patch('charmhelpers.core.hookenv.relation_ids', lambda name: ['cluster:0'])
+class TestHandleExterminateRequest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = {}
+        kv = Mock()
+        kv.get.side_effect = self.store.get
+        kv.set.side_effect = self.store.__setitem__
+        patcher = patch('charmhelpers.core.unitdata.kv', return_value=kv)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def handle(self, side_effect=None, **request):
+        request = dict({
+            'id': 'req1',
+            'name': None,
+            'only-stopped': True,
+            'dry': False,
+            'expires': time.time() + 60,
+        }, **request)
+        with patch('jujushell.exterminate_containers', return_value=('c1',),
+                   side_effect=side_effect) as mock_exterminate:
+            with patch('charmhelpers.core.hookenv.relation_set') as rset:
+                removed = jujushell.handle_exterminate_request(
+                    json.dumps(request))
+        return removed, mock_exterminate, rset
+
+    def test_request_handled(self, mock_log):
+        # Containers are removed as requested, only once.
+        removed, mock_exterminate, rset = self.handle()
+        self.assertEqual(('c1',), removed)
+        mock_exterminate.assert_called_once_with(
+            name=None, only_stopped=True, dry=False)
+        # The result is published on the peer relation.
+        rset.assert_called_once_with(
+            relation_id='cluster:0', relation_settings={
+                'exterminate-result': '{"id":"req1","removed":["c1"]}'})
+        removed, mock_exterminate, rset = self.handle()
+        self.assertEqual((), removed)
+        self.assertFalse(mock_exterminate.called)
+        self.assertFalse(rset.called)
+        # New requests are handled.
+        removed, mock_exterminate, _ = self.handle(
+            id='req2', name='c1', dry=True)
+        mock_exterminate.assert_called_once_with(
+            name='c1', only_stopped=True, dry=True)
+
+    def test_failure(self, mock_log):
+        # Failures are reported as results rather than raised.
+        removed, _, rset = self.handle(side_effect=OSError('bad wolf'))
+        self.assertEqual((), removed)
+        rset.assert_called_once_with(
+            relation_id='cluster:0', relation_settings={
+                'exterminate-result': '{"id":"req1","error":"bad wolf"}'})
+        self.assertEqual(
+            '{"id":"req1","error":"bad wolf"}',
+            self.store['jujushell.exterminate-result'])
+
+    def test_expired(self, mock_log):
+        # Expired requests, for instance seen by units joining later, are
+        # ignored.
+        removed, mock_exterminate, rset = self.handle(
+            expires=time.time() - 1)
+        self.assertEqual((), removed)
+        self.assertFalse(mock_exterminate.called)
+        self.assertFalse(rset.called)
+
+    def test_no_request(self, mock_log):
+        # Nothing happens if there are no requests.
+        self.assertEqual((), jujushell.handle_exterminate_request(None))
+
+
+class TestParseSize(unittest.TestCase):
+
+    tests = [
+        ('1024', 1024),
+        ('1024B', 1024),
+        ('256MB', 256 * 1000 ** 2),
+        ('256MiB', 256 * 1024 ** 2),
+        ('1.5GB', 1500 * 1000 ** 2),
+        ('2 TiB', 2 * 1024 ** 4),
+        ('10kB', 10000),
+    ]
+
+    def test_parse_size(self):
+        for value, want in self.tests:
+            with self.subTest(value):
+                self.assertEqual(want, jujushell.parse_size(value))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            jujushell.parse_size('bad-wolf')
+
+
 class TestServiceURL(unittest.TestCase):
 
     tests = [{
@@ -0,0 +1,195 @@
+# Copyright 2017 Canonical Ltd.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from lifecycle import (  # noqa: E402
+    LIFECYCLE,
+    OPERATIONS,
+    Unit,
+)
+
+
+class TestLifecycle(unittest.TestCase):
+
+    def setUp(self):
+        self.unit = Unit()
+        self.addCleanup(self.unit.close)
+
+    def run_hooks(self, *hooks):
+        """Run the given hooks and return their operation counts."""
+        results = []
+        for hook in hooks:
+            result = self.unit.run(hook)
+            results.append(
+                (hook,) + tuple(result[op] for op in OPERATIONS))
+        return results
+
+    def test_lifecycle(self):
+        # Expensive operations are only performed when required.
+        self.assertEqual(OPERATIONS, (
+            'subprocesses', 'lxd-calls', 'image-imports', 'renders',
+            'service-starts', 'service-restarts', 'service-stops'))
+        self.assertEqual([
+            ('install', 8, 15, 2, 1, 0, 1, 0),
+            ('config-changed', 0, 0, 0, 0, 0, 0, 0),
+            ('start', 0, 0, 0, 0, 1, 0, 0),
+            ('upgrade-charm', 1, 4, 0, 0, 0, 1, 0),
+            ('config-changed', 0, 0, 0, 0, 0, 0, 0),
+            ('update-status', 0, 10, 0, 0, 0, 0, 0),
+            ('stop', 0, 0, 0, 0, 0, 0, 1),
+        ], self.run_hooks(*LIFECYCLE))
+        self.assertIn('jujushell.service.installed', self.unit.flags())
+        self.assertNotIn('jujushell.running', self.unit.flags())
+
+    def test_config_changed(self):
+        # Changing the config restarts the service once, without importing
+        # images or installing the service again.
+        self.run_hooks('install', 'config-changed', 'start')
+        result = self.unit.run('config-changed', log_level='debug')
+        self.assertEqual(1, result['service-restarts'])
+        self.assertEqual(0, result['image-imports'])
+        self.assertEqual(0, result['renders'])
+
+    def test_config_changed_without_server_changes(self):
+        # The service is not restarted if the server config does not change.
+        unit = Unit(config={'tls': False})
+        self.addCleanup(unit.close)
+        for hook in ('install', 'config-changed', 'start'):
+            unit.run(hook)
+        result = unit.run('config-changed', lxc_quota_ram='1GB')
+        self.assertEqual(0, result['service-restarts'])
+        profile = unit.lxd.objects['profiles']['termserver']
+        self.assertEqual('1GB', profile['config']['limits.memory'])
+
+    def test_reserved_cpus_changed(self):
+        # The service is installed again when reserved CPUs change.
+        self.run_hooks('install', 'config-changed', 'start')
+        result = self.unit.run('config-changed', jujushell_reserved_cpus=1)
+        self.assertEqual(1, result['renders'])
+        self.assertEqual(1, result['service-restarts'])
+
+    def test_service_options_changed(self):
+        # The systemd unit is reloaded and the service restarted only if the
+        # unit changes.
+        self.run_hooks('install', 'config-changed', 'start')
+        result = self.unit.run('config-changed', service_limit_nofile=1024)
+        self.assertEqual(1, result['renders'])
+        self.assertEqual(2, result['subprocesses'])
+        self.assertEqual(1, result['service-restarts'])
+        with open(os.path.join(self.unit.dir, 'jujushell.service')) as f:
+            self.assertIn("('limit_nofile', 1024)", f.read())
+        # Delays below one second are rounded up, so the unit does not
+        # change.
+        self.unit.run('config-changed', service_restart_delay=1)
+        result = self.unit.run('config-changed', service_restart_delay=0)
+        self.assertEqual(1, result['renders'])
+        self.assertEqual(0, result['subprocesses'])
+        self.assertEqual(0, result['service-restarts'])
+
+    def test_upgrade_with_new_image(self):
+        # Only the changed image is imported when upgrading the charm.
+        self.run_hooks('install', 'config-changed', 'start')
+        self.unit.resources['termserver'] = b'new termserver image'
+        result = self.unit.run('upgrade-charm')
+        self.assertEqual(1, result['image-imports'])
+        self.assertEqual(1, result['service-restarts'])
+
+    def test_controller_ca_rotated(self):
+        # The service is restarted when the controller CA changes, as new
+        # sessions would otherwise fail to connect to the controller.
+        self.run_hooks('install', 'config-changed', 'start')
+        with open(os.path.join(self.unit.dir, 'agent.conf'), 'w') as f:
+            f.write('cacert: new agent cert\n')
+        result = self.unit.run('update-status')
+        self.assertEqual(1, result['service-restarts'])
+        self.assertNotIn('jujushell.restart.pending', self.unit.flags())
+        self.assertEqual(('active', 'jujushell running'), self.unit.status)
+
+    def test_addresses_reranked(self):
+        # Restarting the service, dropping all sessions, is deferred to the
+        # next config change when only the ranking of addresses changes.
+        addrs = ['1.2.3.4:17070', '4.3.2.1:17070']
+        self.unit.config['juju-addrs'] = ' '.join(addrs)
+        self.run_hooks('install', 'config-changed', 'start')
+        with patch('jujushell.rank_addresses', return_value=addrs[::-1]):
+            result = self.unit.run('update-status')
+        self.assertEqual(0, result['service-restarts'])
+        self.assertIn('jujushell.restart.pending', self.unit.flags())
+        self.assertEqual((
+            'active',
+            'jujushell running, restart pending to apply config changes',
+        ), self.unit.status)
+        # Options not affecting the server config also apply the restart.
+        with patch('jujushell.rank_addresses', return_value=addrs[::-1]):
+            result = self.unit.run('config-changed', home_volume_expiry=7)
+        self.assertEqual(1, result['service-restarts'])
+        self.assertNotIn('jujushell.restart.pending', self.unit.flags())
+
+    def test_populate_cache_failure(self):
+        # Hooks do not fail if the cache volume cannot be populated, and the
+        # operation is retried by the next hook.
+        with patch('jujushell.populate_cache_volume',
+                   side_effect=OSError('boom')):
+            self.run_hooks('install', 'config-changed', 'start')
+            self.assertNotIn('jujushell.cache.populated', self.unit.flags())
+            self.run_hooks('update-status')
+        self.assertEqual(
+            ('blocked', 'cannot populate the cache volume: boom'),
+            self.unit.status)
+        self.run_hooks('update-status')
+        self.assertIn('jujushell.cache.populated', self.unit.flags())
+
+    def test_update_status_invalid_config(self):
+        # The unit is blocked, rather than failing hooks, if the config is not
+        # valid.
+        self.run_hooks('install', 'config-changed', 'start')
+        result = self.unit.run(
+            'update-status', lxd_bridge_ipv4_address='bad address',
+            lxd_bridge_dhcp_range_size=10)
+        self.assertEqual(0, result['lxd-calls'])
+        self.assertEqual('blocked', self.unit.status[0])
+        self.assertIn('bad address', self.unit.status[1])
+
+    def test_update_status_failing_step(self):
+        # A failing step does not prevent the remaining ones from running.
+        self.run_hooks('install', 'config-changed', 'start')
+        with patch('jujushell.place_containers', side_effect=OSError('boom')):
+            with patch('jujushell.reap_containers') as mock_reap:
+                self.unit.run('update-status')
+        self.assertTrue(mock_reap.called)
+        self.assertEqual((
+            'active', 'jujushell running, failed to place containers',
+        ), self.unit.status)
+
+    def test_update_status_leader(self):
+        # The leader reports the free slots in the whole cluster.
+        self.run_hooks('install', 'config-changed', 'start')
+        self.unit.leader = True
+        peers = {'jujushell/1': {'free-slots': 3}}
+        with patch('jujushell.cluster_capacity', return_value=peers):
+            with patch('jujushell.unit_capacity',
+                       return_value={'free-slots': 7}):
+                self.unit.run('update-status')
+        self.assertEqual((
+            'active', 'jujushell running, cluster: 10 free slots on 2 units',
+        ), self.unit.status)
+
+    def test_report(self):
+        # The report includes a row for every hook run.
+        self.run_hooks('install', 'start')
+        lines = self.unit.report().splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertEqual(['hook'] + list(OPERATIONS) + ['seconds'],
+                         lines[0].split())
+        self.assertEqual('install', lines[1].split()[0])
+        self.assertEqual('start', lines[2].split()[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
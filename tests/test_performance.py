@@ -0,0 +1,264 @@
+# Copyright 2017 Canonical Ltd.
+# Licensed under the AGPLv3, see LICENCE file for details.
+
+"""Performance regression tests, run against a fake LXD server.
+
+Each benchmark runs a charm helper with 10, 100 and 1000 LXD objects, and
+fails if the number of LXD API calls exceeds the stored baseline. The time
+required to import the charm library, which is done by every hook, is also
+tracked, and slow modules must not be imported along with it. Wall times
+depend on the machine, so they are only checked when JUJUSHELL_PERF_TIMING is
+set, with a tolerance of JUJUSHELL_PERF_TOLERANCE times the baseline (3 by
+default). Set JUJUSHELL_PERF_UPDATE to store the current results as the new
+baseline.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import pylxd
+
+_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+_layer = os.path.join(_root, 'lib', 'charms', 'layer')
+sys.path.insert(0, _layer)
+
+# jujushell can only be imported after the layer directory has been added to
+# the python path.
+import jujushell  # noqa: E402
+
+from fakelxd import FakeLXD  # noqa: E402
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'performance.json')
+SIZES = (10, 100, 1000)
+
+
+class _Benchmark(unittest.TestCase):
+    """Run charm helpers against a fake LXD and compare with the baseline."""
+
+    results = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        if not os.getenv('JUJUSHELL_PERF_UPDATE'):
+            return
+        baseline = _load_baseline()
+        baseline.update(cls.results)
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+            f.write('\n')
+
+    def setUp(self):
+        for name in ('log', 'status_set'):
+            patcher = patch('charmhelpers.core.hookenv.' + name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch('jujushell.set_flag')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_benchmark(self, name, setup, func):
+        """Run the given benchmark for all sizes.
+
+        The setup function receives the fake LXD and the size, and returns
+        the arguments for calling func.
+        """
+        baseline = _load_baseline().get(name, {})
+        for size in SIZES:
+            with self.subTest(size=size):
+                lxd = FakeLXD()
+                args = setup(lxd, size)
+                with patch('jujushell._lxd_client', lxd.client):
+                    start = time.monotonic()
+                    func(*args)
+                    elapsed = time.monotonic() - start
+                result = {'calls': lxd.count(), 'seconds': round(elapsed, 4)}
+                self.results.setdefault(name, {})[str(size)] = result
+                expected = baseline.get(str(size))
+                if expected is None or os.getenv('JUJUSHELL_PERF_UPDATE'):
+                    continue
+                self.assertLessEqual(
+                    result['calls'], expected['calls'],
+                    'LXD API calls regressed for {} with {} objects'.format(
+                        name, size))
+                self.check_time(name, result, expected)
+
+    def check_time(self, name, result, expected):
+        """Check the wall time in result against the expected one."""
+        if not os.getenv('JUJUSHELL_PERF_TIMING'):
+            return
+        tolerance = float(os.getenv('JUJUSHELL_PERF_TOLERANCE') or 3)
+        self.assertLessEqual(
+            result['seconds'], expected['seconds'] * tolerance,
+            'wall time regressed for {}'.format(name))
+
+
+def _load_baseline():
+    """Return the stored baseline results."""
+    try:
+        with open(BASELINE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+class TestBenchmarks(_Benchmark):
+
+    def test_import_lxd_image(self):
+        # An image is imported when many other images exist.
+        def setup(lxd, size):
+            for i in range(size):
+                lxd.add_image('image {}'.format(i).encode(), ['alias'])
+            f = tempfile.NamedTemporaryFile()
+            self.addCleanup(f.close)
+            f.write(b'new image')
+            f.flush()
+            return 'termserver', f.name
+        self.run_benchmark(
+            'import_lxd_image', setup, jujushell.import_lxd_image)
+
+    def test_exterminate_containers(self):
+        # All containers are removed, half of them are running.
+        def setup(lxd, size):
+            for i in range(size):
+                lxd.add_container(
+                    'ts-{}'.format(i), 'Running' if i % 2 else 'Stopped')
+            return ()
+        self.run_benchmark(
+            'exterminate_containers', setup, jujushell.exterminate_containers)
+
+    def test_setup_lxd(self):
+        # LXD is configured when many unrelated objects exist.
+        def setup(lxd, size):
+            for i in range(size):
+                lxd.add('profiles', {'name': 'profile-{}'.format(i)})
+                lxd.add('networks', {'name': 'network-{}'.format(i)})
+            return {},
+        with patch('jujushell.call'):
+            self.run_benchmark('setup_lxd', setup, jujushell.setup_lxd)
+
+    def test_update_lxc_quotas(self):
+        # Quotas are updated when many containers exist.
+        cfg = {'lxc-quota-cpu-cores': '2', 'lxc-quota-ram': '1GB'}
+
+        def setup(lxd, size):
+            for kind, objects in jujushell._lxd_desired_state({}):
+                for obj in objects:
+                    lxd.add(kind, jujushell._lxd_strip(obj))
+            for i in range(size):
+                lxd.add_container('ts-{}'.format(i))
+            return cfg,
+        self.run_benchmark(
+            'update_lxc_quotas', setup, jujushell.update_lxc_quotas)
+
+    def test_relaunch_containers(self):
+        # Outdated containers are relaunched from the current image.
+        def setup(lxd, size):
+            old = lxd.add_image(b'old image')
+            lxd.add_image(b'new image', ['termserver'])
+            for i in range(size):
+                lxd.add_container('ts-{}'.format(i), config={
+                    'volatile.base_image': old,
+                }, profiles=['default', 'termserver'])
+            return {},
+        with patch('jujushell.call'):
+            self.run_benchmark(
+                'relaunch_containers', setup, jujushell.relaunch_containers)
+
+
+class TestImportTime(_Benchmark):
+
+    # Define the modules that must not be loaded when importing the library.
+    slow_modules = (
+        'charmhelpers.core.host',
+        'charmhelpers.core.templating',
+        'charmhelpers.core.unitdata',
+        'charms.reactive',
+        'pylxd',
+        'sqlite3',
+    )
+
+    def test_import(self):
+        # The charm library is imported quickly, in a new interpreter.
+        script = (
+            'import json, sys, time\n'
+            'sys.path.insert(0, {!r})\n'
+            'start = time.monotonic()\n'
+            'import jujushell\n'
+            'elapsed = time.monotonic() - start\n'
+            'print(json.dumps([elapsed, sorted(sys.modules)]))\n'
+        ).format(_layer)
+        output = subprocess.check_output([sys.executable, '-c', script])
+        elapsed, modules = json.loads(output.decode('utf-8'))
+        for name in self.slow_modules:
+            self.assertNotIn(name, modules)
+        result = {'seconds': round(elapsed, 4)}
+        self.results['import'] = result
+        expected = _load_baseline().get('import')
+        if expected is None or os.getenv('JUJUSHELL_PERF_UPDATE'):
+            return
+        self.check_time('import', result, expected)
+
+
+class TestFakeLXD(unittest.TestCase):
+
+    def test_objects(self):
+        # Objects can be created, retrieved, updated and removed.
+        lxd = FakeLXD()
+        api = lxd.client().api
+        api.profiles.post(json={'name': 'p', 'config': {'a': '1'}})
+        api.profiles['p'].patch(json={'config': {'b': '2'}})
+        self.assertEqual(
+            {'a': '1', 'b': '2'},
+            api.profiles['p'].get().json()['metadata']['config'])
+        api.profiles['p'].put(json={'config': {}, 'devices': {}})
+        self.assertEqual([{
+            'name': 'p', 'config': {}, 'description': '', 'devices': {},
+        }], api.profiles.get(params={'recursion': 1}).json()['metadata'])
+        with self.assertRaises(pylxd.exceptions.Conflict):
+            api.profiles.post(json={'name': 'p'})
+        api.profiles['p'].delete()
+        with self.assertRaises(pylxd.exceptions.NotFound):
+            api.profiles['p'].get()
+        self.assertEqual(8, lxd.count())
+        self.assertEqual(1, lxd.count('PATCH'))
+
+    def test_images(self):
+        # Images can be created and aliased.
+        lxd = FakeLXD()
+        client = lxd.client()
+        image = client.images.create(b'data', wait=True)
+        image.add_alias('termserver', '')
+        self.assertEqual(
+            [{'name': 'termserver'}],
+            client.images.get(image.fingerprint).aliases)
+        image.delete_alias('termserver')
+        self.assertEqual([], client.images.all()[0].aliases)
+
+    def test_containers(self):
+        # Containers can be started, stopped and deleted.
+        lxd = FakeLXD()
+        client = lxd.client()
+        container = client.containers.create({'name': 'c'}, wait=True)
+        container.start(wait=True)
+        self.assertEqual('Running', client.containers.all()[0].status)
+        container.stop(wait=True)
+        container.delete(wait=True)
+        self.assertEqual([], client.containers.all())
+
+    def test_latency(self):
+        # API calls can be slowed down.
+        lxd = FakeLXD(latency=0.01)
+        start = time.monotonic()
+        lxd.client().api.containers.get()
+        self.assertGreaterEqual(time.monotonic() - start, 0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()